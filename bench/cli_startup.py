@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the CLI startup with `python -X importtime`
+
+    python3 bench/cli_startup.py [runs]
+
+Runs `eris --help` and `eris list-members` on an empty database
+and reports the wall time, the cumulative import time and the
+slowest imports of the eris packages.
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+ERIS = path.realpath(path.join(__file__, "..", "..", "bin", "eris"))
+SRC = path.realpath(path.join(__file__, "..", "..", "src"))
+
+COMMANDS = (
+    ("--help",),
+    ("list-members",),
+)
+
+# Slowest imports reported per command
+TOP_IMPORTS = 5
+
+
+def parse_importtime(output):
+    """Get (module, self us, cumulative us) from -X importtime output"""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, module = line[12:].split("|")
+        if not self_us.strip().isdigit():
+            continue # The header line
+        imports.append(
+            (module.strip(), int(self_us), int(cumulative_us)))
+
+    return imports
+
+
+def run(cwd, args):
+    """Run the CLI once, get the wall time and the imports"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", ERIS, *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True)
+    duration = time.perf_counter() - start
+
+    return duration, parse_importtime(result.stderr)
+
+
+def create_database(directory):
+    """Create an empty members database from the schema"""
+    subprocess.run(
+        [sys.executable, "-c",
+         "import sqlite3, sys;"
+         "sqlite3.connect('members.sqlite3').executescript(sys.stdin.read())"],
+        cwd=directory,
+        input=open(path.join(SRC, "..", "db", "schema.sql")).read(),
+        text=True,
+        check=True)
+
+
+def main():
+    """Run the benchmark"""
+    runs = 5
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    with tempfile.TemporaryDirectory() as directory:
+        create_database(directory)
+
+        for args in COMMANDS:
+            best = None
+            for _ in range(runs):
+                duration, imports = run(directory, args)
+                if best is None or duration < best[0]:
+                    best = (duration, imports)
+            duration, imports = best
+
+            total = sum(self_us for _, self_us, _ in imports)
+            eris = sorted(
+                (i for i in imports if i[0].split(".")[0] in (
+                    "eris", "eris_cli")),
+                key=lambda i: -i[2])
+
+            print("eris {}".format(" ".join(args)))
+            print("  wall:\t\t{:.1f}ms".format(duration * 1000))
+            print("  imports:\t{:.1f}ms, {} modules".format(
+                total / 1000, len(imports)))
+            for module, _self_us, cumulative_us in eris[:TOP_IMPORTS]:
+                print("  {:<32}\t{:.1f}ms".format(
+                    module, cumulative_us / 1000))
+
+
+if __name__ == "__main__":
+    main()
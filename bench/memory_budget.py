@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+Check the peak memory of the import, calculation and listing
+paths with tracemalloc on synthetic data of increasing size
+
+    python3 bench/memory_budget.py [scale]
+
+Streaming operations must keep their peak memory about flat
+while the input grows, buffered operations must stay below a
+budget per row. Exits with status 1 if a budget is exceeded.
+"""
+
+import contextlib
+import os
+import sys
+import tempfile
+import tracemalloc
+from argparse import Namespace
+from datetime import date
+from os import path
+
+sys.path.append(
+    path.realpath(path.join(__file__, "..", "..", "src")))
+
+from eris import accounting, banking, db
+from eris_cli.scripts import members as members_script
+
+from read_transactions import write_export
+
+SCHEMA = path.realpath(path.join(__file__, "..", "..", "db", "schema.sql"))
+
+# Rows per run, multiplied by the scale argument
+SIZES = (5000, 10000, 20000)
+
+# Members paying in the synthetic bank exports
+EXPORT_MEMBERS = 1000
+
+# The peak of a streaming operation may grow by this factor from
+# the smallest to the largest input, plus a fixed allowance for
+# the interpreter's own bookkeeping.
+STREAMING_GROWTH = 1.25
+STREAMING_SLACK = 256 * 1024
+
+# Bytes per row for operations that hold their work in memory
+BUFFERED_BYTES_PER_ROW = 4096
+
+
+def create_database(directory, members):
+    """Create a database with synthetic members"""
+    conn = db.connect(path.join(directory, "members.sqlite3"))
+    with open(SCHEMA) as file:
+        conn.executescript(file.read())
+    conn.executemany("""
+        INSERT INTO members (
+          id, name, email, notes, membership_start,
+          fee, interval, last_payment, account
+        ) VALUES ( ?, ?, ?, '', '2020-01-01', 20, 1, '2020-01-01', 0 )
+    """, ((n + 1, "Mitglied {:05d}".format(n), "m{}@example.org".format(n))
+          for n in range(members)))
+    conn.execute("UPDATE state SET accounts_calculated_at = '2023-01-01'")
+    conn.commit()
+
+    return conn
+
+
+def create_export(directory, rows):
+    """Write a synthetic bank export"""
+    filename = path.join(directory, "export.csv")
+    with open(filename, "w", encoding="iso-8859-1") as file:
+        write_export(file, rows, members=EXPORT_MEMBERS)
+
+    return filename
+
+
+def add_import_rules(conn):
+    """Assign the payers of the export to their members"""
+    conn.executemany("""
+        INSERT INTO bank_import_rules ( iban_hash, member_id, handler )
+        VALUES ( ?, ?, 'use_member_id' )
+    """, ((banking.hash_iban(
+        "Mitglied {:05d}".format(n), "DE{:020d}".format(n)), n + 1)
+          for n in range(EXPORT_MEMBERS)))
+    conn.commit()
+
+
+def setup_read(directory, rows):
+    """Read a bank export of rows transactions"""
+    filename = create_export(directory, rows)
+
+    def run():
+        for _ in banking.iter_transactions(filename):
+            pass
+
+    return run
+
+
+def setup_import(directory, rows):
+    """Import a bank export of rows transactions"""
+    conn = create_database(directory, EXPORT_MEMBERS)
+    add_import_rules(conn)
+    filename = create_export(directory, rows)
+
+    def run():
+        not_imported = banking.import_transactions(
+            conn, filename, force=True)
+        assert not not_imported, "synthetic payments not assigned"
+
+    return run
+
+
+def setup_list(directory, rows):
+    """List rows members"""
+    conn = create_database(directory, rows)
+
+    def run():
+        members_script.list_members(conn, Namespace(name=None))
+
+    return run
+
+
+def setup_calculate(directory, rows):
+    """Calculate the accounts of rows members"""
+    conn = create_database(directory, rows)
+
+    def run():
+        accounting.run_account_calculations(conn)
+        assert db.get_accounts_calculated_at(conn) == date.today()
+
+    return run
+
+
+# Name, setup, streaming
+OPERATIONS = (
+    ("read statement", setup_read, True),
+    ("import statement", setup_import, True),
+    ("list members", setup_list, True),
+    ("calculate accounts", setup_calculate, False),
+)
+
+
+def measure(setup, rows):
+    """Get the peak memory of an operation above its baseline"""
+    with tempfile.TemporaryDirectory() as directory:
+        run = setup(directory, rows)
+        # Output is not part of the budget
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            tracemalloc.start()
+            try:
+                baseline = tracemalloc.get_traced_memory()[0]
+                run()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    return peak - baseline
+
+
+def check_streaming(peaks):
+    """The largest input may not need much more than the smallest"""
+    budget = peaks[0] * STREAMING_GROWTH + STREAMING_SLACK
+    return peaks[-1] <= budget, budget
+
+
+def check_buffered(sizes, peaks):
+    """Every run must stay within the budget per row"""
+    budget = sizes[-1] * BUFFERED_BYTES_PER_ROW
+    return all(p <= s * BUFFERED_BYTES_PER_ROW
+               for s, p in zip(sizes, peaks)), budget
+
+
+def main():
+    """Run the memory budget checks"""
+    scale = 1.0
+    if len(sys.argv) > 1:
+        scale = float(sys.argv[1])
+    sizes = [int(size * scale) for size in SIZES]
+
+    failed = []
+    for name, setup, streaming in OPERATIONS:
+        # Fill caches and import lazily loaded modules first
+        measure(setup, sizes[0])
+
+        peaks = [measure(setup, rows) for rows in sizes]
+        if streaming:
+            ok, budget = check_streaming(peaks)
+        else:
+            ok, budget = check_buffered(sizes, peaks)
+        if not ok:
+            failed.append(name)
+
+        print("{:<20}\t{}".format(
+            name, "streaming" if streaming else "buffered"))
+        for rows, peak in zip(sizes, peaks):
+            print("  {:>8} rows\t{:>10.1f} KiB\t{:>8.0f} B/row".format(
+                rows, peak / 1024, peak / rows))
+        print("  budget {:.1f} KiB: {}".format(
+            budget / 1024, "ok" if ok else "EXCEEDED"))
+
+    if failed:
+        print("memory budget exceeded: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the bank CSV readers on a synthetic export
+
+    python3 bench/read_transactions.py [rows]
+"""
+
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.append(
+    path.realpath(path.join(__file__, "..", "..", "src")))
+
+from eris import banking
+
+HEADER = (
+    "Umsätze Girokonto;Zeitraum: 01.01.2023 - 31.12.2023;\n"
+    "Kontostand;01.01.2023;\n"
+    "\n"
+    "Buchungstag;Wert;Umsatzart;Begünstigter / Auftraggeber;"
+    "Verwendungszweck;IBAN;BIC;Kundenreferenz;Mandatsreferenz ;"
+    "Gläubiger ID;Fremde Gebühren;Betrag;Abweichender Empfänger;"
+    "Anzahl der Aufträge;Anzahl der Schecks;Soll;Haben;Währung\n"
+)
+ROW = (
+    "{day:02d}.{month:02d}.2023;{day:02d}.{month:02d}.2023;SEPA-Gutschrift;"
+    "Mitglied {member:05d};Beitrag {n};DE{member:020d};DEUTDEDBXXX;"
+    ";;;;;;;;;{amount},00;EUR\n"
+)
+FOOTER = "Kontostand;31.12.2023;;;1.234,56;EUR\n"
+
+
+def write_export(file, rows, members=1000):
+    """Write a synthetic Deutsche Bank export"""
+    file.write(HEADER)
+    for n in range(rows):
+        file.write(ROW.format(
+            day=1 + n % 28,
+            month=1 + (n // 28) % 12,
+            member=n % members,
+            n=n,
+            amount=10 + n % 3 * 10))
+    file.write(FOOTER)
+
+
+def measure(func, *args):
+    """Best of three runs"""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        result = func(*args)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+
+    return result, best
+
+
+def main():
+    """Run the benchmark"""
+    rows = 100000
+    if len(sys.argv) > 1:
+        rows = int(sys.argv[1])
+
+    with tempfile.NamedTemporaryFile(
+            "w", suffix=".csv", encoding="iso-8859-1") as file:
+        write_export(file, rows)
+        file.flush()
+
+        # Fill the iban hash cache, it is shared by both readers
+        banking.read_transactions(file.name)
+
+        expected, csv_time = measure(
+            banking.read_transactions_csv, file.name, "de", "iso-8859-1")
+        result, mmap_time = measure(
+            banking.read_transactions, file.name)
+
+    assert result == expected, "readers disagree"
+    print("rows:\t{}".format(len(result)))
+    print("csv:\t{:.3f}s".format(csv_time))
+    print("mmap:\t{:.3f}s ({:.2f}x)".format(mmap_time, csv_time / mmap_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+
+-- Transactions of closed years moved to separate database files.
+-- The filename is relative to the directory of the main database.
+CREATE TABLE transaction_archives (
+    year              INTEGER           PRIMARY KEY,
+    filename          TEXT              NOT NULL
+);
@@ -0,0 +1,75 @@
+
+-- Monthly totals of transactions by kind, maintained by triggers.
+-- Amounts are kept in cents to avoid floating point sums.
+CREATE TABLE monthly_totals (
+    month             TEXT              NOT NULL, -- YYYY-MM
+    kind              VARCHAR(20)       NOT NULL, -- payment, fee, adjustment, undo
+    count             INTEGER           NOT NULL DEFAULT 0,
+    amount_cents      INTEGER           NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (month, kind)
+);
+
+CREATE TRIGGER monthly_totals_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        CASE WHEN NEW.description LIKE '[UNDO]%' THEN 'undo'
+             WHEN NEW.description LIKE 'membership fee%' THEN 'fee'
+             WHEN NEW.description LIKE 'manual account adjustment%' THEN 'adjustment'
+             ELSE 'payment' END,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+CREATE TRIGGER monthly_totals_delete AFTER DELETE ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = CASE WHEN OLD.description LIKE '[UNDO]%' THEN 'undo'
+                       WHEN OLD.description LIKE 'membership fee%' THEN 'fee'
+                       WHEN OLD.description LIKE 'manual account adjustment%' THEN 'adjustment'
+                       ELSE 'payment' END;
+END;
+
+CREATE TRIGGER monthly_totals_update AFTER UPDATE OF date, amount, description ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = CASE WHEN OLD.description LIKE '[UNDO]%' THEN 'undo'
+                       WHEN OLD.description LIKE 'membership fee%' THEN 'fee'
+                       WHEN OLD.description LIKE 'manual account adjustment%' THEN 'adjustment'
+                       ELSE 'payment' END;
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        CASE WHEN NEW.description LIKE '[UNDO]%' THEN 'undo'
+             WHEN NEW.description LIKE 'membership fee%' THEN 'fee'
+             WHEN NEW.description LIKE 'manual account adjustment%' THEN 'adjustment'
+             ELSE 'payment' END,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+-- Existing transactions. Archived years are not included.
+INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+SELECT substr(date, 1, 7),
+       CASE WHEN description LIKE '[UNDO]%' THEN 'undo'
+            WHEN description LIKE 'membership fee%' THEN 'fee'
+            WHEN description LIKE 'manual account adjustment%' THEN 'adjustment'
+            ELSE 'payment' END AS kind,
+       count(*),
+       sum(CAST(round(amount * 100) AS INTEGER))
+  FROM transactions
+ GROUP BY 1, 2;
@@ -0,0 +1,15 @@
+
+-- Bank import runs. The row_offset is the position after the last
+-- committed row: a byte offset for exports read from the memory
+-- map, a row number for exports read with the csv module.
+CREATE TABLE import_runs (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    fingerprint       VARCHAR(64)       NOT NULL, -- sha256 of the file
+    filename          TEXT              NOT NULL,
+    started_at        TEXT              NOT NULL, -- DATETIME
+    finished_at       TEXT              NULL     DEFAULT NULL,
+    row_offset        INTEGER           NOT NULL DEFAULT 0,
+    rows_imported     INTEGER           NOT NULL DEFAULT 0
+);
+
+CREATE INDEX import_runs_fingerprint_idx ON import_runs(fingerprint);
@@ -0,0 +1,32 @@
+
+-- Batches of transactions created by one import or calculation run.
+-- accounts_calculated_at is the state before the batch.
+CREATE TABLE batches (
+    id                      INTEGER       PRIMARY KEY AUTOINCREMENT,
+    kind                    VARCHAR(20)   NOT NULL, -- import, calculation, undo
+    description             TEXT          NOT NULL,
+    created_at              TEXT          NOT NULL, -- DATETIME
+    accounts_calculated_at  TEXT          NULL,     -- DATE
+    undone_at               TEXT          NULL     DEFAULT NULL
+);
+
+-- The last_payment of members before a batch changed it
+CREATE TABLE batch_members (
+    batch_id          INTEGER           NOT NULL,
+    member_id         INTEGER           NOT NULL,
+    last_payment      TEXT              NOT NULL, -- DATE
+
+    PRIMARY KEY (batch_id, member_id),
+    FOREIGN KEY (batch_id) REFERENCES batches(id)
+      ON DELETE CASCADE,
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE
+);
+
+ALTER TABLE transactions
+  ADD COLUMN batch_id INTEGER NULL DEFAULT NULL REFERENCES batches(id);
+
+CREATE INDEX transactions_batch_id_idx ON transactions(batch_id);
+
+ALTER TABLE import_runs
+  ADD COLUMN batch_id INTEGER NULL REFERENCES batches(id);
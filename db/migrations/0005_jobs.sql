@@ -0,0 +1,15 @@
+
+-- Queued writer jobs, run one at a time by the writer process
+CREATE TABLE jobs (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    kind              VARCHAR(20)       NOT NULL, -- import, calculate, adjust
+    params            JSONB             NOT NULL,
+    status            VARCHAR(20)       NOT NULL DEFAULT 'queued',
+    output            TEXT              NOT NULL DEFAULT '',
+    error             TEXT              NULL     DEFAULT NULL,
+    created_at        TEXT              NOT NULL, -- DATETIME
+    started_at        TEXT              NULL     DEFAULT NULL,
+    finished_at       TEXT              NULL     DEFAULT NULL
+);
+
+CREATE INDEX jobs_status_idx ON jobs(status, id);
@@ -0,0 +1,15 @@
+
+-- Reached dunning level of members in arrears
+CREATE TABLE dunning (
+    member_id         INTEGER           PRIMARY KEY,
+    level             INTEGER           NOT NULL,
+    notified_at       TEXT              NOT NULL, -- DATE
+    notified_account  DECIMAL(10, 2)    NOT NULL,
+
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE
+);
+
+-- Payment periods in arrears, see eris.dunning.ARREARS
+CREATE INDEX members_arrears_idx
+    ON members((-account / (fee * interval * 1.0)));
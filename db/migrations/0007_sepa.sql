@@ -0,0 +1,39 @@
+-- SEPA creditor settings, a single row
+CREATE TABLE sepa_creditor (
+    name              VARCHAR(70)       NOT NULL,
+    iban              VARCHAR(34)       NOT NULL,
+    bic               VARCHAR(11)       NULL     DEFAULT NULL,
+    creditor_id       VARCHAR(35)       NOT NULL
+);
+
+-- Direct debit mandates, one per member
+CREATE TABLE sepa_mandates (
+    member_id         INTEGER           PRIMARY KEY,
+    mandate_id        VARCHAR(35)       NOT NULL UNIQUE,
+    iban              VARCHAR(34)       NOT NULL,
+    bic               VARCHAR(11)       NULL     DEFAULT NULL,
+    signed_on         TEXT              NOT NULL, -- DATE
+
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE
+);
+
+-- Exported direct debits, pending until the payment is imported
+CREATE TABLE sepa_collections (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    member_id         INTEGER           NOT NULL,
+    mandate_id        VARCHAR(35)       NOT NULL,
+    msg_id            VARCHAR(35)       NOT NULL,
+    end_to_end_id     VARCHAR(35)       NOT NULL UNIQUE,
+    seq_type          VARCHAR(4)        NOT NULL, -- FRST, RCUR
+    amount_cents      INTEGER           NOT NULL,
+    collection_date   TEXT              NOT NULL, -- DATE
+    status            VARCHAR(20)       NOT NULL, -- pending, collected
+
+    FOREIGN KEY (member_id) REFERENCES members(id)
+);
+
+CREATE INDEX sepa_collections_member_idx
+    ON sepa_collections(member_id, status);
+CREATE INDEX sepa_collections_mandate_idx
+    ON sepa_collections(mandate_id, status);
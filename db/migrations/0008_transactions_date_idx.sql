@@ -0,0 +1,2 @@
+-- Listing transactions by date, see eris.db.iter_transactions
+CREATE INDEX transactions_date_idx ON transactions(date, id);
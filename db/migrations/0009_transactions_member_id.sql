@@ -0,0 +1,97 @@
+-- Rebuild transactions with an integer member_id.
+-- Run with the sqlite3 shell, foreign keys must be off while
+-- the table is replaced. Rows referencing missing members are
+-- listed by the foreign_key_check at the end.
+PRAGMA foreign_keys = OFF;
+
+BEGIN;
+
+CREATE TABLE transactions_rebuild (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    member_id         INTEGER           NOT NULL,
+    date              TEXT              NOT NULL, -- DATE
+    account_name      VARCHAR(100)      NOT NULL,
+    amount            DECIMAL(10, 2)    NOT NULL,
+    description       TEXT              NOT NULL,
+    batch_id          INTEGER           NULL     DEFAULT NULL,
+
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE,
+    FOREIGN KEY (batch_id) REFERENCES batches(id)
+);
+
+INSERT INTO transactions_rebuild (
+    id, member_id, date, account_name, amount, description, batch_id
+) SELECT id, CAST(member_id AS INTEGER), date, account_name,
+         amount, description, batch_id
+    FROM transactions;
+
+-- Keep the autoincrement counter, ids of deleted rows are not reused
+UPDATE sqlite_sequence
+   SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'transactions')
+ WHERE name = 'transactions_rebuild';
+
+DROP TABLE transactions;
+ALTER TABLE transactions_rebuild RENAME TO transactions;
+
+CREATE INDEX transactions_batch_id_idx ON transactions(batch_id);
+CREATE INDEX transactions_date_idx ON transactions(date, id);
+CREATE INDEX transactions_member_id_idx ON transactions(member_id);
+
+CREATE TRIGGER monthly_totals_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        CASE WHEN NEW.description LIKE '[UNDO]%' THEN 'undo'
+             WHEN NEW.description LIKE 'membership fee%' THEN 'fee'
+             WHEN NEW.description LIKE 'manual account adjustment%' THEN 'adjustment'
+             ELSE 'payment' END,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+CREATE TRIGGER monthly_totals_delete AFTER DELETE ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = CASE WHEN OLD.description LIKE '[UNDO]%' THEN 'undo'
+                       WHEN OLD.description LIKE 'membership fee%' THEN 'fee'
+                       WHEN OLD.description LIKE 'manual account adjustment%' THEN 'adjustment'
+                       ELSE 'payment' END;
+END;
+
+CREATE TRIGGER monthly_totals_update AFTER UPDATE OF date, amount, description ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = CASE WHEN OLD.description LIKE '[UNDO]%' THEN 'undo'
+                       WHEN OLD.description LIKE 'membership fee%' THEN 'fee'
+                       WHEN OLD.description LIKE 'manual account adjustment%' THEN 'adjustment'
+                       ELSE 'payment' END;
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        CASE WHEN NEW.description LIKE '[UNDO]%' THEN 'undo'
+             WHEN NEW.description LIKE 'membership fee%' THEN 'fee'
+             WHEN NEW.description LIKE 'manual account adjustment%' THEN 'adjustment'
+             ELSE 'payment' END,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+PRAGMA foreign_key_check;
+
+COMMIT;
+
+PRAGMA foreign_keys = ON;
@@ -0,0 +1,87 @@
+-- Change log for incremental syncs, appended by triggers.
+-- Consumers read entries after their last seen id and fetch
+-- the current rows, see eris.db.get_changes.
+CREATE TABLE changes (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    table_name        VARCHAR(40)       NOT NULL,
+    row_key           TEXT              NOT NULL,
+    operation         VARCHAR(10)       NOT NULL, -- insert, update, delete
+    changed_at        TEXT              NOT NULL  -- DATETIME
+);
+
+CREATE INDEX changes_row_idx ON changes(table_name, row_key, id);
+
+CREATE TRIGGER changes_members_insert AFTER INSERT ON members
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'members', NEW.id, 'insert', datetime() );
+END;
+
+CREATE TRIGGER changes_members_update AFTER UPDATE ON members
+WHEN OLD.name IS NOT NEW.name
+    OR OLD.email IS NOT NEW.email
+    OR OLD.notes IS NOT NEW.notes
+    OR OLD.membership_start IS NOT NEW.membership_start
+    OR OLD.membership_end IS NOT NEW.membership_end
+    OR OLD.fee IS NOT NEW.fee
+    OR OLD.interval IS NOT NEW.interval
+    OR OLD.last_payment IS NOT NEW.last_payment
+    OR OLD.account IS NOT NEW.account
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'members', NEW.id, 'update', datetime() );
+END;
+
+CREATE TRIGGER changes_members_delete AFTER DELETE ON members
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'members', OLD.id, 'delete', datetime() );
+END;
+
+CREATE TRIGGER changes_transactions_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', NEW.id, 'insert', datetime() );
+END;
+
+CREATE TRIGGER changes_transactions_update AFTER UPDATE ON transactions
+WHEN OLD.member_id IS NOT NEW.member_id
+    OR OLD.date IS NOT NEW.date
+    OR OLD.account_name IS NOT NEW.account_name
+    OR OLD.amount IS NOT NEW.amount
+    OR OLD.description IS NOT NEW.description
+    OR OLD.batch_id IS NOT NEW.batch_id
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', NEW.id, 'update', datetime() );
+END;
+
+CREATE TRIGGER changes_transactions_delete AFTER DELETE ON transactions
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', OLD.id, 'delete', datetime() );
+END;
+
+CREATE TRIGGER changes_bank_import_rules_insert AFTER INSERT ON bank_import_rules
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'bank_import_rules', NEW.iban_hash, 'insert', datetime() );
+END;
+
+CREATE TRIGGER changes_bank_import_rules_update AFTER UPDATE ON bank_import_rules
+WHEN OLD.member_id IS NOT NEW.member_id
+    OR OLD.handler IS NOT NEW.handler
+    OR OLD.params IS NOT NEW.params
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'bank_import_rules', NEW.iban_hash, 'update', datetime() );
+END;
+
+CREATE TRIGGER changes_bank_import_rules_delete AFTER DELETE ON bank_import_rules
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'bank_import_rules', OLD.iban_hash, 'delete', datetime() );
+END;
+
+-- Entries up to this id may have been removed by a compaction
+ALTER TABLE state ADD COLUMN changes_compacted_until INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,5 @@
+-- Balances as of a date, see eris.db.get_balances.
+-- The amount makes the index covering for the sum.
+DROP INDEX transactions_member_id_idx;
+CREATE INDEX transactions_member_date_idx
+    ON transactions(member_id, date, amount);
@@ -0,0 +1,91 @@
+-- Store the kind of a transaction instead of deriving it from the
+-- description, which holds free text for bank payments.
+DROP TRIGGER monthly_totals_insert;
+DROP TRIGGER monthly_totals_delete;
+DROP TRIGGER monthly_totals_update;
+DROP TRIGGER changes_transactions_update;
+
+ALTER TABLE transactions
+  ADD COLUMN kind VARCHAR(20) NOT NULL DEFAULT 'payment'; -- payment, fee, adjustment, undo
+
+-- The batch tells the kind where there is one. Older rows fall back
+-- to the descriptions written by eris, compared case sensitively.
+UPDATE transactions
+   SET kind = CASE
+       (SELECT kind FROM batches WHERE batches.id = transactions.batch_id)
+         WHEN 'undo' THEN 'undo'
+         WHEN 'calculation' THEN 'fee'
+         WHEN 'import' THEN 'payment'
+         ELSE CASE
+           WHEN substr(description, 1, 7) = '[UNDO] ' THEN 'undo'
+           WHEN substr(description, 1, 14) = 'membership fee' THEN 'fee'
+           WHEN substr(description, 1, 25) = 'manual account adjustment'
+             THEN 'adjustment'
+           ELSE 'payment' END
+       END;
+
+CREATE TRIGGER monthly_totals_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        NEW.kind,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+CREATE TRIGGER monthly_totals_delete AFTER DELETE ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = OLD.kind;
+END;
+
+CREATE TRIGGER monthly_totals_update AFTER UPDATE OF date, amount, kind ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = OLD.kind;
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        NEW.kind,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+CREATE TRIGGER changes_transactions_update AFTER UPDATE ON transactions
+WHEN OLD.member_id IS NOT NEW.member_id
+    OR OLD.date IS NOT NEW.date
+    OR OLD.account_name IS NOT NEW.account_name
+    OR OLD.amount IS NOT NEW.amount
+    OR OLD.description IS NOT NEW.description
+    OR OLD.batch_id IS NOT NEW.batch_id
+    OR OLD.kind IS NOT NEW.kind
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', NEW.id, 'update', datetime() );
+END;
+
+-- Recount the months still in the table, archived months keep
+-- their totals.
+DELETE FROM monthly_totals
+ WHERE month IN (SELECT DISTINCT substr(date, 1, 7) FROM transactions);
+
+INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+SELECT substr(date, 1, 7),
+       kind,
+       count(*),
+       sum(CAST(round(amount * 100) AS INTEGER))
+  FROM transactions
+ GROUP BY 1, 2;
@@ -0,0 +1,29 @@
+-- Members were added with their account set directly, without
+-- a transaction. Book the part of each account not covered by the
+-- transactions as opening balance at the start of the membership,
+-- so the balances summed from the transactions match the accounts.
+-- Archived transactions are not visible here, databases with
+-- archives are left as they are.
+INSERT INTO transactions (
+  member_id,
+  date,
+  account_name,
+  amount,
+  description,
+  kind
+)
+SELECT members.id,
+       members.membership_start,
+       '',
+       round(members.account - coalesce(sums.amount, 0), 2),
+       'opening balance',
+       'adjustment'
+  FROM members
+  LEFT JOIN (
+    SELECT member_id, sum(amount) AS amount
+      FROM transactions
+     GROUP BY member_id
+  ) AS sums ON sums.member_id = members.id
+ WHERE round(members.account - coalesce(sums.amount, 0), 2) != 0
+   AND NOT EXISTS (SELECT 1 FROM transaction_archives)
+ ORDER BY members.id;
@@ -0,0 +1,11 @@
+-- Rows of an import run that could not be assigned to a member.
+-- A new run of the finished file imports only these rows.
+CREATE TABLE import_unmatched (
+    run_id            INTEGER           NOT NULL,
+    row_offset        INTEGER           NOT NULL, -- position after the row
+    transaction_data  JSONB             NOT NULL,
+
+    PRIMARY KEY (run_id, row_offset),
+    FOREIGN KEY (run_id) REFERENCES import_runs(id)
+      ON DELETE CASCADE
+);
@@ -0,0 +1,4 @@
+-- Remember the import batch that marked a collection as collected,
+-- so undoing the batch makes the collection pending again.
+ALTER TABLE sepa_collections
+  ADD COLUMN collected_batch_id INTEGER NULL DEFAULT NULL REFERENCES batches(id);
@@ -1,3 +1,6 @@
+-- Let eris maintain free pages without rewriting the file
+PRAGMA auto_vacuum = INCREMENTAL;
+
 
 CREATE TABLE members (
     id                INTEGER           PRIMARY KEY AUTOINCREMENT,
@@ -22,20 +25,301 @@ CREATE TABLE bank_import_rules (
       ON DELETE CASCADE
 );
 
+-- Batches of transactions created by one import or calculation run.
+-- accounts_calculated_at is the state before the batch.
+CREATE TABLE batches (
+    id                      INTEGER       PRIMARY KEY AUTOINCREMENT,
+    kind                    VARCHAR(20)   NOT NULL, -- import, calculation, undo
+    description             TEXT          NOT NULL,
+    created_at              TEXT          NOT NULL, -- DATETIME
+    accounts_calculated_at  TEXT          NULL,     -- DATE
+    undone_at               TEXT          NULL     DEFAULT NULL
+);
+
+-- The last_payment of members before a batch changed it
+CREATE TABLE batch_members (
+    batch_id          INTEGER           NOT NULL,
+    member_id         INTEGER           NOT NULL,
+    last_payment      TEXT              NOT NULL, -- DATE
+
+    PRIMARY KEY (batch_id, member_id),
+    FOREIGN KEY (batch_id) REFERENCES batches(id)
+      ON DELETE CASCADE,
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE
+);
+
 CREATE TABLE transactions (
     id                INTEGER           PRIMARY KEY AUTOINCREMENT,
-    member_id         VARCHAR(100)      NOT NULL,
+    member_id         INTEGER           NOT NULL,
     date              TEXT              NOT NULL, -- DATE
     account_name      VARCHAR(100)      NOT NULL,
     amount            DECIMAL(10, 2)    NOT NULL,
     description       TEXT              NOT NULL,
+    batch_id          INTEGER           NULL     DEFAULT NULL,
+    kind              VARCHAR(20)       NOT NULL DEFAULT 'payment', -- payment, fee, adjustment, undo
+
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE,
+    FOREIGN KEY (batch_id) REFERENCES batches(id)
+);
+
+CREATE INDEX transactions_batch_id_idx ON transactions(batch_id);
+CREATE INDEX transactions_date_idx ON transactions(date, id);
+CREATE INDEX transactions_member_date_idx
+    ON transactions(member_id, date, amount);
+
+-- Monthly totals of transactions by kind, maintained by triggers.
+-- Amounts are kept in cents to avoid floating point sums.
+CREATE TABLE monthly_totals (
+    month             TEXT              NOT NULL, -- YYYY-MM
+    kind              VARCHAR(20)       NOT NULL, -- payment, fee, adjustment, undo
+    count             INTEGER           NOT NULL DEFAULT 0,
+    amount_cents      INTEGER           NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (month, kind)
+);
+
+CREATE TRIGGER monthly_totals_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        NEW.kind,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+CREATE TRIGGER monthly_totals_delete AFTER DELETE ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = OLD.kind;
+END;
+
+CREATE TRIGGER monthly_totals_update AFTER UPDATE OF date, amount, kind ON transactions
+BEGIN
+    UPDATE monthly_totals
+       SET count = count - 1,
+           amount_cents = amount_cents - CAST(round(OLD.amount * 100) AS INTEGER)
+     WHERE month = substr(OLD.date, 1, 7)
+       AND kind = OLD.kind;
+    INSERT INTO monthly_totals ( month, kind, count, amount_cents )
+    VALUES (
+        substr(NEW.date, 1, 7),
+        NEW.kind,
+        1,
+        CAST(round(NEW.amount * 100) AS INTEGER))
+    ON CONFLICT (month, kind) DO UPDATE
+       SET count = count + 1,
+           amount_cents = amount_cents + excluded.amount_cents;
+END;
+
+-- Transactions of closed years moved to separate database files.
+-- The filename is relative to the directory of the main database.
+CREATE TABLE transaction_archives (
+    year              INTEGER           PRIMARY KEY,
+    filename          TEXT              NOT NULL
+);
+
+-- Bank import runs. The row_offset is the position after the last
+-- committed row: a byte offset for exports read from the memory
+-- map, a row number for exports read with the csv module.
+CREATE TABLE import_runs (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    fingerprint       VARCHAR(64)       NOT NULL, -- sha256 of the file
+    filename          TEXT              NOT NULL,
+    started_at        TEXT              NOT NULL, -- DATETIME
+    finished_at       TEXT              NULL     DEFAULT NULL,
+    row_offset        INTEGER           NOT NULL DEFAULT 0,
+    rows_imported     INTEGER           NOT NULL DEFAULT 0,
+    batch_id          INTEGER           NULL,
+
+    FOREIGN KEY (batch_id) REFERENCES batches(id)
+);
+
+CREATE INDEX import_runs_fingerprint_idx ON import_runs(fingerprint);
+
+-- Rows of an import run that could not be assigned to a member.
+-- A new run of the finished file imports only these rows.
+CREATE TABLE import_unmatched (
+    run_id            INTEGER           NOT NULL,
+    row_offset        INTEGER           NOT NULL, -- position after the row
+    transaction_data  JSONB             NOT NULL,
+
+    PRIMARY KEY (run_id, row_offset),
+    FOREIGN KEY (run_id) REFERENCES import_runs(id)
+      ON DELETE CASCADE
+);
+
+-- Queued writer jobs, run one at a time by the writer process
+CREATE TABLE jobs (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    kind              VARCHAR(20)       NOT NULL, -- import, calculate, adjust
+    params            JSONB             NOT NULL,
+    status            VARCHAR(20)       NOT NULL DEFAULT 'queued',
+    output            TEXT              NOT NULL DEFAULT '',
+    error             TEXT              NULL     DEFAULT NULL,
+    created_at        TEXT              NOT NULL, -- DATETIME
+    started_at        TEXT              NULL     DEFAULT NULL,
+    finished_at       TEXT              NULL     DEFAULT NULL
+);
+
+CREATE INDEX jobs_status_idx ON jobs(status, id);
+
+-- Reached dunning level of members in arrears
+CREATE TABLE dunning (
+    member_id         INTEGER           PRIMARY KEY,
+    level             INTEGER           NOT NULL,
+    notified_at       TEXT              NOT NULL, -- DATE
+    notified_account  DECIMAL(10, 2)    NOT NULL,
+
+    FOREIGN KEY (member_id) REFERENCES members(id)
+      ON DELETE CASCADE
+);
+
+-- Payment periods in arrears, see eris.dunning.ARREARS
+CREATE INDEX members_arrears_idx
+    ON members((-account / (fee * interval * 1.0)));
+
+-- SEPA creditor settings, a single row
+CREATE TABLE sepa_creditor (
+    name              VARCHAR(70)       NOT NULL,
+    iban              VARCHAR(34)       NOT NULL,
+    bic               VARCHAR(11)       NULL     DEFAULT NULL,
+    creditor_id       VARCHAR(35)       NOT NULL
+);
+
+-- Direct debit mandates, one per member
+CREATE TABLE sepa_mandates (
+    member_id         INTEGER           PRIMARY KEY,
+    mandate_id        VARCHAR(35)       NOT NULL UNIQUE,
+    iban              VARCHAR(34)       NOT NULL,
+    bic               VARCHAR(11)       NULL     DEFAULT NULL,
+    signed_on         TEXT              NOT NULL, -- DATE
 
     FOREIGN KEY (member_id) REFERENCES members(id)
       ON DELETE CASCADE
 );
 
+-- Exported direct debits, pending until the payment is imported.
+-- collected_batch_id is the import batch that booked the payment.
+CREATE TABLE sepa_collections (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    member_id         INTEGER           NOT NULL,
+    mandate_id        VARCHAR(35)       NOT NULL,
+    msg_id            VARCHAR(35)       NOT NULL,
+    end_to_end_id     VARCHAR(35)       NOT NULL UNIQUE,
+    seq_type          VARCHAR(4)        NOT NULL, -- FRST, RCUR
+    amount_cents      INTEGER           NOT NULL,
+    collection_date   TEXT              NOT NULL, -- DATE
+    status            VARCHAR(20)       NOT NULL, -- pending, collected, cancelled
+    collected_batch_id INTEGER          NULL     DEFAULT NULL,
+
+    FOREIGN KEY (member_id) REFERENCES members(id),
+    FOREIGN KEY (collected_batch_id) REFERENCES batches(id)
+);
+
+CREATE INDEX sepa_collections_member_idx
+    ON sepa_collections(member_id, status);
+CREATE INDEX sepa_collections_mandate_idx
+    ON sepa_collections(mandate_id, status);
+
+-- Change log for incremental syncs, appended by triggers.
+-- Consumers read entries after their last seen id and fetch
+-- the current rows, see eris.db.get_changes.
+CREATE TABLE changes (
+    id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+    table_name        VARCHAR(40)       NOT NULL,
+    row_key           TEXT              NOT NULL,
+    operation         VARCHAR(10)       NOT NULL, -- insert, update, delete
+    changed_at        TEXT              NOT NULL  -- DATETIME
+);
+
+CREATE INDEX changes_row_idx ON changes(table_name, row_key, id);
+
+CREATE TRIGGER changes_members_insert AFTER INSERT ON members
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'members', NEW.id, 'insert', datetime() );
+END;
+
+CREATE TRIGGER changes_members_update AFTER UPDATE ON members
+WHEN OLD.name IS NOT NEW.name
+    OR OLD.email IS NOT NEW.email
+    OR OLD.notes IS NOT NEW.notes
+    OR OLD.membership_start IS NOT NEW.membership_start
+    OR OLD.membership_end IS NOT NEW.membership_end
+    OR OLD.fee IS NOT NEW.fee
+    OR OLD.interval IS NOT NEW.interval
+    OR OLD.last_payment IS NOT NEW.last_payment
+    OR OLD.account IS NOT NEW.account
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'members', NEW.id, 'update', datetime() );
+END;
+
+CREATE TRIGGER changes_members_delete AFTER DELETE ON members
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'members', OLD.id, 'delete', datetime() );
+END;
+
+CREATE TRIGGER changes_transactions_insert AFTER INSERT ON transactions
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', NEW.id, 'insert', datetime() );
+END;
+
+CREATE TRIGGER changes_transactions_update AFTER UPDATE ON transactions
+WHEN OLD.member_id IS NOT NEW.member_id
+    OR OLD.date IS NOT NEW.date
+    OR OLD.account_name IS NOT NEW.account_name
+    OR OLD.amount IS NOT NEW.amount
+    OR OLD.description IS NOT NEW.description
+    OR OLD.batch_id IS NOT NEW.batch_id
+    OR OLD.kind IS NOT NEW.kind
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', NEW.id, 'update', datetime() );
+END;
+
+CREATE TRIGGER changes_transactions_delete AFTER DELETE ON transactions
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'transactions', OLD.id, 'delete', datetime() );
+END;
+
+CREATE TRIGGER changes_bank_import_rules_insert AFTER INSERT ON bank_import_rules
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'bank_import_rules', NEW.iban_hash, 'insert', datetime() );
+END;
+
+CREATE TRIGGER changes_bank_import_rules_update AFTER UPDATE ON bank_import_rules
+WHEN OLD.member_id IS NOT NEW.member_id
+    OR OLD.handler IS NOT NEW.handler
+    OR OLD.params IS NOT NEW.params
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'bank_import_rules', NEW.iban_hash, 'update', datetime() );
+END;
+
+CREATE TRIGGER changes_bank_import_rules_delete AFTER DELETE ON bank_import_rules
+BEGIN
+    INSERT INTO changes ( table_name, row_key, operation, changed_at )
+    VALUES ( 'bank_import_rules', OLD.iban_hash, 'delete', datetime() );
+END;
+
 CREATE TABLE state (
-    accounts_calculated_at  TEXT -- DATE
+    accounts_calculated_at  TEXT, -- DATE
+    -- Changes up to this id may have been removed by a compaction
+    changes_compacted_until INTEGER NOT NULL DEFAULT 0
 );
 
 INSERT INTO state ( accounts_calculated_at ) VALUES (date());
@@ -39,6 +39,7 @@ def calculate_member_account(member, last_calculation):
         "member_id": member["id"],
         "description": f"membership fee ({months} month)",
         "amount": -fee,
+        "kind": "fee",
     }
 
     return next_amount, transaction
@@ -54,7 +55,10 @@ def run_account_calculations(members_db):
         return
     log("calculating member accounts")
 
-    members = db.get_members(members_db)
+    batch_id = db.add_batch(
+        members_db, "calculation", "membership fees until {}".format(today))
+    session = db.Session(members_db, batch_id=batch_id)
+    members = session.get_members()
     for member in members:
         if member["membership_end"]:
             print("Skipping inactive member: {}".format(member["name"]))
@@ -66,15 +70,18 @@ def run_account_calculations(members_db):
 
         # Update member account and log transaction
         transaction["date"] = today
-        db.set_account(members_db, member["id"], next_amount)
-        db.add_transaction(members_db, transaction)
+        session.set_account(member["id"], next_amount)
+        session.add_transaction(transaction)
 
-    db.set_accounts_calculated_at(members_db, today)
+    session.set_accounts_calculated_at(today)
+    session.flush()
 
 
-def adjust_member_account(members_db, member_id, amount, comment):
+def adjust_member_account(members_db, member_id, amount, comment,
+                          interactive=True):
     """Set member account value"""
-    member = db.get_member(members_db, member_id)
+    session = db.Session(members_db)
+    member = session.get_member(member_id)
     if not member:
         print("member not found")
         return
@@ -90,17 +97,33 @@ def adjust_member_account(members_db, member_id, amount, comment):
         "description": f"manual account adjustment, from {current} EUR: {comment}",
         "amount": diff,
         "date": date.today(),
+        "kind": "adjustment",
     }
 
     print(transaction)
 
-    if input("proceed? (y/n)") != "y":
+    if interactive and input("proceed? (y/n)") != "y":
         print("abort")
         return
 
-    db.set_account(members_db, member["id"], amount)
-    db.add_transaction(members_db, transaction)
+    session.set_account(member["id"], amount)
+    session.add_transaction(transaction)
+    session.flush()
 
     print("ok")
 
 
+
+
+def check_balances(members_db, today=None):
+    """
+    Compare the balances summed from the transactions with
+    the member accounts. Yields the members that differ.
+    """
+    if not today:
+        today = date.today()
+
+    for balance in db.get_balances(members_db, today):
+        if balance["balance"] != balance["account"]:
+            balance["difference"] = balance["account"] - balance["balance"]
+            yield balance
@@ -0,0 +1,427 @@
+"""
+Read-only HTTP API: members, balances, transactions,
+monthly statistics and the change log as JSON.
+
+Requests are served by asyncio while the queries run on a
+pool of read-only SQLite connections in a thread executor.
+Responses carry an ETag derived from `PRAGMA data_version`,
+so unchanged data is answered from the cache or with 304.
+"""
+
+import asyncio
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from decimal import Decimal
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+from eris import db, statistics
+from eris.logging import log
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8023
+DEFAULT_POOL_SIZE = 4
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+CACHE_SIZE = 512
+MAX_HEADER_SIZE = 16384
+
+
+class NotFoundError(LookupError):
+    """The requested resource does not exist"""
+
+
+class BadRequestError(ValueError):
+    """The request could not be understood"""
+
+
+class GoneError(LookupError):
+    """The requested changes were compacted"""
+
+
+def connect_readonly(filename):
+    """
+    Open a read-only connection usable from any executor thread.
+    mode=ro keeps the database files read-only, the temp schema
+    stays writable for the views over the archives.
+    """
+    return sqlite3.connect(
+        "file:{}?mode=ro".format(filename),
+        uri=True,
+        check_same_thread=False)
+
+
+class ConnectionPool:
+    """A fixed set of read-only connections"""
+
+    def __init__(self, filename, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(connect_readonly(filename))
+
+        # Pool connections never write, so the data_version of this
+        # connection changes exactly when another process commits.
+        self.watch = connect_readonly(filename)
+        self.watch_lock = threading.Lock()
+
+    def run(self, func, *args):
+        """Run func with a connection from the pool"""
+        conn = self.connections.get()
+        try:
+            return func(conn, *args)
+        finally:
+            self.connections.put(conn)
+
+    def data_version(self):
+        """Get the current data version of the database"""
+        with self.watch_lock:
+            return self.watch.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        """Close all connections"""
+        for _ in range(self.size):
+            self.connections.get().close()
+        self.watch.close()
+
+
+def encode_value(value):
+    """Encode values not supported by json"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError("can not encode: {}".format(type(value)))
+
+
+def get_limit(params):
+    """Get the page size from the query parameters"""
+    try:
+        limit = int(params.get("limit", DEFAULT_LIMIT))
+    except ValueError as e:
+        raise BadRequestError("limit must be an integer") from e
+
+    return max(1, min(limit, MAX_LIMIT))
+
+
+def get_int_param(params, key):
+    """Get an optional integer query parameter"""
+    value = params.get(key)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError as e:
+        raise BadRequestError("{} must be an integer".format(key)) from e
+
+
+def page(rows, limit, key="id"):
+    """Wrap a page of results with the cursor for the next page"""
+    cursor = None
+    if len(rows) == limit:
+        cursor = rows[-1][key]
+    return {"items": rows, "next": cursor}
+
+
+def query_members(conn, params):
+    """Get a page of members ordered by id"""
+    limit = get_limit(params)
+    after = get_int_param(params, "after") or 0
+    qry = """
+        SELECT * FROM members
+         WHERE id > ?
+         ORDER BY id ASC
+         LIMIT ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (after, limit))
+    rows = [db.decode_member(db.dict_row(row, cur))
+            for row in cur.fetchall()]
+
+    return page(rows, limit)
+
+
+def query_member(conn, member_id):
+    """Get a single member"""
+    member = db.get_member(conn, member_id)
+    if not member:
+        raise NotFoundError("member not found: {}".format(member_id))
+    return member
+
+
+def query_balances_as_of(conn, params):
+    """Get a page of member balances as of a date"""
+    limit = get_limit(params)
+    after = get_int_param(params, "after") or 0
+    try:
+        as_of = db.decode_date(params["as_of"])
+    except ValueError as e:
+        raise BadRequestError("as_of must be a date: YYYY-MM-DD") from e
+
+    rows = list(db.get_balances(conn, as_of, after=after, limit=limit))
+    for balance in rows:
+        del balance["account"]
+
+    return page(rows, limit)
+
+
+def query_balances(conn, params):
+    """Get a page of member balances ordered by id"""
+    if params.get("as_of"):
+        return query_balances_as_of(conn, params)
+
+    limit = get_limit(params)
+    after = get_int_param(params, "after") or 0
+    qry = """
+        SELECT id, name, account, last_payment, membership_end
+          FROM members
+         WHERE id > ?
+         ORDER BY id ASC
+         LIMIT ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (after, limit))
+    rows = []
+    for row in cur.fetchall():
+        balance = db.dict_row(row, cur)
+        balance["account"] = Decimal(balance["account"])
+        rows.append(balance)
+
+    return page(rows, limit)
+
+
+def query_transactions(conn, params, member_id=None):
+    """Get a page of transactions ordered by id"""
+    limit = get_limit(params)
+    after = get_int_param(params, "after") or 0
+    if member_id is None:
+        member_id = get_int_param(params, "member_id")
+
+    filters = "id > ? "
+    args = [after]
+    if member_id is not None:
+        filters += "AND member_id = ? "
+        args.append(member_id)
+    args.append(limit)
+
+    table = db.attach_archives(conn)
+    qry = """
+        SELECT * FROM """ + table + """
+         WHERE """ + filters + """
+         ORDER BY id ASC
+         LIMIT ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, args)
+    rows = [db.decode_transaction(db.dict_row(row, cur))
+            for row in cur.fetchall()]
+
+    return page(rows, limit)
+
+
+def query_changes(conn, params):
+    """Get the change log after a cursor"""
+    limit = get_limit(params)
+    after = get_int_param(params, "after") or 0
+    try:
+        rows = db.get_changes(
+            conn, after=after, limit=limit, table=params.get("table"))
+    except db.ChangesCompactedError as e:
+        raise GoneError(str(e)) from e
+
+    return {
+        "items": rows,
+        "next": rows[-1]["id"] if rows else after,
+        "compacted_until": db.get_changes_compacted_until(conn),
+    }
+
+
+def query_statistics(conn, params):
+    """Get the membership statistics per month"""
+    year = get_int_param(params, "year")
+    return {"items": statistics.get_monthly(conn, year=year)}
+
+
+def route(path):
+    """Resolve a path to a query function and its arguments"""
+    parts = [p for p in path.split("/") if p]
+    if parts == ["members"]:
+        return query_members, ()
+    if parts == ["balances"]:
+        return query_balances, ()
+    if parts == ["transactions"]:
+        return query_transactions, ()
+    if parts == ["changes"]:
+        return query_changes, ()
+    if parts == ["statistics", "monthly"]:
+        return query_statistics, ()
+    if len(parts) >= 2 and parts[0] == "members":
+        try:
+            member_id = int(parts[1])
+        except ValueError as e:
+            raise NotFoundError(path) from e
+        if len(parts) == 2:
+            return (lambda conn, _params: query_member(conn, member_id)), ()
+        if parts[2:] == ["transactions"]:
+            return query_transactions, (member_id,)
+
+    raise NotFoundError(path)
+
+
+class Server:
+    """The HTTP server"""
+
+    def __init__(self, filename, pool_size=DEFAULT_POOL_SIZE):
+        self.pool = ConnectionPool(filename, size=pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.cache = OrderedDict()
+        # The data_version is only meaningful for the
+        # lifetime of the watch connection.
+        self.epoch = "{:x}".format(int(time.time()))
+
+    async def run_query(self, func, *args):
+        """Run a query in the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.pool.run, func, *args)
+
+    async def data_version(self):
+        """Get the current data version without blocking the loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.pool.data_version)
+
+    def cache_get(self, target, etag):
+        """Get a cached response body if it is still current"""
+        entry = self.cache.get(target)
+        if not entry or entry[0] != etag:
+            return None
+        self.cache.move_to_end(target)
+        return entry[1]
+
+    def cache_put(self, target, etag, body):
+        """Remember a response body"""
+        self.cache[target] = (etag, body)
+        self.cache.move_to_end(target)
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    async def respond(self, method, target, headers):
+        """Create the response for a request"""
+        if method not in ("GET", "HEAD"):
+            return HTTPStatus.METHOD_NOT_ALLOWED, {}, b""
+
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        func, args = route(url.path)
+
+        version = await self.data_version()
+        etag = '"{}-{}"'.format(self.epoch, version)
+        if headers.get("if-none-match") == etag:
+            return HTTPStatus.NOT_MODIFIED, {"ETag": etag}, b""
+
+        body = self.cache_get(target, etag)
+        if body is None:
+            result = await self.run_query(func, params, *args)
+            body = json.dumps(result, default=encode_value).encode("utf-8")
+            self.cache_put(target, etag, body)
+
+        return HTTPStatus.OK, {
+            "ETag": etag,
+            "Content-Type": "application/json",
+        }, body
+
+    async def handle(self, reader, writer):
+        """Handle a client connection"""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError,
+                        ConnectionError):
+                    return
+
+                lines = head.decode("iso-8859-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                try:
+                    status, extra, body = await self.respond(
+                        method, target, headers)
+                except NotFoundError as e:
+                    status, extra, body = HTTPStatus.NOT_FOUND, {}, \
+                        json.dumps({"error": str(e)}).encode("utf-8")
+                except BadRequestError as e:
+                    status, extra, body = HTTPStatus.BAD_REQUEST, {}, \
+                        json.dumps({"error": str(e)}).encode("utf-8")
+                except GoneError as e:
+                    status, extra, body = HTTPStatus.GONE, {}, \
+                        json.dumps({"error": str(e)}).encode("utf-8")
+                except Exception as e: # pylint: disable=broad-except
+                    # Keep serving, e.g. when the database is busy
+                    log("error handling {} {}: {!r}", method, target, e)
+                    status, extra, body = \
+                        HTTPStatus.INTERNAL_SERVER_ERROR, {}, \
+                        json.dumps({"error": "internal error"}).encode("utf-8")
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if version == "HTTP/1.0":
+                    keep_alive = headers.get(
+                        "connection", "").lower() == "keep-alive"
+
+                response = "HTTP/1.1 {} {}\r\n".format(
+                    status.value, status.phrase)
+                extra["Content-Length"] = str(len(body))
+                extra["Connection"] = "keep-alive" if keep_alive else "close"
+                for key, value in extra.items():
+                    response += "{}: {}\r\n".format(key, value)
+                response += "\r\n"
+
+                writer.write(response.encode("iso-8859-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """Accept connections until cancelled"""
+        server = await asyncio.start_server(
+            self.handle, host, port, limit=MAX_HEADER_SIZE)
+        log("serving api on http://{}:{}/", host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """Release the executor and connections"""
+        self.executor.shutdown()
+        self.pool.close()
+
+
+def serve(filename, host=DEFAULT_HOST, port=DEFAULT_PORT,
+          pool_size=DEFAULT_POOL_SIZE):
+    """Run the api server"""
+    server = Server(filename, pool_size=pool_size)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
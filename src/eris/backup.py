@@ -0,0 +1,228 @@
+"""
+Online backups with the SQLite backup API.
+
+Pages are copied in small steps with a pause in between, so
+writers are only held up for the duration of a step. Each copy
+is checked with an integrity check before it replaces the oldest
+one, and its sha256 is recorded in a manifest that can be checked
+with `sha256sum -c MANIFEST.sha256`.
+
+The transaction archives are copied next to the copies under their
+own names, as the copies refer to them by name. They are not
+rotated and only copied again when they changed.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+
+from eris import db
+
+# Pages copied per step and pause between the steps in seconds
+BACKUP_PAGES = 1024
+BACKUP_SLEEP = 0.05
+
+DEFAULT_KEEP = 7
+
+MANIFEST = "MANIFEST.sha256"
+
+
+class BackupError(RuntimeError):
+    """A backup copy failed verification"""
+
+
+def file_sha256(filename):
+    """Get the sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_manifest(directory):
+    """Get the checksums of the copies as {filename: sha256}"""
+    checksums = {}
+    try:
+        with open(os.path.join(directory, MANIFEST)) as file:
+            for line in file:
+                checksum, _, filename = line.rstrip("\n").partition("  ")
+                if filename:
+                    checksums[filename] = checksum
+    except FileNotFoundError:
+        pass
+
+    return checksums
+
+
+def write_manifest(directory, checksums):
+    """Replace the manifest"""
+    filename = os.path.join(directory, MANIFEST)
+    with open(filename + ".tmp", "w") as file:
+        for name, checksum in sorted(checksums.items()):
+            file.write("{}  {}\n".format(checksum, name))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(filename + ".tmp", filename)
+
+
+def check_integrity(filename):
+    """Run the integrity check on a copy"""
+    conn = sqlite3.connect("file:{}?mode=ro".format(filename), uri=True)
+    try:
+        rows = conn.execute("PRAGMA integrity_check").fetchall()
+    finally:
+        conn.close()
+
+    return [row[0] for row in rows if row[0] != "ok"]
+
+
+def copy_database(conn, target, progress=None):
+    """Copy the database step by step into the target file"""
+    dst = sqlite3.connect(target)
+    try:
+        conn.backup(
+            dst,
+            pages=BACKUP_PAGES,
+            progress=progress,
+            sleep=BACKUP_SLEEP)
+    finally:
+        dst.close()
+
+
+def verify_copy(target):
+    """
+    Check the copy written to target.tmp and move it in place.
+    Returns its checksum.
+    """
+    problems = check_integrity(target + ".tmp")
+    if problems:
+        os.remove(target + ".tmp")
+        raise BackupError("integrity check failed: {}".format(
+            "; ".join(problems)))
+
+    checksum = file_sha256(target + ".tmp")
+    os.replace(target + ".tmp", target)
+
+    return checksum
+
+
+def backup_archives(conn, directory, checksums, progress=None):
+    """Copy the new or changed transaction archives, updates checksums"""
+    source_directory = os.path.dirname(db.get_filename(conn))
+    for filename in db.get_transaction_archives(conn).values():
+        source = os.path.join(source_directory, filename)
+        target = os.path.join(directory, filename)
+        if filename in checksums and os.path.exists(target) and \
+                os.path.getmtime(source) <= os.path.getmtime(target):
+            continue
+
+        archive = sqlite3.connect("file:{}?mode=ro".format(source), uri=True)
+        try:
+            copy_database(archive, target + ".tmp", progress)
+        finally:
+            archive.close()
+        checksums[filename] = verify_copy(target)
+
+
+def copy_pattern(name):
+    """Match the names of the copies of a database, not its archives"""
+    return re.compile(re.escape(name) + r"-\d{8}-\d{6}(-\d+)?\.sqlite3$")
+
+
+def copy_filename(directory, name, checksums):
+    """
+    Get the filename of a new copy. Copies made in the same second
+    are numbered, name-20240101-120000-02.sqlite3 and so on.
+    """
+    stem = "{}-{}".format(name, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    pattern = copy_pattern(name)
+    taken = [
+        copy_sort_key(n) for n in set(checksums) | set(os.listdir(directory))
+        if n.startswith(stem) and pattern.match(n)
+    ]
+    if not taken:
+        return stem + ".sqlite3"
+
+    # Number after the newest copy, older ones may be rotated out
+    number = int(max(taken)[len(stem) + 1:] or 1) + 1
+    return "{}-{:02d}.sqlite3".format(stem, number)
+
+
+def copy_sort_key(filename):
+    """Order copies by age, numbered copies after the first one"""
+    return os.path.splitext(filename)[0]
+
+
+def backup(conn, directory, keep=DEFAULT_KEEP, progress=None):
+    """
+    Write a verified copy of the database and its changed
+    archives to a directory and remove the oldest copies beyond
+    keep. Returns the filename and checksum of the new copy.
+    """
+    if keep < 1:
+        raise ValueError("at least one copy must be kept")
+
+    os.makedirs(directory, exist_ok=True)
+    name, _ext = os.path.splitext(os.path.basename(db.get_filename(conn)))
+    filename = copy_filename(directory, name, read_manifest(directory))
+    target = os.path.join(directory, filename)
+
+    copy_database(conn, target + ".tmp", progress)
+    checksum = verify_copy(target)
+
+    checksums = read_manifest(directory)
+    checksums[filename] = checksum
+    backup_archives(conn, directory, checksums, progress)
+
+    pattern = copy_pattern(name)
+    copies = sorted(
+        (n for n in checksums if pattern.match(n)),
+        key=copy_sort_key)
+    for old in copies[:len(copies) - keep]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except FileNotFoundError:
+            pass
+        del checksums[old]
+    write_manifest(directory, checksums)
+
+    return filename, checksum
+
+
+def verify_backups(directory):
+    """
+    Check every copy in the manifest against its checksum.
+    Returns {filename: problem or None}.
+    """
+    results = {}
+    for filename, checksum in read_manifest(directory).items():
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            results[filename] = "missing"
+        elif file_sha256(path) != checksum:
+            results[filename] = "checksum mismatch"
+        else:
+            results[filename] = None
+
+    return results
+
+
+class Progress:
+    """Report the backup progress at most every interval seconds"""
+
+    def __init__(self, out, interval=1.0):
+        self.out = out
+        self.interval = interval
+        self.reported_at = 0
+
+    def __call__(self, _status, remaining, total):
+        now = time.monotonic()
+        if remaining and now - self.reported_at < self.interval:
+            return
+        self.reported_at = now
+        self.out("{} of {} pages copied".format(total - remaining, total))
@@ -1,14 +1,22 @@
 """
 ERIS Bank Import: Currently supported are CSV
-exports of Deutsche Bank.
+exports of Deutsche Bank, CAMT.053 and MT940 statements.
 """
 
+import codecs
 import csv
 import hashlib
+import itertools
+import mmap
+import os
+import re
 from datetime import date
 from decimal import Decimal
+from functools import lru_cache
 
-from eris import db
+from eris import db, sepa, statements
+from eris.logging import log
+from eris.matching import NameIndex
 
 F_DATE = 0
 F_ACCOUNT_NAME = 3
@@ -17,7 +25,44 @@ F_IBAN = 5
 F_BIC = 6
 F_AMOUNT = 16
 
+# Automatic rules need this lead of the best suggestion over the next
+AUTO_ASSIGN_MARGIN = 0.1
+
+# Bytes read to detect the format of a statement
+FORMAT_DETECTION_SIZE = 4096
+
+# Encodings in which ';', digits and the date separators
+# are single ASCII bytes, so lines can be scanned as bytes.
+ASCII_COMPATIBLE_ENCODINGS = ("iso8859-1", "cp1252", "utf-8", "ascii")
+
+
+def compile_row_pattern(sep):
+    """
+    Match a transaction line: a date in the first column and an
+    amount in column F_AMOUNT. Only the used columns are captured.
+    """
+    field = rb"([^;\r\n]*)"
+    skip = rb"[^;\r\n]*;"
+    date_field = rb"(\d{1,2})" + sep + rb"(\d{1,2})" + sep + rb"(\d{4})"
+    return re.compile(
+        rb"^" + date_field + b";" +                 # F_DATE
+        skip * (F_ACCOUNT_NAME - F_DATE - 1) +
+        field + b";" +                              # F_ACCOUNT_NAME
+        field + b";" +                              # F_DESCRIPTION
+        field + b";" +                              # F_IBAN
+        field + b";" +                              # F_BIC
+        skip * (F_AMOUNT - F_BIC - 1) +
+        rb"([^;\r\n]+)",                          # F_AMOUNT
+        re.MULTILINE)
+
+
+ROW_PATTERNS = {
+    "de": compile_row_pattern(rb"\."),
+    "en": compile_row_pattern(b"/"),
+}
+
 
+@lru_cache(maxsize=65536)
 def hash_iban(name, iban):
     """Hash the iban"""
     return hashlib.pbkdf2_hmac(
@@ -85,24 +130,84 @@ def get_csv_lang(filename, encoding=None):
     if not encoding:
         encoding="iso-8859-1" # default
 
-    content = ""
     with open(filename, encoding=encoding) as file:
-        content = file.read()
+        header = file.readline()
 
-    lines = content.split("\n")
-    if "Transactions" in lines[0]:
+    if "Transactions" in header:
         return "en"
 
     return "de"
-        
 
-def read_transactions(filename, encoding=None):
-    """Read bank .csv"""
-    if not encoding:
-        encoding="iso-8859-1" # default
 
-    lang = get_csv_lang(filename, encoding)
+@lru_cache(maxsize=4096)
+def decode_date_bytes(lang, first, second, year):
+    """Decode the date fields matched by the row pattern"""
+    if lang == "de":
+        return date(int(year), int(second), int(first))
+
+    return date(int(year), int(first), int(second))
 
+
+@lru_cache(maxsize=4096)
+def decode_amount_bytes(lang, value):
+    """Decode the amount from bytes"""
+    if lang == "en":
+        value = value.translate(None, b",")
+    if lang == "de":
+        value = value.translate(None, b".").replace(b",", b".")
+
+    return Decimal(value.decode("ascii"))
+
+
+def iter_transactions_mmap(filename, lang, encoding, offset=0):
+    """
+    Scan a memory mapped export for transaction rows and
+    decode only the columns used. Yields the byte offset after
+    each row with the transaction. Rows with an invalid date or
+    amount are skipped and logged.
+    """
+    pattern = ROW_PATTERNS[lang]
+    with open(filename, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in pattern.finditer(data, offset):
+                first, second, year, name, description, iban, bic, amount = \
+                    match.groups()
+                try:
+                    tx_date = decode_date_bytes(lang, first, second, year)
+                    tx_amount = decode_amount_bytes(lang, amount)
+                    account_name = name.decode(encoding)
+                    iban = iban.decode(encoding)
+                    description = description.decode(encoding)
+                    bic = bic.decode(encoding)
+                except (ValueError, ArithmeticError):
+                    log("skipping malformed row at byte {} of {}: {}",
+                        match.start(), filename,
+                        match.group(0)[:80].decode(encoding, "replace"))
+                    continue
+                yield match.end(), {
+                    "date": tx_date,
+                    "account_name": account_name,
+                    "description": description,
+                    "iban": iban,
+                    "iban_hash": hash_iban(account_name, iban),
+                    "bic": bic,
+                    "amount": tx_amount,
+                }
+
+
+def use_mmap_reader(filename, encoding):
+    """Check if the export can be parsed as plain bytes"""
+    if codecs.lookup(encoding).name not in ASCII_COMPATIBLE_ENCODINGS:
+        return False
+
+    with open(filename, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # Quoted fields may contain separators or line breaks
+            return data.find(b'"') == -1
+
+
+def read_transactions_csv(filename, lang, encoding):
+    """Read bank .csv with the csv module"""
     transactions = []
     with open(filename, encoding=encoding) as file:
         reader = csv.reader(file, delimiter=";")
@@ -111,19 +216,133 @@ def read_transactions(filename, encoding=None):
                 decode_date(lang, row[0])
             except:
                 continue
-            if len(row) < F_AMOUNT:
+            if len(row) <= F_AMOUNT:
                 continue
             if not row[F_AMOUNT]:
                 continue # We can skip outbound TX
 
-            transactions.append(decode_transaction(lang, row))
+            try:
+                transactions.append(decode_transaction(lang, row))
+            except (ValueError, ArithmeticError):
+                log("skipping malformed row {} of {}: {}",
+                    reader.line_num, filename, ";".join(row)[:80])
 
     return transactions
 
 
-def validate_transaction(members_db, transaction):
+class UnsupportedFormatError(ValueError):
+    """The statement format could not be detected"""
+
+
+# Statement formats as (name, detect, iterate), tried in order.
+# detect gets the first bytes of the file, iterate is called with
+# filename, encoding and offset and yields (position, transaction).
+STATEMENT_FORMATS = []
+
+
+def register_statement_format(name, detect, iterate):
+    """Add a statement format, tried before the ones already added"""
+    STATEMENT_FORMATS.insert(0, (name, detect, iterate))
+
+
+def detect_statement_format(filename):
+    """Get the name and iterator of the format of a statement"""
+    with open(filename, "rb") as file:
+        head = file.read(FORMAT_DETECTION_SIZE)
+
+    for name, detect, iterate in STATEMENT_FORMATS:
+        if detect(head):
+            return name, iterate
+
+    raise UnsupportedFormatError(
+        "unknown statement format: {}".format(filename))
+
+
+def with_iban_hash(transactions, offset):
+    """
+    Add the iban hash to parsed statement entries. Positions
+    are entry numbers, the first offset entries are skipped.
+    """
+    for position, transaction in enumerate(
+            itertools.islice(transactions, offset, None), offset + 1):
+        transaction["iban_hash"] = hash_iban(
+            transaction["account_name"], transaction["iban"])
+        yield position, transaction
+
+
+def iter_transactions_camt053(filename, _encoding=None, offset=0):
+    """Iterate the incoming payments of a CAMT.053 statement"""
+    yield from with_iban_hash(statements.iter_camt053(filename), offset)
+
+
+def iter_transactions_mt940(filename, encoding=None, offset=0):
+    """Iterate the incoming payments of a MT940 statement"""
+    if not encoding:
+        encoding="iso-8859-1" # default
+
+    yield from with_iban_hash(
+        statements.iter_mt940(filename, encoding), offset)
+
+
+def detect_csv(head):
+    """Deutsche Bank CSV exports are separated by semicolons"""
+    return not head or b";" in head
+
+
+def iter_transactions_csv(filename, encoding=None, offset=0):
+    """
+    Iterate the transactions of a bank .csv with the position after
+    each, starting at offset. Positions are byte offsets for the
+    memory mapped reader and row numbers for the csv reader.
+    """
+    if not encoding:
+        encoding="iso-8859-1" # default
+
+    lang = get_csv_lang(filename, encoding)
+    if os.path.getsize(filename) == 0 or \
+        not use_mmap_reader(filename, encoding):
+        transactions = read_transactions_csv(filename, lang, encoding)
+        for row, transaction in enumerate(transactions[offset:], offset):
+            yield row + 1, transaction
+        return
+
+    yield from iter_transactions_mmap(filename, lang, encoding, offset)
+
+
+register_statement_format("csv", detect_csv, iter_transactions_csv)
+register_statement_format("mt940", statements.detect_mt940,
+                          iter_transactions_mt940)
+register_statement_format("camt053", statements.detect_camt053,
+                          iter_transactions_camt053)
+
+
+def iter_transactions(filename, encoding=None, offset=0):
+    """
+    Iterate the transactions of a bank statement in any registered
+    format with the position after each, starting at offset.
+    """
+    _name, iterate = detect_statement_format(filename)
+    yield from iterate(filename, encoding, offset)
+
+
+def read_transactions(filename, encoding=None):
+    """Read a bank statement"""
+    return [tx for _, tx in iter_transactions(filename, encoding)]
+
+
+def file_fingerprint(filename):
+    """Get the sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def validate_transaction(session, transaction):
     """Check if the transaction should be added"""
-    member = db.get_member(members_db, transaction["member_id"])
+    member = session.get_member(transaction["member_id"])
     if transaction["date"] <= member["last_payment"]:
         return ("Date {} is before last payment: {} " +
             "for member: {} ({})").format(
@@ -135,12 +354,11 @@ def validate_transaction(members_db, transaction):
     return None
 
 
-def add_payment(members_db, transaction):
+def add_payment(session, transaction):
     """Log transaction and add payment to account"""
-    member = db.get_member(members_db, transaction["member_id"])
-
-    db.add_payment(members_db, transaction)
-    db.add_transaction(members_db, transaction)
+    member = session.add_payment(transaction)
+    session.add_transaction(transaction)
+    sepa.mark_collected(session, transaction)
 
     print("Added payment from {} ({}): {}, {} ({})".format(
         member["name"],
@@ -150,29 +368,29 @@ def add_payment(members_db, transaction):
         transaction["description"]))
 
 
-def import_handler_rule_member_id(members_db, transaction, rule, force=False):
+def import_handler_rule_member_id(session, transaction, rule, force=False):
     """Create a transaction. Use member ID from rule."""
-    member = db.get_member(members_db, rule["member_id"])
+    member = session.get_member(rule["member_id"])
     if not member:
         raise UnknownMemberError(transaction)
 
     transaction["member_id"] = member["id"]
-    error = validate_transaction(members_db, transaction)
+    error = validate_transaction(session, transaction)
     if error and not force:
         print(error)
         return
 
-    add_payment(members_db, transaction)
+    add_payment(session, transaction)
 
 
-def import_handler_split_accounts(members_db, transaction, rule, force=False):
+def import_handler_split_accounts(session, transaction, rule, force=False):
     """Split the transaction"""
     fallback_id = rule["member_id"]
     rest = transaction["amount"]
     total = Decimal(0)
     # Check rule
     for member_id, amount in rule["params"]:
-        member = db.get_member(members_db, rule["member_id"])
+        member = session.get_member(member_id)
         if not member:
             raise UnknownMemberError(transaction)
 
@@ -196,16 +414,16 @@ def import_handler_split_accounts(members_db, transaction, rule, force=False):
         transaction["amount"] = Decimal(amount)
 
         # Check if we should add
-        error = validate_transaction(members_db, transaction)
+        error = validate_transaction(session, transaction)
         if error and not force:
             print(error)
             return
 
-        add_payment(members_db, transaction)
+        add_payment(session, transaction)
         rest -= Decimal(amount)
 
     if rest > 0:
-        member = db.get_member(members_db, fallback_id)
+        member = session.get_member(fallback_id)
         print("Adding split overflow of {} EUR to: {} ({})".format(
             rest,
             member["name"],
@@ -214,22 +432,22 @@ def import_handler_split_accounts(members_db, transaction, rule, force=False):
         transaction["amount"] = rest
         transaction["member_id"] = fallback_id
 
-        add_payment(members_db, transaction)
+        add_payment(session, transaction)
 
 
-def import_handler_account_name(members_db, transaction, _rule, force=False):
+def import_handler_account_name(session, transaction, _rule, force=False):
     """Create transaction. Member name should match the account name"""
-    member = db.get_member_by_name(members_db, transaction["account_name"])
+    member = session.get_member_by_name(transaction["account_name"])
     if not member:
         raise UnknownMemberError(transaction)
     transaction["member_id"] = member["id"]
 
-    error = validate_transaction(members_db, transaction)
+    error = validate_transaction(session, transaction)
     if error and not force:
         print(error)
         return
 
-    add_payment(members_db, transaction)
+    add_payment(session, transaction)
 
 
 IMPORT_HANDLERS = {
@@ -238,26 +456,152 @@ IMPORT_HANDLERS = {
 }
 
 
-def import_transaction(members_db, transaction, force=False):
+def import_transaction(session, transaction, force=False):
     """Import a transaction"""
     handler = import_handler_account_name
 
     # Check if we have a override rule
-    rule = db.get_bank_import_rule(members_db, transaction["iban_hash"])
+    rule = db.get_bank_import_rule(session.conn, transaction["iban_hash"])
     if rule:
         handler = IMPORT_HANDLERS[rule["handler"]]
 
-    handler(members_db, transaction, rule, force=force)
-
-
-def import_transactions(members_db, filename, encoding=None, force=False):
-    """Import transactions from bank CSV"""
-    transactions = read_transactions(filename, encoding=encoding)
+    handler(session, transaction, rule, force=force)
+
+
+def is_confident_match(suggestions, threshold):
+    """The best suggestion is above the threshold and unambiguous"""
+    if not suggestions or suggestions[0][0] < threshold:
+        return False
+    if len(suggestions) > 1 and \
+            suggestions[0][0] - suggestions[1][0] < AUTO_ASSIGN_MARGIN:
+        return False
+    return True
+
+
+def suggest_members(
+        session, not_imported, limit=3, auto_assign=None, force=False):
+    """
+    Attach member suggestions to not imported transactions. With
+    an auto_assign score threshold, a use_member_id rule is queued
+    in the session for confident matches without a rule and the
+    transaction is imported.
+    Returns the transactions still not imported.
+    """
+    index = NameIndex(session.get_members())
+    remaining = []
+    assigned = {}
+    for transaction in not_imported:
+        suggestions = index.search(transaction["account_name"], limit=limit)
+        transaction["suggestions"] = suggestions
+        iban_hash = transaction["iban_hash"]
+
+        if auto_assign is not None and iban_hash not in assigned and \
+                is_confident_match(suggestions, auto_assign) and \
+                not db.get_bank_import_rule(session.conn, iban_hash):
+            score, member = suggestions[0]
+            log("assigning {} to {} ({}), score {}",
+                transaction["account_name"], member["name"], member["id"],
+                score)
+            # Existing rules, e.g. split_accounts, are never replaced
+            session.execute("""
+                INSERT INTO bank_import_rules (
+                    iban_hash,
+                    member_id,
+                    handler,
+                    params
+                ) VALUES ( ?, ?, 'use_member_id', NULL )
+                ON CONFLICT (iban_hash) DO NOTHING
+            """, (iban_hash, member["id"]))
+            assigned[iban_hash] = member["id"]
+
+        if iban_hash in assigned:
+            # The rule is written with the next flush
+            import_handler_rule_member_id(
+                session, transaction, {"member_id": assigned[iban_hash]},
+                force=force)
+            continue
+
+        remaining.append(transaction)
+
+    return remaining
+
+
+def import_transactions(
+        members_db, filename, encoding=None, force=False, chunk_size=500,
+        auto_assign=None):
+    """
+    Import transactions from a bank statement. The work is committed in
+    chunks with a checkpoint, an interrupted import of the same
+    file continues after the last committed row. Rows that could not
+    be assigned are kept with the run: a new run of a finished file
+    only imports those, e.g. after adding import rules. The whole
+    file is only imported again after its batch was undone.
+    Members are suggested for transactions that could not be assigned.
+    force only skips the last_payment validation.
+    Returns all rows of the file still not imported.
+    """
+    _name, iterate = detect_statement_format(filename)
+    fingerprint = file_fingerprint(filename)
+    run = db.get_import_run(members_db, fingerprint)
+    earlier = []
+    if run:
+        earlier = db.get_import_unmatched(members_db, run["id"])
+    if run and run["finished_at"]:
+        if not earlier:
+            log("{} was already imported at {}, undo batch {} to "
+                "import it again", filename, run["finished_at"],
+                run["batch_id"])
+            return []
+        log("importing the {} not imported rows of {}",
+            len(earlier), filename)
+    elif not run:
+        batch_id = db.add_batch(members_db, "import", filename)
+        run = db.add_import_run(members_db, fingerprint, filename, batch_id)
+    elif run["row_offset"]:
+        log("resuming import of {} after {} rows",
+            filename, run["rows_imported"])
+
+    session = db.Session(members_db, batch_id=run["batch_id"])
     not_imported = []
-    for transaction in transactions:
-        try:
-            import_transaction(members_db, transaction, force=force)
-        except UnknownMemberError as e:
-            not_imported.append(transaction)
 
-    return not_imported
+    # Rows left over by an earlier run, rules may match them now
+    for row_offset, transaction in earlier:
+        try:
+            import_transaction(session, transaction, force=force)
+        except UnknownMemberError:
+            not_imported.append((row_offset, transaction))
+            continue
+        db.remove_import_unmatched(session, run["id"], row_offset)
+
+    offset = run["row_offset"]
+    rows = 0
+    if not run["finished_at"]:
+        for offset, transaction in iterate(filename, encoding, offset):
+            row = dict(transaction)
+            try:
+                import_transaction(session, transaction, force=force)
+            except UnknownMemberError:
+                not_imported.append((offset, transaction))
+                db.add_import_unmatched(session, run["id"], offset, row)
+
+            rows += 1
+            if rows == chunk_size:
+                db.checkpoint_import_run(session, run["id"], offset, rows)
+                session.flush()
+                rows = 0
+
+    remaining = []
+    if not_imported:
+        remaining = suggest_members(
+            session, [tx for _, tx in not_imported],
+            auto_assign=auto_assign, force=force)
+        remaining_ids = {id(tx) for tx in remaining}
+        for row_offset, transaction in not_imported:
+            if id(transaction) not in remaining_ids:
+                db.remove_import_unmatched(session, run["id"], row_offset)
+
+    db.checkpoint_import_run(
+        session, run["id"], offset, rows, finished=True)
+    session.flush()
+
+    return remaining
@@ -4,15 +4,78 @@ Database
 from datetime import date
 from decimal import Decimal
 import json
+import os
 
 import sqlite3
 
 DEFAULT_FEE = 20.0
 DEFAULT_INTERVAL = 1
 
+SNAPSHOT_INDEXES = (
+    "CREATE INDEX snapshot_members_name_idx"
+    " ON members(name COLLATE NOCASE)",
+    "CREATE INDEX snapshot_transactions_member_idx"
+    " ON transactions(member_id, date, amount)",
+    "CREATE INDEX snapshot_transactions_date_idx"
+    " ON transactions(date, id)",
+)
+
+
+class SnapshotConnection(sqlite3.Connection):
+    """In-memory copy of a database file"""
+    source_filename = None
+
+
 def connect(filename):
     """Open Sqlite Database"""
-    return sqlite3.connect(filename)
+    conn = sqlite3.connect(filename)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def snapshot(conn):
+    """
+    Copy the database into memory with the backup API and build
+    the indexes used by the reports. Changes to the copy are
+    never written back.
+    """
+    copy = sqlite3.connect(":memory:", factory=SnapshotConnection)
+    copy.source_filename = get_filename(conn)
+    conn.backup(copy)
+
+    for qry in SNAPSHOT_INDEXES:
+        copy.execute(qry)
+    copy.execute("ANALYZE")
+    copy.commit()
+
+    return copy
+
+
+def get_filename(conn):
+    """Get the filename of the main database of a connection"""
+    if getattr(conn, "source_filename", None):
+        return conn.source_filename
+
+    qry = """
+        PRAGMA database_list
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+    for _seq, name, filename in cur.fetchall():
+        if name == "main":
+            return filename
+
+    return None
+
+
+def encode_id(value):
+    """
+    Get an integer id. Ids given on the command line are
+    strings, they must not reach integer columns as text.
+    """
+    if isinstance(value, int):
+        return value
+    return int(str(value).strip())
 
 
 def dict_row(row, cur):
@@ -65,6 +128,7 @@ def decode_member(member):
 
 def decode_transaction(transaction):
     """Decode transaction"""
+    transaction["member_id"] = encode_id(transaction["member_id"])
     transaction["date"] = decode_date(transaction["date"])
     transaction["amount"] = Decimal(transaction["amount"])
 
@@ -82,21 +146,30 @@ def decode_bank_import_rule(rule):
     return rule
 
 
-def get_members(conn):
-    """Get all members from the database"""
+def iter_members(conn):
+    """Iterate all members ordered by name, one row at a time"""
     qry = """
          SELECT * FROM members
           ORDER BY name ASC
     """
     cur = conn.cursor()
     cur.execute(qry)
-    res = cur.fetchall()
+    for row in cur:
+        yield decode_member(dict_row(row, cur))
 
-    return [decode_member(dict_row(row, cur)) for row in res]
+
+def get_members(conn):
+    """Get all members from the database"""
+    return list(iter_members(conn))
 
 
 def get_member(conn, member_id):
     """Get a members by id from the database"""
+    try:
+        member_id = encode_id(member_id)
+    except ValueError:
+        return None
+
     qry = """
         SELECT *
           FROM members
@@ -150,9 +223,17 @@ def add_member(conn, member):
         interval = DEFAULT_INTERVAL
     start = member.get("membership_start", date.today())
     end   = member.get("membership_end")
-    account = member.get("account", -fee) # Initial fee
     notes = member.get("notes", "")
 
+    # The account is opened with a transaction, so the balances
+    # summed from the transactions match it
+    if "account" in member:
+        account = Decimal(str(member["account"]))
+        opening = ("opening balance", "adjustment")
+    else:
+        account = -Decimal(str(fee))
+        opening = ("membership fee (initial)", "fee")
+
     qry = """
         INSERT INTO members (
           name,
@@ -173,7 +254,7 @@ def add_member(conn, member):
         notes,
         interval,
         fee,
-        account,
+        encode_decimal(account),
         encode_date(start),
         encode_date(end),
         encode_date(start),
@@ -182,6 +263,17 @@ def add_member(conn, member):
     cur = conn.cursor()
     cur.execute(qry, params)
     res = cur.fetchone()
+    if account:
+        cur.execute("""
+            INSERT INTO transactions (
+              member_id,
+              date,
+              account_name,
+              amount,
+              description,
+              kind
+            ) VALUES ( ?, ?, '', ?, ?, ? )
+        """, (res[0], encode_date(start), encode_decimal(account), *opening))
     conn.commit()
 
     return get_member(conn, res[0])
@@ -189,6 +281,7 @@ def add_member(conn, member):
 
 def end_membership(conn, member_id, end=None):
     """Update the note of a member"""
+    member_id = encode_id(member_id)
     if not end:
         end = date.today()
 
@@ -204,6 +297,7 @@ def end_membership(conn, member_id, end=None):
 
 def set_name(conn, member_id, name):
     """Update the note of a member"""
+    member_id = encode_id(member_id)
     qry = """
         UPDATE members SET name = ? WHERE id = ?
     """
@@ -216,6 +310,7 @@ def set_name(conn, member_id, name):
 
 def set_notes(conn, member_id, notes):
     """Update the note of a member"""
+    member_id = encode_id(member_id)
     qry = """
         UPDATE members SET notes = ? WHERE id = ?
     """
@@ -228,6 +323,7 @@ def set_notes(conn, member_id, notes):
 
 def set_interval(conn, member_id, interval):
     """Update the payment interval of a member"""
+    member_id = encode_id(member_id)
     qry = """
         UPDATE members SET interval = ? WHERE id = ?
     """
@@ -240,6 +336,7 @@ def set_interval(conn, member_id, interval):
 
 def set_fee(conn, member_id, fee):
     """Update the membership fee"""
+    member_id = encode_id(member_id)
     qry = """
         UPDATE members SET fee = ? WHERE id = ?
     """
@@ -250,6 +347,37 @@ def set_fee(conn, member_id, fee):
     return get_member(conn, member_id)
 
 
+MEMBER_UPDATE_QUERIES = {
+    "name": "UPDATE members SET name = ? WHERE id = ?",
+    "fee": "UPDATE members SET fee = ? WHERE id = ?",
+    "interval": "UPDATE members SET interval = ? WHERE id = ?",
+    "membership_end": "UPDATE members SET membership_end = ? WHERE id = ?",
+}
+
+
+def update_members(conn, updates):
+    """
+    Apply a list of (member_id, field, value) updates
+    in a single transaction.
+    """
+    by_field = {}
+    for member_id, field, value in updates:
+        if field == "fee":
+            value = encode_decimal(value)
+        elif field == "membership_end":
+            value = encode_date(value)
+        by_field.setdefault(field, []).append((value, encode_id(member_id)))
+
+    cur = conn.cursor()
+    try:
+        for field, params in by_field.items():
+            cur.executemany(MEMBER_UPDATE_QUERIES[field], params)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
 def add_payment(conn, transaction):
     """Add payment to member"""
     member = get_member(conn, transaction["member_id"])
@@ -266,7 +394,7 @@ def add_payment(conn, transaction):
     params = (
         encode_decimal(transaction["amount"]),
         encode_date(transaction["date"]),
-        transaction["member_id"],
+        encode_id(transaction["member_id"]),
     )
     cur = conn.cursor()
     cur.execute(qry, params)
@@ -277,6 +405,7 @@ def add_payment(conn, transaction):
 
 def set_account(conn, member_id, value):
     """Set account value for member"""
+    member_id = encode_id(member_id)
     qry = """
         UPDATE members SET account = ? WHERE id = ?
     """
@@ -291,26 +420,264 @@ def set_account(conn, member_id, value):
     return get_member(conn, member_id)
 
 
-def get_transactions(conn, member_id=None, since=None):
-    """Get transactions"""
+# Columns of transactions kept in the archives
+ARCHIVE_COLUMNS = \
+    "id, member_id, date, account_name, amount, description, kind"
+
+TRANSACTIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {schema}.transactions (
+        id                INTEGER           PRIMARY KEY AUTOINCREMENT,
+        member_id         INTEGER           NOT NULL,
+        date              TEXT              NOT NULL, -- DATE
+        account_name      VARCHAR(100)      NOT NULL,
+        amount            DECIMAL(10, 2)    NOT NULL,
+        description       TEXT              NOT NULL,
+        kind              VARCHAR(20)       NOT NULL DEFAULT 'payment'
+    )
+"""
+
+
+def get_transaction_archives(conn):
+    """Get the archived years and their database files"""
+    qry = """
+        SELECT year, filename
+          FROM transaction_archives
+         ORDER BY year ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+
+    return dict(cur.fetchall())
+
+
+def get_archive_filename(conn, year):
+    """Get the filename for the archive of a year"""
+    stem, ext = os.path.splitext(os.path.basename(get_filename(conn)))
+    return "{}-transactions-{}{}".format(stem, year, ext or ".sqlite3")
+
+
+def archive_schema(year):
+    """Get the schema name of an attached archive"""
+    return "archive_{}".format(int(year))
+
+
+def encode_date_year(value):
+    """Get the year of a date or YYYY-MM-DD string"""
+    if isinstance(value, date):
+        return value.year
+    return int(str(value)[:4])
+
+
+def archive_has_kind(conn, schema):
+    """Archives written before transactions had a kind lack the column"""
+    columns = conn.execute(
+        "PRAGMA {}.table_info(transactions)".format(schema)).fetchall()
+    return any(column[1] == "kind" for column in columns)
+
+
+def archive_columns(conn, schema):
+    """Get ARCHIVE_COLUMNS of an archive, 'payment' for a missing kind"""
+    if archive_has_kind(conn, schema):
+        return ARCHIVE_COLUMNS
+    return ARCHIVE_COLUMNS.replace("kind", "'payment' AS kind")
+
+
+def attach_archives(conn, since=None, until=None):
+    """
+    Attach the archives overlapping the date range and
+    return the name of a view over all attached transactions.
+    """
+    archives = get_transaction_archives(conn)
+    years = [
+        year for year in archives
+        if (not since or year >= encode_date_year(since))
+        and (not until or year <= encode_date_year(until))
+    ]
+    if not years:
+        return "main.transactions"
+
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    directory = os.path.dirname(get_filename(conn))
+    for year in years:
+        schema = archive_schema(year)
+        if schema in attached:
+            continue
+        conn.execute("ATTACH DATABASE ? AS " + schema,
+                     (os.path.join(directory, archives[year]),))
+
+    view = "transactions_history_{}".format("_".join(map(str, years)))
+    conn.execute("""
+        CREATE TEMP VIEW IF NOT EXISTS {} AS
+        SELECT {}, batch_id FROM main.transactions
+    """.format(view, ARCHIVE_COLUMNS) + "".join(
+        " UNION ALL SELECT {}, NULL FROM {}.transactions".format(
+            archive_columns(conn, archive_schema(y)), archive_schema(y))
+        for y in years))
+
+    return "temp." + view
+
+
+def archive_transactions(conn, until_year):
+    """
+    Move the transactions up to and including a year into
+    per-year archive databases. Returns the archived row count per year.
+    """
+    qry = """
+        SELECT DISTINCT substr(date, 1, 4)
+          FROM transactions
+         WHERE date < ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, ("{:04d}-01-01".format(until_year + 1),))
+    years = sorted(int(r[0]) for r in cur.fetchall())
+
+    directory = os.path.dirname(get_filename(conn))
+    archives = get_transaction_archives(conn)
+    archived = {}
+    for year in years:
+        filename = archives.get(year, get_archive_filename(conn, year))
+        schema = archive_schema(year)
+        period = ("{:04d}-01-01".format(year), "{:04d}-01-01".format(year + 1))
+
+        cur.execute("ATTACH DATABASE ? AS " + schema,
+                    (os.path.join(directory, filename),))
+        try:
+            cur.execute(TRANSACTIONS_TABLE.format(schema=schema))
+            if not archive_has_kind(conn, schema):
+                cur.execute("""
+                    ALTER TABLE {}.transactions
+                      ADD COLUMN kind VARCHAR(20) NOT NULL DEFAULT 'payment'
+                """.format(schema))
+            cur.execute("""
+                INSERT INTO {0}.transactions ( {1} )
+                SELECT {1} FROM main.transactions
+                 WHERE date >= ? AND date < ?
+            """.format(schema, ARCHIVE_COLUMNS), period)
+            archived[year] = cur.rowcount
+
+            # Archived transactions stay in the monthly totals
+            cur.execute("""
+                SELECT count, amount_cents, month, kind
+                  FROM monthly_totals
+                 WHERE month >= ? AND month < ?
+            """, (period[0][:7], period[1][:7]))
+            totals = cur.fetchall()
+            cur.execute("SELECT max(id) FROM changes")
+            last_change = cur.fetchone()[0] or 0
+            cur.execute("""
+                DELETE FROM main.transactions
+                 WHERE date >= ? AND date < ?
+            """, period)
+            # Archived transactions are not deleted for consumers
+            cur.execute("""
+                DELETE FROM changes
+                 WHERE id > ? AND table_name = 'transactions'
+            """, (last_change,))
+            cur.executemany("""
+                UPDATE monthly_totals
+                   SET count = ?, amount_cents = ?
+                 WHERE month = ? AND kind = ?
+            """, totals)
+            cur.execute("""
+                INSERT OR REPLACE INTO transaction_archives (
+                    year,
+                    filename
+                ) VALUES ( ?, ? )
+            """, (year, filename))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("DETACH DATABASE " + schema)
+
+    return archived
+
+
+def iter_transactions(
+        conn, member_id=None, since=None, until=None, after=None, limit=None):
+    """
+    Iterate transactions ordered by (date, id). after is the
+    (date, id) of the last transaction of the previous page.
+    """
     filters = " 1 "
     params = []
     if member_id:
         filters += "AND member_id = ? "
-        params.append(member_id)
+        params.append(encode_id(member_id))
     if since:
-        filters += "AND date(date) >= date(?) "
-        params.append(since)
-
+        filters += "AND date >= ? "
+        params.append(encode_date(since))
+    if until:
+        filters += "AND date <= ? "
+        params.append(encode_date(until))
+    if after:
+        filters += "AND (date, id) > (?, ?) "
+        params.extend((encode_date(after[0]), int(after[1])))
+
+    table = attach_archives(conn, since=since, until=until)
     qry = """
-        SELECT * FROM transactions WHERE
-    """ + filters
+        SELECT * FROM """ + table + """
+         WHERE """ + filters + """
+         ORDER BY date ASC, id ASC
+    """
+    if limit:
+        qry += " LIMIT ? "
+        params.append(int(limit))
 
     cur = conn.cursor()
     cur.execute(qry, params)
-    res = cur.fetchall()
+    for row in cur:
+        yield decode_transaction(dict_row(row, cur))
+
+
+def iter_transactions_by_member(conn, since=None, until=None,
+                                member_id=None):
+    """
+    Iterate (member_id, transactions) for all members with
+    transactions in the period, ordered by member id, in one scan
+    of transactions_member_date_idx.
+    """
+    filters = " 1 "
+    params = []
+    if member_id is not None:
+        filters += "AND member_id = ? "
+        params.append(encode_id(member_id))
+    if since:
+        filters += "AND date >= ? "
+        params.append(encode_date(since))
+    if until:
+        filters += "AND date <= ? "
+        params.append(encode_date(until))
+
+    table = attach_archives(conn, since=since, until=until)
+    qry = """
+        SELECT * FROM """ + table + """
+         WHERE """ + filters + """
+         ORDER BY member_id ASC, date ASC, id ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, params)
+
+    member_id = None
+    transactions = []
+    for row in cur:
+        transaction = decode_transaction(dict_row(row, cur))
+        tx_member_id = transaction["member_id"]
+        if tx_member_id != member_id and transactions:
+            yield member_id, transactions
+            transactions = []
+        member_id = tx_member_id
+        transactions.append(transaction)
+
+    if transactions:
+        yield member_id, transactions
+
 
-    return [decode_transaction(dict_row(row, cur)) for row in res]
+def get_transactions(conn, member_id=None, since=None, until=None):
+    """Get transactions"""
+    return list(iter_transactions(
+        conn, member_id=member_id, since=since, until=until))
 
 
 def get_transaction(conn, tx_id):
@@ -321,6 +688,14 @@ def get_transaction(conn, tx_id):
     cur = conn.cursor()
     cur.execute(qry, (tx_id,))
     res = cur.fetchone()
+    if not res and get_transaction_archives(conn):
+        # Fall back to the archives
+        table = attach_archives(conn)
+        cur.execute("SELECT * FROM " + table + " WHERE id = ?", (tx_id,))
+        res = cur.fetchone()
+
+    if not res:
+        return None
 
     return decode_transaction(dict_row(res, cur))
 
@@ -336,16 +711,20 @@ def add_transaction(conn, transaction):
           date,
           account_name,
           amount,
-          description
-        ) VALUES ( ?, ?, ?, ?, ? )
+          description,
+          batch_id,
+          kind
+        ) VALUES ( ?, ?, ?, ?, ?, ?, ? )
         RETURNING id
     """
     params = (
-        transaction["member_id"],
+        encode_id(transaction["member_id"]),
         encode_date(tx_date),
         transaction.get("account_name", ""),
         encode_decimal(transaction.get("amount", "0.00")),
         transaction.get("description", ""),
+        transaction.get("batch_id"),
+        transaction.get("kind", "payment"),
     )
     cur = conn.cursor()
     cur.execute(qry, params)
@@ -355,6 +734,81 @@ def add_transaction(conn, transaction):
     return get_transaction(conn, res[0])
 
 
+def get_balances(conn, as_of, after=0, limit=None):
+    """
+    Get the balance of every member as of the end of a date, summed
+    from the transactions. Members are ordered by id and paged with
+    after and limit. The sum reads transactions_member_date_idx
+    in member order, no sort is needed.
+    """
+    table = attach_archives(conn, until=as_of)
+    qry = """
+        WITH page AS (
+            SELECT id, name, account
+              FROM members
+             WHERE id > ? AND membership_start <= ?
+             ORDER BY id ASC
+             LIMIT ?
+        )
+        SELECT page.id,
+               page.name,
+               page.account,
+               coalesce(balances.cents, 0) AS cents,
+               balances.transactions,
+               balances.last_date
+          FROM page
+          LEFT JOIN (
+            SELECT member_id,
+                   sum(CAST(round(amount * 100) AS INTEGER)) AS cents,
+                   count(*) AS transactions,
+                   max(date) AS last_date
+              FROM """ + table + """
+             WHERE member_id IN (SELECT id FROM page)
+               AND date <= ?
+             GROUP BY member_id
+          ) AS balances ON balances.member_id = page.id
+         ORDER BY page.id ASC
+    """
+    as_of = encode_date(as_of)
+    params = (encode_id(after), as_of, int(limit or -1), as_of)
+
+    cur = conn.cursor()
+    cur.execute(qry, params)
+    for row in cur:
+        balance = dict_row(row, cur)
+        balance["account"] = Decimal(balance["account"])
+        balance["balance"] = Decimal(balance.pop("cents")).scaleb(-2)
+        balance["transactions"] = balance["transactions"] or 0
+        if balance["last_date"]:
+            balance["last_date"] = decode_date(balance["last_date"])
+        yield balance
+
+
+def get_monthly_totals(conn, year=None):
+    """Get the transaction totals per month and kind"""
+    filters = " 1 "
+    params = []
+    if year:
+        filters += "AND month LIKE ? "
+        params.append("{:04d}-%".format(int(year)))
+
+    qry = """
+        SELECT month, kind, count, amount_cents
+          FROM monthly_totals
+         WHERE """ + filters + """
+         ORDER BY month ASC, kind ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, params)
+
+    return [{
+        "month": month,
+        "kind": kind,
+        "count": count,
+        "amount": Decimal(cents).scaleb(-2),
+    } for month, kind, count, cents in cur.fetchall()]
+
+
 def get_accounts_calculated_at(conn):
     """Get the date of the last account calculation"""
     qry  = """
@@ -384,6 +838,376 @@ def set_accounts_calculated_at(conn, calculated_at):
     return get_accounts_calculated_at(conn)
 
 
+class ChangesCompactedError(LookupError):
+    """Changes after the cursor were removed, a full sync is needed"""
+
+
+def get_changes_compacted_until(conn):
+    """Get the id up to which changes may have been removed"""
+    qry = """
+        SELECT changes_compacted_until FROM state
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+    res = cur.fetchone()
+
+    return res[0]
+
+
+def get_changes(conn, after=0, limit=1000, table=None):
+    """
+    Get the change log entries after a cursor, oldest first.
+    The cursor is the id of the last entry seen.
+    """
+    after = encode_id(after)
+    if after < get_changes_compacted_until(conn):
+        raise ChangesCompactedError(
+            "changes after {} were compacted".format(after))
+
+    filters = "id > ? "
+    params = [after]
+    if table:
+        filters += "AND table_name = ? "
+        params.append(table)
+    params.append(limit)
+
+    qry = """
+        SELECT * FROM changes
+         WHERE """ + filters + """
+         ORDER BY id ASC
+         LIMIT ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, params)
+    res = cur.fetchall()
+
+    return [dict_row(row, cur) for row in res]
+
+
+def compact_changes(conn, before=None):
+    """
+    Remove change log entries superseded by a later entry for
+    the same row, consumers only need the latest. With before,
+    all entries older than that date are removed as well and
+    consumers behind them have to sync in full.
+    Returns the number of removed entries.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            DELETE FROM changes
+             WHERE id < (SELECT max(id) FROM changes AS later
+                          WHERE later.table_name = changes.table_name
+                            AND later.row_key = changes.row_key)
+        """)
+        removed = cur.rowcount
+        if before:
+            cur.execute("""
+                SELECT max(id) FROM changes WHERE changed_at < ?
+            """, (encode_date(before),))
+            until = cur.fetchone()[0]
+            if until:
+                cur.execute("DELETE FROM changes WHERE id <= ?", (until,))
+                removed += cur.rowcount
+                cur.execute("""
+                    UPDATE state
+                       SET changes_compacted_until =
+                           max(changes_compacted_until, ?)
+                """, (until,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    return removed
+
+
+def add_batch(conn, kind, description):
+    """Start a batch of transactions, returns the batch id"""
+    qry = """
+        INSERT INTO batches (
+            kind,
+            description,
+            created_at,
+            accounts_calculated_at
+        ) SELECT ?, ?, datetime(), accounts_calculated_at
+            FROM state
+        RETURNING id
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (kind, description))
+    res = cur.fetchone()
+    conn.commit()
+
+    return res[0]
+
+
+def get_batches(conn, batch_id=None):
+    """Get batches with their transaction count and total"""
+    filters = " 1 "
+    params = []
+    if batch_id:
+        filters += "AND batches.id = ? "
+        params.append(batch_id)
+
+    qry = """
+        SELECT batches.*,
+               count(transactions.id) AS transactions,
+               count(DISTINCT transactions.member_id) AS members,
+               coalesce(sum(transactions.amount), 0) AS total
+          FROM batches
+          LEFT JOIN transactions ON transactions.batch_id = batches.id
+         WHERE """ + filters + """
+         GROUP BY batches.id
+         ORDER BY batches.id ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, params)
+    res = cur.fetchall()
+
+    return [dict_row(row, cur) for row in res]
+
+
+def get_batch(conn, batch_id):
+    """Get a batch by id"""
+    batches = get_batches(conn, batch_id=batch_id)
+    if not batches:
+        return None
+
+    return batches[0]
+
+
+class UndoBatchError(ValueError):
+    """A batch can not be undone"""
+
+
+def get_later_calculations(conn, batch):
+    """
+    Get the ids of the calculation batches after a calculation
+    batch which were not undone.
+    """
+    if batch["kind"] != "calculation":
+        return []
+
+    qry = """
+        SELECT id FROM batches
+         WHERE kind = 'calculation'
+           AND id > ?
+           AND undone_at IS NULL
+         ORDER BY id ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (batch["id"],))
+
+    return [row[0] for row in cur.fetchall()]
+
+
+def undo_batch(conn, batch_id):
+    """
+    Reverse all transactions of a batch in one transaction:
+    subtract the amounts from the member accounts, restore
+    last_payment, reopen the SEPA collections the batch marked
+    as collected and log [UNDO] transactions in a new batch.
+    Returns the id of the undo batch.
+
+    Calculations are undone latest first, as the date of the
+    last calculation is reset to the one before the batch.
+    Raises UndoBatchError for missing or already undone batches.
+    """
+    cur = conn.cursor()
+    # Hold the write lock, a batch must only be undone once
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        batch = get_batch(conn, batch_id)
+        if not batch:
+            raise UndoBatchError("batch not found: {}".format(batch_id))
+        if batch["undone_at"]:
+            raise UndoBatchError("batch was already undone at {}".format(
+                batch["undone_at"]))
+        later = get_later_calculations(conn, batch)
+        if later:
+            raise UndoBatchError(
+                "undo the later calculation batches first: {}".format(
+                    ", ".join(map(str, later))))
+
+        cur.execute("""
+            INSERT INTO batches (
+                kind,
+                description,
+                created_at
+            ) VALUES ( 'undo', ?, datetime() )
+            RETURNING id
+        """, ("undo batch {}: {}".format(batch["id"], batch["description"]),))
+        undo_id = cur.fetchone()[0]
+
+        cur.execute("""
+            UPDATE members
+               SET account = round(account - (
+                       SELECT sum(amount) FROM transactions
+                        WHERE batch_id = ?
+                          AND member_id = members.id), 2)
+             WHERE id IN (SELECT member_id FROM transactions
+                           WHERE batch_id = ?)
+        """, (batch["id"], batch["id"]))
+
+        # Only if no later payment moved last_payment on
+        cur.execute("""
+            UPDATE members
+               SET last_payment = (
+                       SELECT last_payment FROM batch_members
+                        WHERE batch_id = ?
+                          AND member_id = members.id)
+             WHERE id IN (SELECT member_id FROM batch_members
+                           WHERE batch_id = ?)
+               AND last_payment <= (
+                       SELECT max(date) FROM transactions
+                        WHERE batch_id = ?
+                          AND member_id = members.id)
+        """, (batch["id"], batch["id"], batch["id"]))
+
+        cur.execute("""
+            INSERT INTO transactions (
+              member_id,
+              date,
+              account_name,
+              amount,
+              description,
+              batch_id,
+              kind
+            ) SELECT member_id,
+                     date(),
+                     account_name,
+                     -amount,
+                     '[UNDO] ' || description,
+                     ?,
+                     'undo'
+                FROM transactions
+               WHERE batch_id = ?
+               ORDER BY id ASC
+        """, (undo_id, batch["id"]))
+
+        # Collections booked by the batch are pending again
+        cur.execute("""
+            UPDATE sepa_collections
+               SET status = 'pending',
+                   collected_batch_id = NULL
+             WHERE collected_batch_id = ?
+        """, (batch["id"],))
+
+        if batch["kind"] == "calculation":
+            cur.execute("""
+                UPDATE state
+                   SET accounts_calculated_at = ?
+            """, (batch["accounts_calculated_at"],))
+
+        cur.execute("""
+            UPDATE batches
+               SET undone_at = datetime()
+             WHERE id = ?
+        """, (batch["id"],))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    return undo_id
+
+
+def get_import_run(conn, fingerprint):
+    """Get the latest import run of a file, unless it was undone"""
+    qry = """
+        SELECT import_runs.*
+          FROM import_runs
+          LEFT JOIN batches ON batches.id = import_runs.batch_id
+         WHERE fingerprint = ?
+           AND batches.undone_at IS NULL
+         ORDER BY import_runs.id DESC
+         LIMIT 1
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (fingerprint,))
+    res = cur.fetchone()
+
+    return dict_row(res, cur)
+
+
+def add_import_run(conn, fingerprint, filename, batch_id=None):
+    """Start a new import run"""
+    qry = """
+        INSERT INTO import_runs (
+            fingerprint,
+            filename,
+            batch_id,
+            started_at
+        ) VALUES ( ?, ?, ?, datetime() )
+        RETURNING id
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (fingerprint, filename, batch_id))
+    res = cur.fetchone()
+    conn.commit()
+
+    return get_import_run(conn, fingerprint)
+
+
+def checkpoint_import_run(session, run_id, offset, rows, finished=False):
+    """Record the position of the last imported row with the next flush"""
+    qry = """
+        UPDATE import_runs
+           SET row_offset = ?,
+               rows_imported = rows_imported + ?,
+               finished_at = CASE WHEN ? THEN datetime() END
+         WHERE id = ?
+    """
+    session.execute(qry, (offset, rows, finished, run_id))
+
+
+def get_import_unmatched(conn, run_id):
+    """Get the not imported rows of a run, in the order of the file"""
+    qry = """
+        SELECT row_offset, transaction_data
+          FROM import_unmatched
+         WHERE run_id = ?
+         ORDER BY row_offset ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (run_id,))
+
+    unmatched = []
+    for offset, data in cur.fetchall():
+        transaction = json.loads(data)
+        transaction["date"] = decode_date(transaction["date"])
+        transaction["amount"] = Decimal(transaction["amount"])
+        unmatched.append((offset, transaction))
+
+    return unmatched
+
+
+def add_import_unmatched(session, run_id, offset, transaction):
+    """Record a not imported row of a run with the next flush"""
+    qry = """
+        INSERT OR REPLACE INTO import_unmatched (
+            run_id,
+            row_offset,
+            transaction_data
+        ) VALUES ( ?, ?, ? )
+    """
+    data = json.dumps({
+        key: str(value) if isinstance(value, (date, Decimal)) else value
+        for key, value in transaction.items()
+    })
+    session.execute(qry, (run_id, offset, data))
+
+
+def remove_import_unmatched(session, run_id, offset):
+    """Forget a row of a run once it was imported, with the next flush"""
+    qry = """
+        DELETE FROM import_unmatched
+         WHERE run_id = ? AND row_offset = ?
+    """
+    session.execute(qry, (run_id, offset))
+
+
 def get_bank_import_rules(conn):
     """Get all bank import rules"""
     qry = """SELECT * FROM bank_import_rules"""
@@ -422,7 +1246,7 @@ def add_bank_import_rule(conn, rule):
     """
     params = (
         rule["iban_hash"],
-        rule["member_id"],
+        encode_id(rule["member_id"]),
         rule["handler"],
         encode_json(rule.get("params")),
     )
@@ -432,3 +1256,195 @@ def add_bank_import_rule(conn, rule):
     conn.commit()
 
     return get_bank_import_rule(conn, rule["iban_hash"])
+
+
+MEMBER_FIELD_ENCODERS = {
+    "name": str,
+    "email": str,
+    "notes": str,
+    "membership_start": encode_date,
+    "membership_end": encode_date,
+    "fee": encode_decimal,
+    "interval": int,
+}
+
+
+def encode_member_update(member, fields, account_delta):
+    """
+    Encode the changed fields of a member for an UPDATE. The account
+    is changed by a delta and last_payment only moves forward, so
+    concurrent changes by other processes are kept.
+    Returns the SET clause and its params.
+    """
+    assignments = []
+    params = []
+    for field in sorted(fields):
+        if field == "account":
+            assignments.append("account = round(account + ?, 2)")
+            params.append(encode_decimal(account_delta))
+        elif field == "last_payment":
+            assignments.append("last_payment = max(last_payment, ?)")
+            params.append(encode_date(member["last_payment"]))
+        else:
+            assignments.append("{} = ?".format(field))
+            params.append(MEMBER_FIELD_ENCODERS[field](member[field]))
+
+    return ", ".join(assignments), params
+
+
+class Session:
+    """
+    Unit of work with an identity map for members.
+
+    Each member is loaded at most once per session. Updates are
+    applied to the loaded member and only the changed fields are
+    written back with new transactions in a single commit by
+    `flush`. Accounts are written as the change since loading, so
+    concurrent changes by other processes are kept.
+
+    New transactions are tagged with the batch_id of the
+    session, if any, to allow undoing them together.
+    """
+
+    def __init__(self, conn, batch_id=None):
+        self.conn = conn
+        self.batch_id = batch_id
+        self.members = {}
+        self.accounts = {}
+        self.dirty = {}
+        self.transactions = []
+        self.statements = []
+        self.last_payments = {}
+
+    def _identity(self, member):
+        """Register a freshly decoded member or return the known one"""
+        if not member:
+            return None
+        known = self.members.get(member["id"])
+        if known:
+            return known
+        self.members[member["id"]] = member
+        self.accounts[member["id"]] = member["account"]
+        return member
+
+    def get_member(self, member_id):
+        """Get a member by id, loading it only once"""
+        try:
+            member = self.members.get(encode_id(member_id))
+        except ValueError:
+            return None
+        if member:
+            return member
+        return self._identity(get_member(self.conn, member_id))
+
+    def get_members(self):
+        """Get all members and register them"""
+        return [self._identity(m) for m in get_members(self.conn)]
+
+    def get_member_by_name(self, name):
+        """Get a member by name"""
+        return self._identity(get_member_by_name(self.conn, name))
+
+    def update_member(self, member_id, **fields):
+        """Update fields of a member in memory"""
+        member = self.get_member(member_id)
+        member.update(fields)
+        self.dirty.setdefault(member["id"], set()).update(fields)
+        return member
+
+    def set_account(self, member_id, value):
+        """Set account value for member"""
+        return self.update_member(member_id, account=Decimal(value))
+
+    def add_payment(self, transaction):
+        """Add payment to member"""
+        member = self.get_member(transaction["member_id"])
+        payment_date = transaction["date"]
+        if payment_date < member["last_payment"]:
+            print("WARNING: last_payment for member is more recent.")
+            payment_date = member["last_payment"]
+
+        # Remember last_payment before the batch changed it
+        if self.batch_id and member["id"] not in self.last_payments:
+            self.last_payments[member["id"]] = member["last_payment"]
+
+        return self.update_member(
+            member["id"],
+            account=member["account"] + Decimal(transaction["amount"]),
+            last_payment=payment_date)
+
+    def add_transaction(self, transaction):
+        """Queue a transaction for the next flush"""
+        self.transactions.append(dict(transaction))
+
+    def execute(self, qry, params=()):
+        """Queue a statement for the next flush"""
+        self.statements.append((qry, params))
+
+    def set_accounts_calculated_at(self, calculated_at):
+        """Set the date of the account calculation on flush"""
+        self.execute("""
+            UPDATE state
+               SET accounts_calculated_at = ?
+        """, (encode_date(calculated_at),))
+
+    def flush(self):
+        """Write all changes in one transaction"""
+        today = date.today()
+        members = [encode_member_update(
+            self.members[member_id],
+            fields,
+            self.members[member_id]["account"] - self.accounts[member_id],
+        ) + (member_id,) for member_id, fields in self.dirty.items()]
+        transactions = [(
+            encode_id(tx["member_id"]),
+            encode_date(tx.get("date", today)),
+            tx.get("account_name", ""),
+            encode_decimal(tx.get("amount", "0.00")),
+            tx.get("description", ""),
+            self.batch_id,
+            tx.get("kind", "payment"),
+        ) for tx in self.transactions]
+        last_payments = [
+            (self.batch_id, member_id, encode_date(last_payment))
+            for member_id, last_payment in self.last_payments.items()]
+
+        cur = self.conn.cursor()
+        try:
+            for assignments, params, member_id in members:
+                cur.execute("""
+                    UPDATE members
+                       SET """ + assignments + """
+                     WHERE id = ?
+                """, (*params, member_id))
+            cur.executemany("""
+                INSERT INTO transactions (
+                  member_id,
+                  date,
+                  account_name,
+                  amount,
+                  description,
+                  batch_id,
+                  kind
+                ) VALUES ( ?, ?, ?, ?, ?, ?, ? )
+            """, transactions)
+            cur.executemany("""
+                INSERT OR IGNORE INTO batch_members (
+                  batch_id,
+                  member_id,
+                  last_payment
+                ) VALUES ( ?, ?, ? )
+            """, last_payments)
+            for qry, params in self.statements:
+                cur.execute(qry, params)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+        for member_id in self.dirty:
+            self.accounts[member_id] = self.members[member_id]["account"]
+        self.dirty.clear()
+        self.transactions = []
+        self.statements = []
+        self.last_payments = {}
@@ -0,0 +1,230 @@
+"""
+Payment reminders for members in arrears.
+
+A member is in arrears when the account is below one full payment
+period (fee * interval). Each further period raises the dunning
+level up to MAX_LEVEL. Letters are written to a local maildir or
+mbox, a letter is only written when a member reaches a new level.
+"""
+
+import mailbox
+from datetime import date
+from email.header import Header
+from email.utils import formatdate, make_msgid
+from functools import lru_cache
+from string import Formatter
+
+from eris import db
+
+MAX_LEVEL = 3
+
+SENDER = "vorstand@berlin.ccc.de"
+MESSAGE_ID_DOMAIN = "berlin.ccc.de"
+
+# Keep in sync with the members_arrears_idx index expression
+ARREARS = "(-account / (fee * interval * 1.0))"
+
+DEFAULT_TEMPLATE = """\
+Subject: Zahlungserinnerung ({level}. Mahnung)
+
+Hallo {name},
+
+laut unserer Buchhaltung ist dein Mitgliedskonto mit {amount_due} EUR
+im Rückstand. Dein Beitrag beträgt {fee} EUR alle {interval} Monat(e).
+
+Bitte überweise den offenen Betrag oder melde dich beim Vorstand,
+falls du Fragen hast oder eine Vereinbarung treffen möchtest.
+
+Deine Mitgliedsnummer: {id}
+
+Viele Grüße
+Der Vorstand
+"""
+
+
+class LetterTemplate:
+    """A letter template parsed once and rendered per member"""
+
+    def __init__(self, text):
+        header, _, body = text.partition("\n\n")
+        if not header.startswith("Subject:"):
+            raise ValueError("template must start with a Subject: line")
+        self.subject = self.compile(header[len("Subject:"):].strip())
+        self.body = self.compile(body)
+
+    @staticmethod
+    def compile(text):
+        """Split a format string into literals and field names"""
+        parts = []
+        for literal, field, spec, _conversion in Formatter().parse(text):
+            parts.append((literal, field, spec))
+        return parts
+
+    @staticmethod
+    def render_parts(parts, values):
+        """Render compiled parts"""
+        out = []
+        for literal, field, spec in parts:
+            out.append(literal)
+            if field is not None:
+                out.append(format(values[field], spec or ""))
+        return "".join(out)
+
+    def render(self, values):
+        """Get subject and body for a member"""
+        return (self.render_parts(self.subject, values),
+                self.render_parts(self.body, values))
+
+
+def get_members_in_arrears(conn, today=None):
+    """Get active members at least one payment period behind"""
+    if not today:
+        today = date.today()
+
+    qry = """
+        SELECT members.*,
+               """ + ARREARS + """ AS periods,
+               coalesce(dunning.level, 0) AS dunning_level
+          FROM members
+          LEFT JOIN dunning ON dunning.member_id = members.id
+         WHERE """ + ARREARS + """ >= 1
+           AND (membership_end IS NULL OR membership_end > ?)
+         ORDER BY members.id ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (db.encode_date(today),))
+    for row in cur:
+        member = db.decode_member(db.dict_row(row, cur))
+        member["level"] = min(int(member.pop("periods")), MAX_LEVEL)
+        yield member
+
+
+def open_mailbox(path):
+    """Open an mbox for *.mbox paths, a maildir otherwise"""
+    if path.endswith(".mbox"):
+        return mailbox.mbox(path)
+    return mailbox.Maildir(path, create=True)
+
+
+@lru_cache(maxsize=64)
+def encode_header(value):
+    """Encode a header value, RFC 2047 for non ASCII text"""
+    if value.isascii():
+        return value
+    return Header(value, "utf-8").encode()
+
+
+def make_letter(template, member, headers):
+    """
+    Create the reminder mail for a member as bytes. The message
+    is assembled directly, the email package is far too slow
+    for thousands of plain text letters.
+    """
+    values = dict(member)
+    values["amount_due"] = -member["account"]
+    subject, body = template.render(values)
+
+    msg = headers + (
+        "To: {}\n"
+        "Subject: {}\n"
+        "Message-ID: {}\n"
+        "\n"
+    ).format(
+        encode_header(member["email"]),
+        encode_header(subject),
+        make_msgid(domain=MESSAGE_ID_DOMAIN))
+
+    return msg.encode("ascii") + body.encode("utf-8")
+
+
+def write_letters(conn, path, template=None, today=None):
+    """
+    Write letters for members who reached a new dunning level
+    and record the levels. Returns the number of letters per level.
+    """
+    if not today:
+        today = date.today()
+    template = LetterTemplate(template or DEFAULT_TEMPLATE)
+
+    headers = (
+        "From: {}\n"
+        "Date: {}\n"
+        "MIME-Version: 1.0\n"
+        "Content-Type: text/plain; charset=utf-8\n"
+        "Content-Transfer-Encoding: 8bit\n"
+    ).format(SENDER, formatdate(localtime=True))
+
+    box = open_mailbox(path)
+    box.lock()
+    levels = []
+    lowered = []
+    counts = {}
+    try:
+        for member in get_members_in_arrears(conn, today):
+            if member["level"] < member["dunning_level"]:
+                # Paid in part, a new level warrants a new letter
+                lowered.append((member["level"], member["id"]))
+            if member["level"] <= member["dunning_level"]:
+                continue
+            box.add(make_letter(template, member, headers))
+            levels.append((
+                member["id"],
+                member["level"],
+                db.encode_date(today),
+                db.encode_decimal(member["account"]),
+            ))
+            counts[member["level"]] = counts.get(member["level"], 0) + 1
+        box.flush()
+    finally:
+        box.unlock()
+        box.close()
+
+    record_levels(conn, levels, lowered, today)
+
+    return counts
+
+
+def record_levels(conn, levels, lowered, today):
+    """Store reached levels and reset members no longer in arrears"""
+    cur = conn.cursor()
+    try:
+        cur.executemany("""
+            UPDATE dunning SET level = ? WHERE member_id = ?
+        """, lowered)
+        cur.executemany("""
+            INSERT INTO dunning (
+                member_id,
+                level,
+                notified_at,
+                notified_account
+            ) VALUES ( ?, ?, ?, ? )
+            ON CONFLICT (member_id) DO UPDATE
+               SET level = excluded.level,
+                   notified_at = excluded.notified_at,
+                   notified_account = excluded.notified_account
+        """, levels)
+        cur.execute("""
+            DELETE FROM dunning
+             WHERE member_id NOT IN (
+                SELECT id FROM members
+                 WHERE """ + ARREARS + """ >= 1
+                   AND (membership_end IS NULL OR membership_end > ?))
+        """, (db.encode_date(today),))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def get_dunning_summary(conn):
+    """Get the number of members per recorded dunning level"""
+    qry = """
+        SELECT level, count(*)
+          FROM dunning
+         GROUP BY level
+         ORDER BY level ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+
+    return dict(cur.fetchall())
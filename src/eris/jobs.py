@@ -0,0 +1,336 @@
+"""
+Writer job queue.
+
+Writing commands can be queued in the jobs table instead of
+running them directly. A single writer process runs the jobs
+one after another, so concurrent eris invocations no longer
+compete for the database lock. Readers are not affected.
+"""
+
+import contextlib
+import fcntl
+import io
+import json
+import sqlite3
+import time
+import traceback
+
+from eris import accounting, banking, db
+from eris.logging import log
+
+POLL_INTERVAL = 0.5
+OUTPUT_INTERVAL = 0.5
+
+# Milliseconds to wait for direct writers to release the database
+BUSY_TIMEOUT = 5000
+
+# Seconds to wait for a job while no writer is running
+NO_WRITER_TIMEOUT = 30
+
+
+def decode_job(job):
+    """Decode a job row"""
+    if not job:
+        return None
+    job["params"] = json.loads(job["params"])
+    return job
+
+
+def submit_job(conn, kind, params):
+    """Queue a job, returns the job id"""
+    if kind not in JOB_HANDLERS:
+        raise ValueError("unknown job: {}".format(kind))
+
+    qry = """
+        INSERT INTO jobs (
+            kind,
+            params,
+            created_at
+        ) VALUES ( ?, ?, datetime() )
+        RETURNING id
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (kind, json.dumps(params)))
+    res = cur.fetchone()
+    conn.commit()
+
+    return res[0]
+
+
+def get_job(conn, job_id):
+    """Get a job by id"""
+    qry = """
+        SELECT * FROM jobs WHERE id = ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (job_id,))
+    res = cur.fetchone()
+
+    return decode_job(db.dict_row(res, cur))
+
+
+def get_jobs(conn, limit=20):
+    """Get the latest jobs"""
+    qry = """
+        SELECT * FROM jobs
+         ORDER BY id DESC
+         LIMIT ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (limit,))
+    res = cur.fetchall()
+
+    return [decode_job(db.dict_row(row, cur)) for row in res]
+
+
+def claim_next_job(conn):
+    """Mark the oldest queued job as running and return it"""
+    qry = """
+        UPDATE jobs
+           SET status = 'running',
+               started_at = datetime()
+         WHERE id = (SELECT id FROM jobs
+                      WHERE status = 'queued'
+                      ORDER BY id ASC
+                      LIMIT 1)
+        RETURNING *
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+    res = cur.fetchone()
+    job = decode_job(db.dict_row(res, cur))
+    conn.commit()
+
+    return job
+
+
+def finish_job(conn, job_id, status, error=None):
+    """Set the final status of a job"""
+    qry = """
+        UPDATE jobs
+           SET status = ?,
+               error = ?,
+               finished_at = datetime()
+         WHERE id = ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (status, error, job_id))
+    conn.commit()
+
+
+def fail_running_jobs(conn):
+    """Fail jobs left running by a writer that stopped"""
+    qry = """
+        UPDATE jobs
+           SET status = 'failed',
+               error = 'writer stopped while running the job',
+               finished_at = datetime()
+         WHERE status = 'running'
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+    conn.commit()
+
+
+class JobOutput(io.TextIOBase):
+    """Collect the output of a job and append it to the job row"""
+
+    def __init__(self, conn, job_id):
+        self.conn = conn
+        self.job_id = job_id
+        self.buffer = []
+        self.written_at = time.monotonic()
+
+    def write(self, text):
+        self.buffer.append(text)
+        if time.monotonic() - self.written_at > OUTPUT_INTERVAL:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        """
+        Append the buffered output, keep it for the next flush
+        while the database is locked, the job must not fail for it.
+        """
+        try:
+            self.write_output()
+        except sqlite3.OperationalError as e:
+            self.conn.rollback()
+            log("job output not written, retrying later: {}", e)
+            self.written_at = time.monotonic()
+
+    def write_output(self):
+        """Append the buffered output to the job row"""
+        if not self.buffer:
+            return
+        qry = """
+            UPDATE jobs
+               SET output = output || ?
+             WHERE id = ?
+        """
+        self.conn.execute(qry, ("".join(self.buffer), self.job_id))
+        self.conn.commit()
+        self.buffer = []
+        self.written_at = time.monotonic()
+
+
+def run_import(conn, params):
+    """Import a bank CSV"""
+    not_imported = banking.import_transactions(
+        conn,
+        params["filename"],
+        encoding=params.get("encoding"),
+        force=params.get("force", False),
+        auto_assign=params.get("auto_assign"))
+
+    for transaction in not_imported:
+        print("not imported: {} {} EUR\tIBAN hash: {}".format(
+            transaction["account_name"],
+            transaction["amount"],
+            transaction["iban_hash"]))
+
+
+def run_calculate(conn, _params):
+    """Run the member account calculations"""
+    accounting.run_account_calculations(conn)
+
+
+def run_adjust(conn, params):
+    """Set a member account value"""
+    accounting.adjust_member_account(
+        conn,
+        params["member_id"],
+        params["amount"],
+        params.get("comment", ""),
+        interactive=False)
+
+
+JOB_HANDLERS = {
+    "import": run_import,
+    "calculate": run_calculate,
+    "adjust": run_adjust,
+}
+
+
+def retry_busy(conn, func, *args):
+    """
+    Run a bookkeeping write until the database is not busy,
+    direct writers may hold the lock longer than the busy timeout.
+    """
+    while True:
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            log("database busy, retrying: {}", e)
+            time.sleep(POLL_INTERVAL)
+
+
+def run_job(conn, output_conn, job):
+    """Run a single job and record the outcome"""
+    output = JobOutput(output_conn, job["id"])
+    try:
+        with contextlib.redirect_stdout(output):
+            JOB_HANDLERS[job["kind"]](conn, job["params"])
+    except Exception: # pylint: disable=broad-except
+        error = traceback.format_exc()
+        retry_busy(output_conn, output.write_output)
+        retry_busy(output_conn, finish_job,
+                   output_conn, job["id"], "failed", error)
+        return False
+
+    retry_busy(output_conn, output.write_output)
+    retry_busy(output_conn, finish_job, output_conn, job["id"], "done")
+    return True
+
+
+def lock_filename(filename):
+    """Get the lock file held by the writer of a database"""
+    return filename + ".writer.lock"
+
+
+def writer_running(filename):
+    """Check if a writer holds the lock of a database"""
+    with open(lock_filename(filename), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return False
+
+
+def connect_writer(filename):
+    """Open a connection waiting for direct writers"""
+    conn = db.connect(filename)
+    conn.execute("PRAGMA busy_timeout = {}".format(BUSY_TIMEOUT))
+    return conn
+
+
+def run_writer(filename, once=False):
+    """
+    Run queued jobs until interrupted. Only one writer
+    may run per database.
+    """
+    with open(lock_filename(filename), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log("another writer is running for {}", filename)
+            return
+
+        conn = connect_writer(filename)
+        retry_busy(conn, conn.execute, "PRAGMA journal_mode = WAL")
+        output_conn = connect_writer(filename)
+        retry_busy(conn, fail_running_jobs, conn)
+        log("writer started for {}", filename)
+
+        while True:
+            try:
+                job = claim_next_job(conn)
+            except sqlite3.OperationalError as e:
+                # Direct writers still hold the lock, next poll
+                conn.rollback()
+                log("database busy, retrying: {}", e)
+                time.sleep(POLL_INTERVAL)
+                continue
+            if not job:
+                if once:
+                    return
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            log("running job {}: {}", job["id"], job["kind"])
+            ok = run_job(conn, output_conn, job)
+            log("job {} {}", job["id"], "done" if ok else "failed")
+
+
+def wait_for_job(conn, job_id, out=None, timeout=NO_WRITER_TIMEOUT):
+    """
+    Follow the output of a job until it is finished. Gives up
+    and returns the queued job when no writer was running for
+    timeout seconds.
+    """
+    filename = db.get_filename(conn)
+    seen = 0
+    waiting_since = None
+    while True:
+        job = get_job(conn, job_id)
+        if out and len(job["output"]) > seen:
+            out.write(job["output"][seen:])
+            out.flush()
+            seen = len(job["output"])
+        if job["status"] in ("done", "failed"):
+            return job
+
+        if job["status"] == "queued" and not writer_running(filename):
+            if waiting_since is None:
+                waiting_since = time.monotonic()
+                log("no writer is running for {}, start one with "
+                    "eris run-writer", filename)
+            elif timeout is not None and \
+                    time.monotonic() - waiting_since > timeout:
+                return job
+        else:
+            waiting_since = None
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,210 @@
+"""
+Database maintenance: integrity check, planner statistics and
+incremental vacuum, with a report of the database pages, the
+indexes and the effect on a few typical queries.
+"""
+
+import sqlite3
+import time
+from datetime import date, timedelta
+
+from eris.dunning import ARREARS
+
+# Pages freed per run by the incremental vacuum
+DEFAULT_VACUUM_PAGES = 2000
+
+# Rows sampled per index by ANALYZE, 0 analyzes everything
+ANALYSIS_LIMIT = 1000
+
+# Errors reported by the integrity check before it stops
+INTEGRITY_MAX_ERRORS = 20
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def probe_queries():
+    """Typical queries, timed before and after the maintenance"""
+    month = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+    return {
+        "transactions of last month": (
+            "SELECT * FROM transactions WHERE date >= ? ORDER BY date, id",
+            (month.strftime("%Y-%m-%d"),)),
+        "transactions of a member": (
+            "SELECT * FROM transactions WHERE member_id = ?",
+            ("1",)),
+        "members in arrears": (
+            "SELECT * FROM members WHERE " + ARREARS + " >= 1",
+            ()),
+        "member by name": (
+            "SELECT * FROM members WHERE name LIKE ?",
+            ("%a%",)),
+    }
+
+
+def pragma(conn, name):
+    """Get the value of a pragma"""
+    return conn.execute("PRAGMA " + name).fetchone()[0]
+
+
+def get_page_stats(conn):
+    """Get page size, page count and freelist size"""
+    return {
+        "page_size": pragma(conn, "page_size"),
+        "page_count": pragma(conn, "page_count"),
+        "freelist_count": pragma(conn, "freelist_count"),
+        "auto_vacuum": AUTO_VACUUM_MODES[pragma(conn, "auto_vacuum")],
+    }
+
+
+def get_index_stats(conn):
+    """
+    Get the tables and indexes with their size in pages and
+    the ANALYZE statistics: rows and rows per distinct key.
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT name, tbl_name, type
+          FROM sqlite_schema
+         WHERE type IN ('table', 'index')
+           AND name NOT LIKE 'sqlite_%'
+         ORDER BY tbl_name, type DESC, name
+    """)
+    stats = [{"name": name, "table": table, "type": kind,
+              "pages": None, "stat": None}
+             for name, table, kind in cur.fetchall()]
+
+    try:
+        cur.execute("""
+            SELECT name, count(*) FROM dbstat GROUP BY name
+        """)
+        pages = dict(cur.fetchall())
+    except sqlite3.OperationalError:
+        pages = {} # SQLite without the dbstat table
+    try:
+        cur.execute("SELECT tbl, idx, stat FROM sqlite_stat1")
+        analyzed = cur.fetchall()
+    except sqlite3.OperationalError:
+        analyzed = [] # Never analyzed
+
+    # Tables are analyzed through their indexes, the first
+    # number of an index statistic is the number of rows.
+    table_rows = {}
+    index_stats = {}
+    for table, index, stat in analyzed:
+        table_rows[table] = stat.split()[0]
+        if index:
+            index_stats[index] = stat
+
+    for entry in stats:
+        entry["pages"] = pages.get(entry["name"])
+        if entry["type"] == "table":
+            rows = table_rows.get(entry["name"])
+            entry["stat"] = rows and "{} rows".format(rows)
+        else:
+            entry["stat"] = index_stats.get(entry["name"])
+
+    return stats
+
+
+def time_probes(conn):
+    """Run the probe queries, get the plan and time of each"""
+    results = {}
+    for name, (qry, params) in probe_queries().items():
+        plan = conn.execute("EXPLAIN QUERY PLAN " + qry, params).fetchall()
+        start = time.perf_counter()
+        conn.execute(qry, params).fetchall()
+        results[name] = {
+            "plan": "; ".join(row[-1] for row in plan),
+            "seconds": time.perf_counter() - start,
+        }
+
+    return results
+
+
+def timed(steps, name, func, *args):
+    """Run a maintenance step and record its duration"""
+    start = time.perf_counter()
+    result = func(*args)
+    steps.append({
+        "step": name,
+        "seconds": time.perf_counter() - start,
+        "result": result,
+    })
+    return result
+
+
+def check_integrity(conn):
+    """Run the integrity check, returns the problems found"""
+    rows = conn.execute(
+        "PRAGMA integrity_check({})".format(INTEGRITY_MAX_ERRORS)).fetchall()
+    problems = [row[0] for row in rows if row[0] != "ok"]
+    return problems or "ok"
+
+
+def analyze(conn):
+    """Update the query planner statistics"""
+    conn.execute("PRAGMA analysis_limit = {}".format(ANALYSIS_LIMIT))
+    conn.execute("ANALYZE")
+    conn.commit()
+    return "ok"
+
+
+def optimize(conn):
+    """Let SQLite run the optimizations it considers useful"""
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+    return "ok"
+
+
+def incremental_vacuum(conn, pages):
+    """Free up to the given number of pages, returns the freed pages"""
+    before = pragma(conn, "freelist_count")
+    conn.execute("PRAGMA incremental_vacuum({})".format(int(pages)))
+    conn.commit()
+    return "{} pages freed".format(before - pragma(conn, "freelist_count"))
+
+
+def enable_incremental_vacuum(conn):
+    """
+    Switch the database to incremental auto vacuum. This
+    rebuilds the whole file once with VACUUM.
+    """
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return "rebuilt with auto_vacuum = incremental"
+
+
+def maintain(conn, vacuum_pages=DEFAULT_VACUUM_PAGES, rebuild=False):
+    """
+    Run the maintenance steps and collect the statistics.
+    A full VACUUM only runs with rebuild, once, to enable
+    the incremental vacuum on databases created without it.
+    """
+    report = {
+        "pages_before": get_page_stats(conn),
+        "probes_before": time_probes(conn),
+        "steps": [],
+    }
+    steps = report["steps"]
+
+    problems = timed(steps, "integrity_check", check_integrity, conn)
+    if problems != "ok":
+        # Do not rewrite a damaged database
+        report["pages_after"] = report["pages_before"]
+        return report
+
+    timed(steps, "analyze", analyze, conn)
+    timed(steps, "optimize", optimize, conn)
+
+    mode = report["pages_before"]["auto_vacuum"]
+    if mode == "incremental":
+        timed(steps, "incremental_vacuum",
+              incremental_vacuum, conn, vacuum_pages)
+    elif rebuild:
+        timed(steps, "vacuum", enable_incremental_vacuum, conn)
+
+    report["pages_after"] = get_page_stats(conn)
+    report["indexes"] = get_index_stats(conn)
+    report["probes_after"] = time_probes(conn)
+
+    return report
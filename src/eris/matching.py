@@ -0,0 +1,84 @@
+"""
+Fuzzy matching of bank account names to members
+with a trigram index.
+"""
+
+import heapq
+import re
+
+from eris.readers import normalize_name
+
+# Number of posting entries counted per search. The rarest
+# trigrams are counted first, common ones only if the budget
+# allows, so a search never touches all members.
+MAX_POSTINGS = 20000
+
+# Candidates scored exactly per requested result
+CANDIDATES_FACTOR = 10
+
+
+def trigrams(name):
+    """Get the set of trigrams of a name"""
+    name = re.sub(r"[\W_]+", " ", normalize_name(name)).strip()
+    if not name:
+        return frozenset()
+    padded = "  " + name + " "
+    return frozenset(padded[i:i+3] for i in range(len(padded) - 2))
+
+
+class NameIndex:
+    """Trigram index over member names"""
+
+    def __init__(self, members):
+        self.members = {}
+        self.grams = {}
+        self.postings = {}
+        for member in members:
+            grams = trigrams(member["name"])
+            self.members[member["id"]] = member
+            self.grams[member["id"]] = grams
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(member["id"])
+        self.cache = {}
+
+    def candidates(self, grams, limit):
+        """Get the members sharing the most of the rarest trigrams"""
+        postings = sorted(
+            (self.postings[g] for g in grams if g in self.postings), key=len)
+        selective = []
+        budget = MAX_POSTINGS
+        for posting in postings:
+            if selective and len(posting) > budget:
+                break
+            selective.append(posting)
+            budget -= len(posting)
+
+        counts = {}
+        for posting in selective:
+            for member_id in posting:
+                counts[member_id] = counts.get(member_id, 0) + 1
+
+        return heapq.nlargest(limit, counts, key=counts.get)
+
+    def search(self, name, limit=3):
+        """
+        Get the most similar members for a name as
+        (score, member) tuples, best first.
+        """
+        grams = trigrams(name)
+        key = (grams, limit)
+        if key in self.cache:
+            return self.cache[key]
+
+        scored = []
+        for member_id in self.candidates(grams, limit * CANDIDATES_FACTOR):
+            other = self.grams[member_id]
+            score = 2 * len(grams & other) / (len(grams) + len(other))
+            scored.append((score, member_id))
+
+        best = heapq.nlargest(limit, scored)
+        result = [(round(score, 3), self.members[member_id])
+                  for score, member_id in best]
+        self.cache[key] = result
+
+        return result
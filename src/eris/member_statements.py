@@ -0,0 +1,220 @@
+"""
+Account statements for members.
+
+The transactions of a period and the closing balances are read in
+scans ordered by member and rendered as text or PDF files, one per
+member, in a pool of worker processes.
+"""
+
+import os
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+)
+from decimal import Decimal
+
+from eris import db
+
+FORMATS = ("text", "pdf")
+
+# Members rendered per task, and tasks in flight per worker
+CHUNK_SIZE = 50
+TASKS_PER_WORKER = 2
+
+# PDF page layout: A4 in points, Courier 10pt
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 56
+FONT_SIZE = 10
+LINE_HEIGHT = 12
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * MARGIN) // LINE_HEIGHT
+
+
+def render_text(member, transactions, balance, since, until):
+    """Render the statement of a member as lines of text"""
+    lines = [
+        "Kontoauszug Mitgliedskonto",
+        "",
+        "Mitglied:     {} ({})".format(member["name"], member["id"]),
+        "Zeitraum:     {} bis {}".format(since, until),
+        "Beitrag:      {} EUR alle {} Monat(e)".format(
+            member["fee"], member["interval"]),
+        "",
+        "{:<10}  {:>10}  {}".format("Datum", "Betrag", "Verwendungszweck"),
+        "-" * 72,
+    ]
+    total = Decimal(0)
+    for tx in transactions:
+        total += tx["amount"]
+        lines.append("{:<10}  {:>10.2f}  {}".format(
+            str(tx["date"]), tx["amount"], tx["description"][:48]))
+    if not transactions:
+        lines.append("Keine Buchungen im Zeitraum.")
+    lines += [
+        "-" * 72,
+        "{:<10}  {:>10.2f}".format("Summe", total),
+        "",
+        "Kontostand am {}: {:.2f} EUR".format(until, balance),
+    ]
+    return lines
+
+
+def pdf_string(text):
+    """Encode text as a PDF string literal"""
+    text = text.encode("cp1252", "replace")
+    text = text.replace(b"\\", b"\\\\")
+    return b"(" + text.replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def render_pdf(lines):
+    """Render lines of text as a PDF document in Courier"""
+    pages = [lines[i:i + LINES_PER_PAGE]
+             for i in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+
+    # 1: catalog, 2: pages, 3: font, then content and page per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier"
+        b" /Encoding /WinAnsiEncoding >>",
+    ]
+    kids = []
+    for page in pages:
+        stream = b"BT /F1 %d Tf %d TL %d %d Td\n" % (
+            FONT_SIZE, LINE_HEIGHT, MARGIN, PAGE_HEIGHT - MARGIN)
+        stream += b"".join(pdf_string(line) + b" '\n" for line in page)
+        stream += b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (
+            len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d]"
+            b" /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (
+                PAGE_WIDTH, PAGE_HEIGHT, len(objects)))
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(kids), len(kids))
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, xref)
+
+    return out
+
+
+def statement_filename(path, member, fmt):
+    """Get the file of a member statement"""
+    ext = "pdf" if fmt == "pdf" else "txt"
+    return os.path.join(path, "{:05d}.{}".format(member["id"], ext))
+
+
+def write_statements_chunk(path, fmt, since, until, chunk):
+    """Render and write the statements of a chunk of members"""
+    for member, transactions, balance in chunk:
+        lines = render_text(member, transactions, balance, since, until)
+        filename = statement_filename(path, member, fmt)
+        if fmt == "pdf":
+            with open(filename, "wb") as file:
+                file.write(render_pdf(lines))
+        else:
+            with open(filename, "w", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n")
+
+    return len(chunk)
+
+
+def iter_closing_balances(conn, until, member_id=None):
+    """Iterate (member_id, balance) at the end of the period by id"""
+    if member_id is None:
+        balances = db.get_balances(conn, until)
+    else:
+        balances = db.get_balances(conn, until, after=member_id - 1, limit=1)
+    for balance in balances:
+        yield balance["id"], balance["balance"]
+
+
+def iter_member_transactions(conn, since, until, member_id=None):
+    """
+    Merge the members active in the period with their transactions
+    and closing balances from ordered scans.
+    """
+    if member_id is None:
+        members = db.iter_members(conn)
+    else:
+        members = [m for m in [db.get_member(conn, member_id)] if m]
+    members = sorted(
+        (m for m in members
+         if m["membership_start"] <= until
+         and (not m["membership_end"] or m["membership_end"] >= since)),
+        key=lambda m: m["id"])
+    members = iter(members)
+    balances = iter_closing_balances(conn, until, member_id)
+
+    def with_balance(member, transactions):
+        # Both scans are ordered by id and list every member joined
+        # before the end of the period
+        for balance_member_id, balance in balances:
+            if balance_member_id == member["id"]:
+                return member, transactions, balance
+        return member, transactions, Decimal(0)
+
+    member = next(members, None)
+    for tx_member_id, transactions in db.iter_transactions_by_member(
+            conn, since=since, until=until, member_id=member_id):
+        while member and member["id"] < tx_member_id:
+            yield with_balance(member, [])
+            member = next(members, None)
+        if member and member["id"] == tx_member_id:
+            yield with_balance(member, transactions)
+            member = next(members, None)
+
+    while member:
+        yield with_balance(member, [])
+        member = next(members, None)
+
+
+def write_statements(conn, path, since, until, fmt="text",
+                     member_id=None, workers=None):
+    """
+    Write the statements of all members active in the period
+    to a directory. Returns the number of statements written.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown format: {}".format(fmt))
+
+    os.makedirs(path, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+
+    written = 0
+    pending = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def submit(chunk):
+            nonlocal written, pending
+            # Bound the work in flight, the scan is faster than rendering
+            while len(pending) >= workers * TASKS_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                written += sum(f.result() for f in done)
+            pending.add(pool.submit(
+                write_statements_chunk,
+                path, fmt, since, until, chunk))
+
+        chunk = []
+        for member, transactions, balance in iter_member_transactions(
+                conn, since, until, member_id):
+            chunk.append((member, transactions, balance))
+            if len(chunk) == CHUNK_SIZE:
+                submit(chunk)
+                chunk = []
+        if chunk:
+            submit(chunk)
+
+        written += sum(f.result() for f in wait(pending)[0])
+
+    return written
@@ -2,6 +2,7 @@
 Import data files, like a legacy members export
 """
 
+import unicodedata
 from csv import reader as csv_reader
 from csv import DictReader
 
@@ -11,3 +12,48 @@ def read_members_csv(file):
     return list(reader)
 
 
+
+MEMBER_UPDATE_COLUMNS = ("id", "field", "value")
+
+
+def read_member_updates_csv(file):
+    """
+    Read CSV of member changes: id, field, value. Values missing
+    in short rows are None.
+    """
+    reader = DictReader(file)
+    missing = [c for c in MEMBER_UPDATE_COLUMNS
+               if c not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError("missing columns: {}".format(", ".join(missing)))
+
+    return [tuple(row[c] for c in MEMBER_UPDATE_COLUMNS) for row in reader]
+
+
+def normalize_name(name):
+    """Normalize a name for matching: case, unicode form and whitespace"""
+    name = unicodedata.normalize("NFKC", name or "")
+    return " ".join(name.casefold().split())
+
+
+def index_rows(rows, key="name"):
+    """Build a lookup of rows by their normalized key. Later rows win."""
+    return {normalize_name(row[key]): row for row in rows}
+
+
+def join_members(members, rows, key="name"):
+    """
+    Join members with legacy rows on the normalized name.
+    Returns the matched (member, row) pairs and the unmatched members.
+    """
+    index = index_rows(rows, key=key)
+    matched = []
+    unmatched = []
+    for member in members:
+        row = index.get(normalize_name(member["name"]))
+        if row is None:
+            unmatched.append(member)
+        else:
+            matched.append((member, row))
+
+    return matched, unmatched
@@ -0,0 +1,506 @@
+"""
+SEPA direct debit collection: pain.008.001.02 export.
+
+Members with a mandate who are at least one payment period behind
+are collected for their outstanding balance. The XML is written as
+a stream while the members are read, so memory use does not depend
+on the number of members. Each debit is recorded as a pending
+collection until the payment shows up in a bank import.
+"""
+
+import os
+import re
+import unicodedata
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from xml.sax.saxutils import XMLGenerator
+
+from eris import db
+from eris.dunning import ARREARS
+
+NAMESPACE = "urn:iso:std:iso:20022:tech:xsd:pain.008.001.02"
+
+SEQUENCE_TYPES = ("FRST", "RCUR")
+
+# Days between the export and the requested collection date
+COLLECTION_DELAY = 5
+
+# Days after the collection date in which an imported payment is
+# matched to a pending collection. Collections still pending after
+# that expire and the member is debited again if still in arrears.
+COLLECTION_WINDOW = 30
+
+# Characters of the SEPA latin character set
+SEPA_CHARS = re.compile(r"[^A-Za-z0-9/\-?:().,'+ ]")
+TRANSLITERATION = str.maketrans({
+    "ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss",
+    "Ä": "Ae", "Ö": "Oe", "Ü": "Ue",
+})
+
+INSERT_BATCH_SIZE = 500
+
+
+class MandateError(ValueError):
+    """Invalid mandate or creditor data"""
+
+
+class ValidationError(ValueError):
+    """The exported message does not match the XSD"""
+
+
+def sepa_text(value, length):
+    """Reduce text to the SEPA character set"""
+    value = unicodedata.normalize("NFKD", value.translate(TRANSLITERATION))
+    value = value.encode("ascii", "ignore").decode("ascii")
+    return SEPA_CHARS.sub(" ", value).strip()[:length]
+
+
+def normalize_iban(iban):
+    """Remove spaces and validate the checksum of an IBAN"""
+    iban = iban.replace(" ", "").upper()
+    if not re.fullmatch(r"[A-Z]{2}[0-9]{2}[A-Z0-9]{11,30}", iban):
+        raise MandateError("not an IBAN: {}".format(iban))
+
+    digits = "".join(str(int(c, 36)) for c in iban[4:] + iban[:4])
+    if int(digits) % 97 != 1:
+        raise MandateError("invalid IBAN checksum: {}".format(iban))
+
+    return iban
+
+
+def normalize_bic(bic):
+    """Validate a BIC"""
+    if not bic:
+        return None
+    bic = bic.replace(" ", "").upper()
+    if not re.fullmatch(r"[A-Z]{6}[A-Z0-9]{2}([A-Z0-9]{3})?", bic):
+        raise MandateError("not a BIC: {}".format(bic))
+    return bic
+
+
+def get_creditor(conn):
+    """Get the creditor settings"""
+    qry = """
+        SELECT * FROM sepa_creditor
+    """
+    cur = conn.cursor()
+    cur.execute(qry)
+    res = cur.fetchone()
+
+    return db.dict_row(res, cur)
+
+
+def set_creditor(conn, name, iban, bic, creditor_id):
+    """Set the creditor settings"""
+    params = (
+        sepa_text(name, 70),
+        normalize_iban(iban),
+        normalize_bic(bic),
+        creditor_id.replace(" ", "").upper(),
+    )
+    cur = conn.cursor()
+    cur.execute("DELETE FROM sepa_creditor")
+    cur.execute("""
+        INSERT INTO sepa_creditor (
+            name,
+            iban,
+            bic,
+            creditor_id
+        ) VALUES ( ?, ?, ?, ? )
+    """, params)
+    conn.commit()
+
+    return get_creditor(conn)
+
+
+def get_mandate(conn, member_id):
+    """Get the mandate of a member"""
+    qry = """
+        SELECT * FROM sepa_mandates WHERE member_id = ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (member_id,))
+    res = cur.fetchone()
+
+    return db.dict_row(res, cur)
+
+
+def set_mandate(conn, mandate):
+    """Add or replace the mandate of a member"""
+    params = (
+        mandate["member_id"],
+        mandate.get("mandate_id") or "ERIS-M-{}".format(mandate["member_id"]),
+        normalize_iban(mandate["iban"]),
+        normalize_bic(mandate.get("bic")),
+        db.encode_date(mandate["signed_on"]),
+    )
+    qry = """
+        INSERT OR REPLACE INTO sepa_mandates (
+            member_id,
+            mandate_id,
+            iban,
+            bic,
+            signed_on
+        ) VALUES ( ?, ?, ?, ?, ? )
+    """
+    cur = conn.cursor()
+    cur.execute(qry, params)
+    conn.commit()
+
+    return get_mandate(conn, mandate["member_id"])
+
+
+# Active members with a mandate, at least one payment period
+# behind and without a pending collection that has not expired.
+DUE_MEMBERS = """
+      FROM members
+      JOIN sepa_mandates ON sepa_mandates.member_id = members.id
+     WHERE """ + ARREARS + """ >= 1
+       AND (membership_end IS NULL OR membership_end > :today)
+       AND NOT EXISTS (
+           SELECT 1 FROM sepa_collections
+            WHERE sepa_collections.member_id = members.id
+              AND status = 'pending'
+              AND collection_date >= date(:today, :window))
+"""
+
+
+def due_params(today, **params):
+    """Get the named params of DUE_MEMBERS"""
+    return dict(
+        params,
+        today=db.encode_date(today),
+        window="-{} days".format(COLLECTION_WINDOW))
+
+SEQUENCE_TYPE = """
+    CASE WHEN EXISTS (
+        SELECT 1 FROM sepa_collections
+         WHERE sepa_collections.mandate_id = sepa_mandates.mandate_id
+           AND status = 'collected')
+    THEN 'RCUR' ELSE 'FRST' END
+"""
+
+
+def get_due_totals(conn, today):
+    """Get the number and sum in cents of due debits per sequence type"""
+    qry = """
+        SELECT """ + SEQUENCE_TYPE + """ AS seq_type,
+               count(*),
+               sum(CAST(round(-account * 100) AS INTEGER))
+    """ + DUE_MEMBERS + """
+         GROUP BY seq_type
+    """
+    cur = conn.cursor()
+    cur.execute(qry, due_params(today))
+
+    return {seq: (count, cents) for seq, count, cents in cur.fetchall()}
+
+
+def iter_due_debits(conn, today, seq_type):
+    """Iterate the due debits of a sequence type"""
+    qry = """
+        SELECT members.id AS member_id,
+               members.name,
+               CAST(round(-account * 100) AS INTEGER) AS cents,
+               sepa_mandates.mandate_id,
+               sepa_mandates.iban,
+               sepa_mandates.bic,
+               sepa_mandates.signed_on
+    """ + DUE_MEMBERS + """
+           AND """ + SEQUENCE_TYPE + """ = :seq_type
+         ORDER BY members.id ASC
+    """
+    cur = conn.cursor()
+    cur.execute(qry, due_params(today, seq_type=seq_type))
+    for row in cur:
+        yield db.dict_row(row, cur)
+
+
+def format_cents(cents):
+    """Format an amount in cents"""
+    return str(Decimal(cents).scaleb(-2).quantize(Decimal("0.01")))
+
+
+class Writer:
+    """Streaming writer for XML elements"""
+
+    def __init__(self, file):
+        self.xml = XMLGenerator(file, encoding="utf-8",
+                                short_empty_elements=True)
+
+    def start(self, name, attrs=None):
+        """Open an element"""
+        self.xml.startElement(name, attrs or {})
+
+    def end(self, name):
+        """Close an element"""
+        self.xml.endElement(name)
+
+    def element(self, name, text, attrs=None):
+        """Write an element with text content"""
+        self.start(name, attrs)
+        self.xml.characters(str(text))
+        self.end(name)
+
+    def path(self, names, text):
+        """Write nested elements around a text"""
+        for name in names[:-1]:
+            self.start(name)
+        self.element(names[-1], text)
+        for name in reversed(names[:-1]):
+            self.end(name)
+
+
+def write_debit(out, debit, end_to_end_id, remittance):
+    """Write a DrctDbtTxInf element"""
+    out.start("DrctDbtTxInf")
+    out.path(("PmtId", "EndToEndId"), end_to_end_id)
+    out.element("InstdAmt", format_cents(debit["cents"]), {"Ccy": "EUR"})
+    out.start("DrctDbtTx")
+    out.start("MndtRltdInf")
+    out.element("MndtId", debit["mandate_id"])
+    out.element("DtOfSgntr", debit["signed_on"])
+    out.end("MndtRltdInf")
+    out.end("DrctDbtTx")
+    if debit["bic"]:
+        out.path(("DbtrAgt", "FinInstnId", "BIC"), debit["bic"])
+    else:
+        out.path(("DbtrAgt", "FinInstnId", "Othr", "Id"), "NOTPROVIDED")
+    out.path(("Dbtr", "Nm"), sepa_text(debit["name"], 70))
+    out.path(("DbtrAcct", "Id", "IBAN"), debit["iban"])
+    out.path(("RmtInf", "Ustrd"), remittance)
+    out.end("DrctDbtTxInf")
+
+
+def write_payment_info(out, creditor, msg_id, seq_type, totals,
+                       collection_date):
+    """Write the start of a PmtInf element"""
+    count, cents = totals
+    out.start("PmtInf")
+    out.element("PmtInfId", "{}-{}".format(msg_id, seq_type))
+    out.element("PmtMtd", "DD")
+    out.element("NbOfTxs", count)
+    out.element("CtrlSum", format_cents(cents))
+    out.start("PmtTpInf")
+    out.path(("SvcLvl", "Cd"), "SEPA")
+    out.path(("LclInstrm", "Cd"), "CORE")
+    out.element("SeqTp", seq_type)
+    out.end("PmtTpInf")
+    out.element("ReqdColltnDt", db.encode_date(collection_date))
+    out.path(("Cdtr", "Nm"), creditor["name"])
+    out.path(("CdtrAcct", "Id", "IBAN"), creditor["iban"])
+    if creditor["bic"]:
+        out.path(("CdtrAgt", "FinInstnId", "BIC"), creditor["bic"])
+    else:
+        out.path(("CdtrAgt", "FinInstnId", "Othr", "Id"), "NOTPROVIDED")
+    out.element("ChrgBr", "SLEV")
+    out.start("CdtrSchmeId")
+    out.start("Id")
+    out.start("PrvtId")
+    out.start("Othr")
+    out.element("Id", creditor["creditor_id"])
+    out.path(("SchmeNm", "Prtry"), "SEPA")
+    out.end("Othr")
+    out.end("PrvtId")
+    out.end("Id")
+    out.end("CdtrSchmeId")
+
+
+def next_msg_id(conn, now):
+    """
+    Get a message id for an export, numbered within the second
+    as the end-to-end ids derived from it must be unique.
+    """
+    prefix = "ERIS-" + now.strftime("%Y%m%d%H%M%S") + "-"
+    qry = """
+        SELECT count(DISTINCT msg_id)
+          FROM sepa_collections
+         WHERE substr(msg_id, 1, ?) = ?
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (len(prefix), prefix))
+
+    return "{}{}".format(prefix, cur.fetchone()[0] + 1)
+
+
+def export_debits(conn, filename, collection_date=None, today=None,
+                  xsd=None):
+    """
+    Write a pain.008 message for all due members to a file and
+    record the pending collections in the same transaction. With
+    an xsd the file is validated before the collections are
+    committed. No file is written when no member is due.
+    Returns the number of debits and the total in cents.
+    """
+    if not today:
+        today = date.today()
+    if not collection_date:
+        collection_date = today + timedelta(days=COLLECTION_DELAY)
+
+    creditor = get_creditor(conn)
+    if not creditor:
+        raise MandateError("creditor is not configured")
+
+    now = datetime.now()
+    remittance = sepa_text("{} Mitgliedsbeitrag {}".format(
+        creditor["name"], collection_date.strftime("%m/%Y")), 140)
+
+    # Hold the write lock, totals and debits must agree
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        totals = get_due_totals(conn, today)
+        count = sum(t[0] for t in totals.values())
+        cents = sum(t[1] for t in totals.values())
+        if not count:
+            conn.rollback()
+            return 0, 0
+
+        msg_id = next_msg_id(conn, now)
+        with open(filename + ".tmp", "wb") as file:
+            write_message(conn, file, creditor, msg_id, now, totals,
+                          collection_date, today, remittance)
+        if xsd:
+            validate(filename + ".tmp", xsd)
+        os.replace(filename + ".tmp", filename)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if os.path.exists(filename + ".tmp"):
+            os.remove(filename + ".tmp")
+        raise
+
+    return count, cents
+
+
+def write_message(conn, file, creditor, msg_id, now, totals,
+                  collection_date, today, remittance):
+    """Write the message and insert the pending collections"""
+    count = sum(t[0] for t in totals.values())
+    cents = sum(t[1] for t in totals.values())
+
+    out = Writer(file)
+    out.xml.startDocument()
+    out.start("Document", {"xmlns": NAMESPACE})
+    out.start("CstmrDrctDbtInitn")
+    out.start("GrpHdr")
+    out.element("MsgId", msg_id)
+    out.element("CreDtTm", now.strftime("%Y-%m-%dT%H:%M:%S"))
+    out.element("NbOfTxs", count)
+    out.element("CtrlSum", format_cents(cents))
+    out.path(("InitgPty", "Nm"), creditor["name"])
+    out.end("GrpHdr")
+
+    cur = conn.cursor()
+    collections = []
+    for seq_type in SEQUENCE_TYPES:
+        if seq_type not in totals:
+            continue
+        write_payment_info(out, creditor, msg_id, seq_type,
+                           totals[seq_type], collection_date)
+        for debit in iter_due_debits(conn, today, seq_type):
+            end_to_end_id = "{}-{}".format(msg_id, debit["member_id"])
+            write_debit(out, debit, end_to_end_id, remittance)
+            collections.append((
+                debit["member_id"],
+                debit["mandate_id"],
+                msg_id,
+                end_to_end_id,
+                seq_type,
+                debit["cents"],
+                db.encode_date(collection_date),
+            ))
+            if len(collections) >= INSERT_BATCH_SIZE:
+                add_collections(cur, collections)
+                collections = []
+        out.end("PmtInf")
+    add_collections(cur, collections)
+
+    out.end("CstmrDrctDbtInitn")
+    out.end("Document")
+    out.xml.endDocument()
+
+
+def add_collections(cur, collections):
+    """Insert pending collections"""
+    cur.executemany("""
+        INSERT INTO sepa_collections (
+            member_id,
+            mandate_id,
+            msg_id,
+            end_to_end_id,
+            seq_type,
+            amount_cents,
+            collection_date,
+            status
+        ) VALUES ( ?, ?, ?, ?, ?, ?, ?, 'pending' )
+    """, collections)
+
+
+def mark_collected(session, transaction):
+    """
+    Queue marking a pending collection of the member as collected
+    by the import batch of the session. A payment matches by its
+    EndToEndId, given as reference or in the description, or by
+    the amount within the window after the collection date.
+    """
+    session.execute("""
+        UPDATE sepa_collections
+           SET status = 'collected',
+               collected_batch_id = ?
+         WHERE id = (
+            SELECT id FROM sepa_collections
+             WHERE member_id = ?
+               AND status = 'pending'
+               AND (end_to_end_id = ?
+                    OR instr(?, end_to_end_id) > 0
+                    OR (amount_cents = CAST(round(? * 100) AS INTEGER)
+                        AND ? BETWEEN collection_date
+                                  AND date(collection_date, ?)))
+             ORDER BY collection_date ASC
+             LIMIT 1)
+    """, (
+        session.batch_id,
+        transaction["member_id"],
+        transaction.get("end_to_end_id", ""),
+        transaction.get("description", ""),
+        db.encode_decimal(transaction["amount"]),
+        db.encode_date(transaction["date"]),
+        "+{} days".format(COLLECTION_WINDOW),
+    ))
+
+
+def cancel_collections(conn, member_id):
+    """
+    Cancel the pending collections of a member, e.g. after a
+    return debit. Returns the number of cancelled collections.
+    """
+    qry = """
+        UPDATE sepa_collections
+           SET status = 'cancelled'
+         WHERE member_id = ?
+           AND status = 'pending'
+    """
+    cur = conn.cursor()
+    cur.execute(qry, (db.encode_id(member_id),))
+    conn.commit()
+
+    return cur.rowcount
+
+
+def validate(filename, xsd):
+    """
+    Validate a message against the pain.008 XSD while streaming
+    through it. This needs lxml.
+    """
+    try:
+        from lxml import etree # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise RuntimeError("XSD validation needs lxml") from e
+
+    schema = etree.XMLSchema(etree.parse(xsd))
+    try:
+        for _event, elem in etree.iterparse(filename, schema=schema):
+            elem.clear()
+    except etree.Error as e:
+        raise ValidationError("not valid according to {}: {}".format(
+            xsd, e)) from e
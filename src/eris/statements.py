@@ -0,0 +1,230 @@
+"""
+Bank statement parsers for CAMT.053 (ISO 20022 XML)
+and MT940 (SWIFT) account statements.
+
+Both parsers stream through the file and yield incoming
+payments with the fields of a Deutsche Bank CSV row:
+date, account_name, description, iban, bic and amount.
+CAMT.053 entries also carry the end_to_end_id of direct debits.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+from datetime import date
+from decimal import Decimal
+
+CAMT_NAMESPACE_PREFIX = b"urn:iso:std:iso:20022:tech:xsd:camt.053"
+
+MT940_START = re.compile(rb"^(\{1:|:20:)", re.MULTILINE)
+MT940_TAG = re.compile(r"^:(\d\d[A-Z]?):(.*)$")
+MT940_ENTRY = re.compile(
+    r"^(?P<value_date>\d{6})(?P<entry_date>\d{4})?"
+    r"(?P<mark>RC|RD|C|D)[A-Z]?(?P<amount>\d+,\d*)")
+MT940_FIELD = re.compile(r"\?(\d\d)")
+
+
+def detect_camt053(head):
+    """Check the first bytes for a CAMT.053 document"""
+    return head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<") and \
+        CAMT_NAMESPACE_PREFIX in head
+
+
+def detect_mt940(head):
+    """Check the first bytes for a MT940 statement"""
+    return MT940_START.search(head) is not None
+
+
+def local_name(tag):
+    """Strip the namespace from a tag"""
+    return tag.rpartition("}")[2]
+
+
+def find(elem, path):
+    """Find a descendant by local names, ignoring namespaces"""
+    for name in path.split("/"):
+        for child in elem:
+            if local_name(child.tag) == name:
+                elem = child
+                break
+        else:
+            return None
+    return elem
+
+
+def find_text(elem, *paths):
+    """Get the text of the first path found"""
+    for path in paths:
+        found = find(elem, path)
+        if found is not None and found.text:
+            return found.text.strip()
+    return ""
+
+
+def find_all(elem, name):
+    """Get the children with a local name"""
+    return [child for child in elem if local_name(child.tag) == name]
+
+
+def decode_camt_entry(entry):
+    """Get the incoming payments of a booked Ntry element"""
+    if find_text(entry, "CdtDbtInd") != "CRDT":
+        return
+    if find_text(entry, "Sts/Cd", "Sts") not in ("", "BOOK"):
+        return
+
+    booked = find_text(entry, "BookgDt/Dt", "BookgDt/DtTm", "ValDt/Dt")
+    booked = date.fromisoformat(booked[:10])
+
+    details = []
+    for entry_details in find_all(entry, "NtryDtls"):
+        details.extend(find_all(entry_details, "TxDtls"))
+    if not details:
+        details = [None]
+
+    for tx in details:
+        amount = find_text(entry, "Amt")
+        if tx is None:
+            yield {
+                "date": booked,
+                "account_name": "",
+                "description": find_text(entry, "AddtlNtryInf"),
+                "iban": "",
+                "bic": "",
+                "amount": Decimal(amount),
+            }
+            continue
+
+        if len(details) > 1:
+            amount = find_text(tx, "Amt", "AmtDtls/TxAmt/Amt") or amount
+        remittance = find(tx, "RmtInf")
+        description = " ".join(
+            (u.text or "").strip() for u in find_all(remittance, "Ustrd")) \
+            if remittance is not None else ""
+        end_to_end_id = find_text(tx, "Refs/EndToEndId")
+        if end_to_end_id == "NOTPROVIDED":
+            end_to_end_id = ""
+        yield {
+            "date": booked,
+            "account_name": find_text(
+                tx, "RltdPties/Dbtr/Nm", "RltdPties/Dbtr/Pty/Nm"),
+            "description": description or find_text(entry, "AddtlNtryInf"),
+            "iban": find_text(tx, "RltdPties/DbtrAcct/Id/IBAN"),
+            "bic": find_text(
+                tx,
+                "RltdAgts/DbtrAgt/FinInstnId/BIC",
+                "RltdAgts/DbtrAgt/FinInstnId/BICFI"),
+            "amount": Decimal(amount),
+            "end_to_end_id": end_to_end_id,
+        }
+
+
+def iter_camt053(filename):
+    """
+    Iterate the incoming payments of a CAMT.053 statement.
+    Each Ntry element is dropped from the tree once decoded,
+    so memory use does not grow with the size of the file.
+    """
+    parents = []
+    for event, elem in ET.iterparse(filename, events=("start", "end")):
+        if event == "start":
+            parents.append(elem)
+            continue
+
+        parents.pop()
+        if local_name(elem.tag) != "Ntry":
+            continue
+
+        yield from decode_camt_entry(elem)
+        elem.clear()
+        parents[-1].remove(elem)
+
+
+def decode_mt940_date(value, year=None):
+    """Decode a YYMMDD or, with a year, MMDD date"""
+    if year is None:
+        return date(2000 + int(value[:2]), int(value[2:4]), int(value[4:6]))
+    return date(year, int(value[:2]), int(value[2:4]))
+
+
+def decode_mt940_details(text):
+    """
+    Decode the structured :86: field into name, iban, bic and
+    description. Unstructured fields are used as description.
+    """
+    details = {"account_name": "", "iban": "", "bic": "", "description": ""}
+    if len(text) < 4 or text[3] != "?":
+        details["description"] = text
+        return details
+
+    fields = MT940_FIELD.split(text[3:])
+    purpose = []
+    name = []
+    for key, value in zip(fields[1::2], fields[2::2]):
+        if "20" <= key <= "29" or "60" <= key <= "63":
+            purpose.append(value)
+        elif key == "30":
+            details["bic"] = value
+        elif key == "31":
+            details["iban"] = value
+        elif key in ("32", "33"):
+            name.append(value)
+    details["account_name"] = "".join(name).strip()
+    details["description"] = "".join(purpose).strip()
+    return details
+
+
+def decode_mt940_entry(entry, details):
+    """Decode a :61: line with its :86: field, None for debits"""
+    match = MT940_ENTRY.match(entry)
+    if not match:
+        raise ValueError("invalid :61: line: {}".format(entry))
+    if match["mark"] != "C":
+        return None
+
+    booked = decode_mt940_date(match["value_date"])
+    if match["entry_date"]:
+        entry_date = decode_mt940_date(match["entry_date"], booked.year)
+        # Booked around the turn of the year
+        if (entry_date - booked).days > 180:
+            entry_date = entry_date.replace(year=booked.year - 1)
+        elif (booked - entry_date).days > 180:
+            entry_date = entry_date.replace(year=booked.year + 1)
+        booked = entry_date
+
+    transaction = {"date": booked}
+    transaction.update(decode_mt940_details(details))
+    transaction["amount"] = Decimal(match["amount"].replace(",", "."))
+    return transaction
+
+
+def iter_mt940(filename, encoding):
+    """Iterate the incoming payments of a MT940 statement"""
+    entry = None
+    details = []
+    tag = None
+    with open(filename, encoding=encoding, newline="") as file:
+        for line in file:
+            line = line.rstrip("\r\n")
+            match = MT940_TAG.match(line)
+            if match:
+                tag, value = match.groups()
+                if tag == "86":
+                    details = [value]
+                    continue
+                if entry:
+                    transaction = decode_mt940_entry(entry, "".join(details))
+                    if transaction:
+                        yield transaction
+                    entry = None
+                if tag == "61":
+                    entry = value
+                    details = []
+            elif tag == "86" and not line.startswith("-"):
+                details.append(line)
+            elif line.startswith("-"):
+                tag = None
+
+    if entry:
+        transaction = decode_mt940_entry(entry, "".join(details))
+        if transaction:
+            yield transaction
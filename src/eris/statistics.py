@@ -0,0 +1,134 @@
+"""
+Membership statistics per month: active members, joiners,
+leavers, churn and fee revenue, computed in SQL.
+
+Results are cached until the database changes, detected with
+`PRAGMA data_version` for commits of other connections and the
+change counter of the connection for its own.
+"""
+
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+
+from eris import db
+
+CACHE_SIZE = 32
+
+# Months from the first membership to today. Active members and
+# expected fees are running sums of joiners minus leavers.
+MONTHLY_QUERY = """
+    WITH RECURSIVE
+    months(month) AS (
+        SELECT date(min(membership_start), 'start of month') FROM members
+        UNION ALL
+        SELECT date(month, '+1 month') FROM months
+         WHERE month < date(?, 'start of month')
+    ),
+    joins AS (
+        SELECT substr(membership_start, 1, 7) AS month,
+               count(*) AS members,
+               sum(CAST(round(fee * 100) AS INTEGER)) AS fee_cents
+          FROM members
+         GROUP BY 1
+    ),
+    leaves AS (
+        SELECT substr(membership_end, 1, 7) AS month,
+               count(*) AS members,
+               sum(CAST(round(fee * 100) AS INTEGER)) AS fee_cents
+          FROM members
+         WHERE membership_end IS NOT NULL
+         GROUP BY 1
+    ),
+    monthly AS (
+        SELECT substr(months.month, 1, 7) AS month,
+               coalesce(joins.members, 0) AS joiners,
+               coalesce(leaves.members, 0) AS leavers,
+               sum(coalesce(joins.members, 0) - coalesce(leaves.members, 0))
+                   OVER (ORDER BY months.month) AS active,
+               sum(coalesce(joins.fee_cents, 0) - coalesce(leaves.fee_cents, 0))
+                   OVER (ORDER BY months.month) AS fee_cents,
+               coalesce(payments.amount_cents, 0) AS payment_cents
+          FROM months
+          LEFT JOIN joins ON joins.month = substr(months.month, 1, 7)
+          LEFT JOIN leaves ON leaves.month = substr(months.month, 1, 7)
+          LEFT JOIN monthly_totals AS payments
+                 ON payments.month = substr(months.month, 1, 7)
+                AND payments.kind = 'payment'
+    ),
+    churn AS (
+        SELECT monthly.*,
+               round(leavers * 1.0 / lag(active) OVER (ORDER BY month), 4)
+                   AS churn
+          FROM monthly
+    )
+    SELECT month, joiners, leavers, active, churn, fee_cents, payment_cents
+      FROM churn
+     WHERE month >= ? AND month <= ?
+     ORDER BY month ASC
+"""
+
+
+class StatisticsCache:
+    """Query results per connection, dropped when the data changes"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def version(conn):
+        """Get a key that changes with every commit"""
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return (data_version, conn.total_changes)
+
+    def get(self, conn, key, func):
+        """Get a cached result or compute it with func"""
+        key = (id(conn), self.version(conn)) + key
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        result = func()
+        self.entries[key] = result
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        return result
+
+
+CACHE = StatisticsCache()
+
+
+def decode_month(row):
+    """Decode a row of monthly statistics"""
+    row["fees"] = Decimal(row.pop("fee_cents")).scaleb(-2)
+    row["payments"] = Decimal(row.pop("payment_cents")).scaleb(-2)
+    return row
+
+
+def query_monthly(conn, first, last, today):
+    """Run the monthly statistics query"""
+    cur = conn.cursor()
+    cur.execute(MONTHLY_QUERY, (db.encode_date(today), first, last))
+    return [decode_month(db.dict_row(row, cur)) for row in cur.fetchall()]
+
+
+def get_monthly(conn, year=None, today=None):
+    """
+    Get the statistics per month: active members at the end of
+    the month, joiners, leavers, churn as leavers per active member
+    of the previous month, expected fees of the active members at
+    their current fee, and received payments.
+    """
+    if not today:
+        today = date.today()
+
+    first, last = "0000-00", "9999-99"
+    if year:
+        first, last = "{:04d}-01".format(int(year)), "{:04d}-12".format(
+            int(year))
+
+    return CACHE.get(
+        conn, ("monthly", first, last, today),
+        lambda: query_monthly(conn, first, last, today))
@@ -1,16 +1,26 @@
 """
 CLI entry point
 """
-from eris import db
-from eris_cli.cli import parse_args, print_help
+from eris_cli.cli import parse_args, print_help, get_command
 
 def __main__():
     """CLI main entry point"""
-    members_db = db.connect("members.sqlite3")
     args = parse_args()
-    command = args.command
-    if not command:
+    if not args.command:
         print_help()
         return
 
-    command(members_db, args)
+    command = get_command(args.command)
+    func = command.load()
+    if not command.database:
+        func(None, args)
+        return
+
+    # Imported here, --help and completion do not need the database
+    from eris import db
+
+    members_db = db.connect("members.sqlite3")
+    if command.read_only and args.snapshot:
+        members_db = db.snapshot(members_db)
+
+    func(members_db, args)
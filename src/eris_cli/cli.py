@@ -1,82 +1,300 @@
 """
-CLI Command Line Arguments
+CLI Commands and Arguments
+
+Commands are registered by the name of their script module and
+function, the module is only imported when the command runs.
 """
+import sys
 from argparse import ArgumentParser
+from importlib import import_module
+
+SCRIPTS_PACKAGE = "eris_cli.scripts"
+
+# Options shared by the commands, each command adds those it reads
+OPTIONS = {
+    "filename": ("--filename", {}),
+    "iban_hash": ("--iban-hash", {}),
+    "id": ("--id", {}),
+    "name": ("--name", {}),
+    "email": ("--email", {}),
+    "amount": ("--amount", {}),
+    "split": ("--split", {"nargs": "*"}),
+    "encoding": ("--encoding", {}),
+    "comment": ("--comment", {}),
+    "interval": ("--interval", {}),
+    "date": ("--date", {}),
+    "since": ("--since", {"help": "first date, YYYY-MM-DD"}),
+    "until": ("--until", {"help": "last date, YYYY-MM-DD"}),
+    "limit": ("--limit", {}),
+    "after": ("--after", {
+        "metavar": "CURSOR",
+        "help": "continue a listing after this cursor"}),
+    "follow": ("--follow", {
+        "default": False, "action": "store_true",
+        "help": "keep polling for new changes"}),
+    "force": ("--force", {"default": False, "action": "store_true"}),
+    "queue": ("--queue", {
+        "default": False, "action": "store_true",
+        "help": "run through the writer job queue"}),
+    "host": ("--host", {}),
+    "port": ("--port", {}),
+    "year": ("--year", {}),
+    "template": ("--template", {}),
+    "format": ("--format", {"help": "statement format: text or pdf"}),
+    "keep": ("--keep", {"help": "number of backup copies to keep"}),
+    "vacuum_pages": ("--vacuum-pages", {"help": "pages freed per run"}),
+    "iban": ("--iban", {}),
+    "bic": ("--bic", {}),
+    "creditor_id": ("--creditor-id", {}),
+    "mandate_id": ("--mandate-id", {}),
+    "xsd": ("--xsd", {"help": "validate the export against this XSD"}),
+    "auto_assign": ("--auto-assign", {
+        "metavar": "SCORE",
+        "help": "create member rules for suggestions above SCORE"}),
+    "shell": ("--shell", {
+        "default": "bash", "choices": ("bash", "zsh"),
+        "help": "shell to complete, default bash"}),
+}
+
+SNAPSHOT_OPTION = ("--snapshot", {
+    "default": False, "action": "store_true",
+    "help": "run the report on an in-memory copy of the database"})
+
 
-from eris_cli.scripts import (
-    banking,
-    members,
-    accounting,
-)
+class Command:
+    """A registered command"""
 
-def register_command(argp, flag, cmd):
-    """Add a command to the parser"""
-    argp.add_argument(
-        flag,
-        dest="command",
-        action="store_const",
-        const=cmd,
-        help=cmd.__doc__)
+    def __init__(self, name, target, description, options=(),
+                 read_only=False, database=True):
+        self.name = name
+        self.target = target
+        self.description = description
+        self.options = options
+        self.read_only = read_only
+        self.database = database
 
+    def get_options(self):
+        """Get the flags and argparse settings of the options"""
+        options = [OPTIONS[option] for option in self.options]
+        if self.read_only:
+            options.append(SNAPSHOT_OPTION)
+        return options
 
-parser = ArgumentParser(
-    description="eris membership tool")
+    def load(self):
+        """Import the module of the command, get the function"""
+        module, func = self.target.split(".")
+        return getattr(import_module(SCRIPTS_PACKAGE + "." + module), func)
 
-# Options
-parser.add_argument("--filename")
-parser.add_argument("--iban-hash")
-parser.add_argument("--id")
-parser.add_argument("--name")
-parser.add_argument("--email")
-parser.add_argument("--amount")
-parser.add_argument("--split", nargs="*")
-parser.add_argument("--encoding")
-parser.add_argument("--comment")
-parser.add_argument("--interval")
-parser.add_argument("--date")
-parser.add_argument("--force", default=False, action="store_true")
 
+# Commands by name, in the order of the help text
+COMMANDS = {}
 
-# Commands
+
+def register_command(name, target, description, options=(),
+                     read_only=False, database=True):
+    """Add a command to the registry"""
+    COMMANDS[name] = Command(
+        name, target, description, options, read_only, database)
+
+
+register_command(
+    "list-members", "members.list_members",
+    "List all members",
+    ("name",), read_only=True)
+register_command(
+    "import-members", "members.import_members",
+    "Import members from JSON",
+    ("filename",))
+register_command(
+    "calculate-accounts", "accounting.calculate_member_accounts",
+    "Run member account calculations",
+    ("queue",))
+register_command(
+    "import-bank-csv", "banking.import_bank_csv",
+    "Import a deutsche bank CSV, CAMT.053 or MT940 statement",
+    ("filename", "encoding", "force", "queue", "auto_assign"))
+register_command(
+    "list-bank-rules", "banking.list_rules",
+    "List all bank import rules",
+    read_only=True)
+register_command(
+    "assign-member-iban", "banking.assign_member_iban",
+    "Use this member ID for the matching IBAN hash",
+    ("iban_hash", "id"))
+register_command(
+    "assign-split-iban", "banking.assign_split_iban",
+    "Split the amount to multiple members",
+    ("iban_hash", "split"))
+register_command(
+    "import-payment-intervals", "members.import_payment_intervals",
+    "Import payment intervals",
+    ("filename",))
+register_command(
+    "list-transactions", "banking.list_transactions",
+    "List transactions",
+    ("id", "name", "since", "until", "limit", "after"), read_only=True)
+register_command(
+    "undo-transaction", "banking.undo_transaction",
+    "Subtract the amount from the member account and undo transaction",
+    ("id",))
+register_command(
+    "list-batches", "banking.list_batches",
+    "List import and calculation batches",
+    read_only=True)
 register_command(
-    parser, "--list-members", members.list_members)
+    "undo-batch", "banking.undo_batch",
+    "Reverse all transactions of a batch",
+    ("id",))
 register_command(
-    parser, "--import-members", members.import_members)
+    "archive-transactions", "banking.archive_transactions",
+    "Move transactions of closed years into per-year archive files",
+    ("year",))
 register_command(
-    parser, "--calculate-accounts", accounting.calculate_member_accounts)
+    "set-fee", "members.set_member_fee",
+    "Set membership fee",
+    ("id", "amount"))
 register_command(
-    parser, "--import-bank-csv", banking.import_bank_csv)
+    "set-interval", "members.set_interval",
+    "Set payment interval",
+    ("id", "interval"))
 register_command(
-    parser, "--list-bank-rules", banking.list_rules)
+    "adjust-account", "accounting.adjust_member_account",
+    "Set member account value",
+    ("id", "amount", "comment", "queue"))
 register_command(
-    parser, "--assign-member-iban", banking.assign_member_iban)
+    "report-monthly", "accounting.report_monthly",
+    "Show income and billed fees per month",
+    ("year",), read_only=True)
 register_command(
-    parser, "--assign-split-iban", banking.assign_split_iban)
+    "report-balances", "accounting.report_balances",
+    "Show the balance of every member as of --date, default today",
+    ("date",), read_only=True)
 register_command(
-    parser, "--import-payment-intervals", members.import_payment_intervals)
+    "report-statistics", "accounting.report_statistics",
+    "Show active members, joiners, leavers and fees per month",
+    ("year",), read_only=True)
 register_command(
-    parser, "--list-transactions", banking.list_transactions)
+    "write-statements", "accounting.write_statements",
+    "Write account statements for all members into a directory",
+    ("filename", "format", "year", "since", "until", "id"), read_only=True)
 register_command(
-    parser, "--undo-transaction", banking.undo_transaction)
+    "update-name", "members.update_name",
+    "Change a name",
+    ("id", "name"))
 register_command(
-    parser, "--set-fee", members.set_member_fee)
+    "end-membership", "members.end_membership",
+    "End a membership",
+    ("id", "date"))
 register_command(
-    parser, "--set-interval", members.set_interval)
+    "add-member", "members.add_member",
+    "Add a member to the database",
+    ("name", "email", "amount", "date", "comment"))
 register_command(
-    parser, "--adjust-account", accounting.adjust_member_account)
+    "bulk-update-members", "members.bulk_update_members",
+    "Update members from a CSV with id,field,value rows",
+    ("filename",))
 register_command(
-    parser, "--update-name", members.update_name)
+    "list-arrears", "dunning.list_arrears",
+    "List members in arrears with their dunning level",
+    read_only=True)
 register_command(
-    parser, "--end-membership", members.end_membership)
+    "write-dunning-letters", "dunning.write_dunning_letters",
+    "Write reminders for members in arrears to a maildir or .mbox",
+    ("filename", "template"))
 register_command(
-    parser, "--add-member", members.add_member)
+    "set-sepa-creditor", "sepa.set_sepa_creditor",
+    "Set the SEPA creditor name, account and creditor id",
+    ("name", "iban", "bic", "creditor_id"))
+register_command(
+    "add-mandate", "sepa.add_mandate",
+    "Add or replace the direct debit mandate of a member",
+    ("id", "mandate_id", "date", "iban", "bic"))
+register_command(
+    "export-sepa-debits", "sepa.export_sepa_debits",
+    "Write a pain.008 direct debit file for all due members",
+    ("filename", "date", "xsd"))
+register_command(
+    "cancel-collection", "sepa.cancel_collection",
+    "Cancel the pending direct debit of a member, e.g. after a return",
+    ("id",))
+register_command(
+    "tail-changes", "changes.tail_changes",
+    "Show the changes after --after <id>, keep polling with --follow",
+    ("after", "limit", "follow"), read_only=True)
+register_command(
+    "compact-changes", "changes.compact_changes",
+    "Remove superseded changes, and all before --date if given",
+    ("date",))
+register_command(
+    "maintain", "maintenance.maintain",
+    "Check and optimize the database, vacuum incrementally",
+    ("vacuum_pages", "force"))
+register_command(
+    "backup", "backup.backup_database",
+    "Write a verified standby copy into the --filename directory",
+    ("filename", "keep"))
+register_command(
+    "verify-backups", "backup.verify_backups",
+    "Check the copies in the --filename directory against the manifest",
+    ("filename",), database=False)
+register_command(
+    "serve-api", "api.serve_api",
+    "Serve members, balances and transactions as read-only JSON",
+    ("host", "port"))
+register_command(
+    "run-writer", "jobs.run_writer",
+    "Run queued import, calculation and adjustment jobs")
+register_command(
+    "list-jobs", "jobs.list_jobs",
+    "List the latest writer jobs",
+    read_only=True)
+register_command(
+    "completion", "completion.print_completion",
+    "Print a shell completion script: eval \"$(eris completion)\"",
+    ("shell",), database=False)
+
+
+def build_parser():
+    """Build the parser with a subparser per command"""
+    parser = ArgumentParser(
+        prog="eris",
+        description="eris membership tool")
+    subparsers = parser.add_subparsers(
+        dest="command", metavar="<command>")
+    for command in COMMANDS.values():
+        subparser = subparsers.add_parser(
+            command.name,
+            help=command.description,
+            description=command.description)
+        for flag, settings in command.get_options():
+            subparser.add_argument(flag, **settings)
+
+    return parser
+
+
+def translate_legacy_args(argv):
+    """
+    Move a command given as flag, like --list-members, to the
+    front as subcommand, so existing scripts keep working.
+    """
+    for i, arg in enumerate(argv):
+        if arg.startswith("--") and arg[2:] in COMMANDS:
+            return [arg[2:]] + argv[:i] + argv[i + 1:]
+    return argv
+
+
+def get_command(name):
+    """Get a registered command"""
+    return COMMANDS[name]
 
 
 def print_help():
     """Print help text"""
-    parser.print_help()
+    build_parser().print_help()
 
 
-def parse_args():
+def parse_args(argv=None):
     """Parse commandline arguments"""
-    return parser.parse_args()
+    if argv is None:
+        argv = sys.argv[1:]
+    return build_parser().parse_args(translate_legacy_args(argv))
@@ -1,10 +1,20 @@
 """
 ERIS Accounting Scripts
 """
-from eris import accounting
+from datetime import date
+from decimal import Decimal
 
-def calculate_member_accounts(members_db, _args):
+from eris import accounting, db, member_statements, statistics
+from eris_cli.scripts import jobs
+
+MONTHLY_KINDS = ("payment", "fee", "adjustment", "undo")
+
+def calculate_member_accounts(members_db, args):
     """Run member account calculations"""
+    if args.queue:
+        jobs.submit(members_db, "calculate", {})
+        return
+
     accounting.run_account_calculations(members_db)
 
 def adjust_member_account(members_db, args):
@@ -21,5 +31,122 @@ def adjust_member_account(members_db, args):
     if args.comment:
         comment = args.comment
 
+    if args.queue:
+        member = db.get_member(members_db, args.id)
+        if not member:
+            print("member not found")
+            return
+        print("Set account of {} ({}) from {} to {} EUR: {}".format(
+            member["name"], member["id"], member["account"],
+            args.amount, comment))
+        if input("proceed? (y/n) ") != "y":
+            print("abort")
+            return
+        jobs.submit(members_db, "adjust", {
+            "member_id": member["id"],
+            "amount": args.amount,
+            "comment": comment,
+        })
+        return
+
     accounting.adjust_member_account(
         members_db, args.id, args.amount, comment)
+
+
+def report_monthly(members_db, args):
+    """Show income and billed fees per month"""
+    totals = db.get_monthly_totals(members_db, year=args.year)
+
+    months = {}
+    for total in totals:
+        months.setdefault(total["month"], {})[total["kind"]] = total["amount"]
+
+    print("{:<8}\t{:>12}\t{:>12}\t{:>12}\t{:>12}\t{:>12}".format(
+        "Month", "Payments", "Fees", "Adjustments", "Undo", "Net"))
+    print("{:-<90}".format("-"))
+    for month, kinds in months.items():
+        amounts = [kinds.get(kind, Decimal("0.00")) for kind in MONTHLY_KINDS]
+        print("{:<8}\t{:>12}\t{:>12}\t{:>12}\t{:>12}\t{:>12}".format(
+            month, *amounts, sum(amounts)))
+
+
+def report_statistics(members_db, args):
+    """Show active members, joiners, leavers and fees per month"""
+    months = statistics.get_monthly(members_db, year=args.year)
+
+    print("{:<8}\t{:>8}\t{:>8}\t{:>8}\t{:>8}\t{:>12}\t{:>12}".format(
+        "Month", "Active", "Joined", "Left", "Churn", "Fees", "Payments"))
+    print("{:-<90}".format("-"))
+    for month in months:
+        churn = ""
+        if month["churn"] is not None:
+            churn = "{:.2%}".format(month["churn"])
+        print("{month:<8}\t{active:>8}\t{joiners:>8}\t{leavers:>8}\t"
+              "{churn:>8}\t{fees:>12}\t{payments:>12}".format(
+                  **dict(month, churn=churn)))
+
+
+def write_statements(members_db, args):
+    """Write account statements for all members into a directory"""
+    if not args.filename:
+        print("--filename <output directory> is required")
+        return
+
+    if args.year:
+        since = date(int(args.year), 1, 1)
+        until = date(int(args.year), 12, 31)
+    elif args.since and args.until:
+        since = db.decode_date(args.since)
+        until = db.decode_date(args.until)
+    else:
+        print("--year <year> or --since <date> --until <date> is required")
+        return
+
+    fmt = args.format or "text"
+    if fmt not in member_statements.FORMATS:
+        print("--format must be one of: {}".format(
+            ", ".join(member_statements.FORMATS)))
+        return
+
+    member_id = None
+    if args.id:
+        member_id = int(args.id)
+
+    count = member_statements.write_statements(
+        members_db, args.filename, since, until, fmt, member_id=member_id)
+    print("{} statements written to {}".format(count, args.filename))
+
+
+def report_balances(members_db, args):
+    """Show the balance of every member as of --date, default today"""
+    today = date.today()
+    as_of = today
+    if args.date:
+        as_of = db.decode_date(args.date)
+
+    print("{:>6}\t{:<24}\t{:>12}\t{:>6}\t{}".format(
+        "ID", "Name", "Balance", "Tx", "Last Transaction"))
+    print("{:-<90}".format("-"))
+    total = Decimal(0)
+    for balance in db.get_balances(members_db, as_of):
+        total += balance["balance"]
+        print("{id:>6}\t{name:<24}\t{balance:>12.2f}\t{transactions:>6}\t"
+              "{}".format(balance["last_date"] or "", **balance))
+    print("{:-<90}".format("-"))
+    print("{:>6}\t{:<24}\t{:>12.2f}".format("", "Total", total))
+
+    if as_of != today:
+        return
+
+    # The balances of today must match the accounts
+    differences = list(accounting.check_balances(members_db, today))
+    print("")
+    if not differences:
+        print("all balances match the member accounts")
+        return
+    print("{} accounts differ from their transactions:".format(
+        len(differences)))
+    for balance in differences:
+        print("{id:>6}\t{name:<24}\taccount {account:>10.2f}\t"
+              "transactions {balance:>10.2f}\tdifference "
+              "{difference:>10.2f}".format(**balance))
@@ -0,0 +1,26 @@
+"""
+ERIS HTTP API
+"""
+
+from eris import api, db
+
+
+def serve_api(members_db, args):
+    """Serve members, balances and transactions as read-only JSON"""
+    filename = db.get_filename(members_db)
+    if not filename:
+        print("the api needs a database file")
+        return
+
+    host = api.DEFAULT_HOST
+    if args.host:
+        host = args.host
+
+    port = api.DEFAULT_PORT
+    if args.port:
+        port = int(args.port)
+
+    # Do not hold the writable connection while serving
+    members_db.close()
+
+    api.serve(filename, host=host, port=port)
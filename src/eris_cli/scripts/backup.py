@@ -0,0 +1,48 @@
+"""
+ERIS Database Backup
+"""
+
+from eris import backup
+from eris.logging import log
+
+
+def backup_database(members_db, args):
+    """Write a verified standby copy into the --filename directory"""
+    if not args.filename:
+        print("--filename <backup directory> is required")
+        return
+
+    keep = backup.DEFAULT_KEEP
+    if args.keep:
+        try:
+            keep = int(args.keep)
+        except ValueError:
+            keep = 0
+    if keep < 1:
+        print("--keep must be a number of at least 1")
+        return
+
+    try:
+        filename, checksum = backup.backup(
+            members_db, args.filename, keep=keep,
+            progress=backup.Progress(log))
+    except backup.BackupError as e:
+        print(e)
+        return
+
+    print("{}  {}".format(checksum, filename))
+
+
+def verify_backups(_members_db, args):
+    """Check the copies in the --filename directory against the manifest"""
+    if not args.filename:
+        print("--filename <backup directory> is required")
+        return
+
+    results = backup.verify_backups(args.filename)
+    if not results:
+        print("no backups found in {}".format(args.filename))
+        return
+
+    for filename, problem in sorted(results.items()):
+        print("{}\t{}".format(filename, problem or "ok"))
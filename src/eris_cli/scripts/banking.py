@@ -5,8 +5,11 @@ ERIS Bank CSV Import
 from datetime import date
 from decimal import Decimal
 
+from os import path
+
 from eris import db
-from eris.banking import import_transactions
+from eris.banking import import_transactions, UnsupportedFormatError
+from eris_cli.scripts import jobs
 
 
 def print_not_imported(transaction):
@@ -15,11 +18,14 @@ def print_not_imported(transaction):
                               transaction["amount"]))
     print("\tIBAN: {iban}\t{iban_hash}".format(**transaction))
     print("\t{description}".format(**transaction))
+    for score, member in transaction.get("suggestions", []):
+        print("\tsuggested: {} ({})\tscore {}".format(
+            member["name"], member["id"], score))
     print("")
 
 
 def import_bank_csv(members_db, args):
-    """Import a deutsche bank CSV"""
+    """Import a deutsche bank CSV, CAMT.053 or MT940 statement"""
     if not args.filename:
         print("please provide the CSV with transactions using --filename")
         return
@@ -29,37 +35,58 @@ def import_bank_csv(members_db, args):
             print("abort")
             return
 
-    not_imported = import_transactions(
-        members_db,
-        args.filename,
-        encoding=args.encoding,
-        force=args.force,
-    )
+    auto_assign = None
+    if args.auto_assign:
+        auto_assign = float(args.auto_assign)
+
+    if args.queue:
+        jobs.submit(members_db, "import", {
+            "filename": path.abspath(args.filename),
+            "encoding": args.encoding,
+            "force": args.force,
+            "auto_assign": auto_assign,
+        })
+        return
+
+    try:
+        not_imported = import_transactions(
+            members_db,
+            args.filename,
+            encoding=args.encoding,
+            force=args.force,
+            auto_assign=auto_assign,
+        )
+    except UnsupportedFormatError as e:
+        print(e)
+        return
 
     if not_imported:
         print("Could not import the following transactions.")
         print("Consider creating import rules for:")
         for transaction in not_imported:
             print_not_imported(transaction)
+        print("Importing {} again only imports these transactions.".format(
+            args.filename))
 
 
-def print_rule(members_db, rule):
+def print_rule(session, rule):
     """Print a bank import rule"""
-    member = db.get_member(members_db, rule["member_id"])
+    member = session.get_member(rule["member_id"])
     print("{:<30} ({})\t{}:\t{}".format(
         member["name"], member["id"], rule["iban_hash"], rule["handler"]))
 
 
 def list_rules(members_db, _args):
     """List all bank import rules"""
+    session = db.Session(members_db)
     rules = db.get_bank_import_rules(members_db)
     for rule in rules:
-        print_rule(members_db, rule)
+        print_rule(session, rule)
 
 
-def print_transaction(members_db, tx):
+def print_transaction(session, tx):
     """Print a tx"""
-    member = db.get_member(members_db, tx["member_id"])
+    member = session.get_member(tx["member_id"])
                                         
     print("{}\t{}\t{:<20}\t{:<40}\t{}\t{}".format(
         tx["id"], tx["date"],
@@ -89,9 +116,46 @@ def list_transactions(members_db, args):
     if member:
         member_id = member["id"]
     
-    transactions = db.get_transactions(members_db, member_id=member_id)
+    after = None
+    if args.after:
+        try:
+            tx_date, tx_id = args.after.split(",")
+            after = (db.decode_date(tx_date), int(tx_id))
+        except ValueError:
+            print("--after <date>,<transaction id> is expected")
+            return
+
+    since = None
+    until = None
+    try:
+        if args.since:
+            since = db.decode_date(args.since)
+        if args.until:
+            until = db.decode_date(args.until)
+    except ValueError:
+        print("--since and --until expect a date: YYYY-MM-DD")
+        return
+
+    limit = None
+    if args.limit:
+        limit = int(args.limit)
+
+    session = db.Session(members_db)
+    transactions = db.iter_transactions(
+        members_db,
+        member_id=member_id,
+        since=since,
+        until=until,
+        after=after,
+        limit=limit)
+    tx = None
+    count = 0
     for tx in transactions:
-        print_transaction(members_db, tx)
+        print_transaction(session, tx)
+        count += 1
+
+    if limit and count == limit:
+        print("next page: --after {},{}".format(tx["date"], tx["id"]))
 
 
 def undo_transaction(members_db, args):
@@ -104,7 +168,8 @@ def undo_transaction(members_db, args):
         print("transaction not found")
         return
 
-    member = db.get_member(members_db, tx["member_id"])
+    session = db.Session(members_db)
+    member = session.get_member(tx["member_id"])
     next_amount = member["account"] - tx["amount"]
     print("Member: {} ({})".format(member["name"], member["id"]))
     print("Transaction: {}\t {} \t{} EUR, {}".format(
@@ -123,14 +188,84 @@ def undo_transaction(members_db, args):
         "amount": -tx["amount"],
         "account_name": tx["account_name"],
         "description": "[UNDO] " + tx["description"],
+        "kind": "undo",
     }
 
-    db.set_account(members_db, member["id"], next_amount)
-    db.add_transaction(members_db, undo_tx)
+    session.set_account(member["id"], next_amount)
+    session.add_transaction(undo_tx)
+    session.flush()
 
     print("ok")
 
 
+def list_batches(members_db, _args):
+    """List import and calculation batches"""
+    print("{:>4}\t{:<12}\t{:<20}\t{:>6}\t{:>12}\t{:<20}\t{}".format(
+        "ID", "Kind", "Created", "TX", "Total", "Undone", "Description"))
+    print("{:-<120}".format("-"))
+    for batch in db.get_batches(members_db):
+        print("{id:>4}\t{kind:<12}\t{created_at:<20}\t{transactions:>6}\t"
+              "{total:>12.2f}\t{undone:<20}\t{description}".format(
+                  undone=batch["undone_at"] or "", **batch))
+
+
+def undo_batch(members_db, args):
+    """Reverse all transactions of a batch"""
+    if not args.id:
+        print("--id <batch_id> is required")
+        return
+    batch = db.get_batch(members_db, args.id)
+    if not batch:
+        print("batch not found")
+        return
+    if batch["undone_at"]:
+        print("batch was already undone at {}".format(batch["undone_at"]))
+        return
+    later = db.get_later_calculations(members_db, batch)
+    if later:
+        print("undo the later calculation batches first: {}".format(
+            ", ".join(map(str, later))))
+        return
+
+    print("Batch: {} ({}) {}".format(
+        batch["id"], batch["kind"], batch["description"]))
+    print("Undoing {} transactions of {} members, total {:.2f} EUR".format(
+        batch["transactions"], batch["members"], batch["total"]))
+    print("")
+    if input("proceed? (y/n) ") != "y":
+        print("not undoing batch")
+        return
+
+    try:
+        undo_id = db.undo_batch(members_db, batch["id"])
+    except db.UndoBatchError as e:
+        print(e)
+        return
+    print("ok, undo batch: {}".format(undo_id))
+
+
+def archive_transactions(members_db, args):
+    """Move transactions of closed years into per-year archive files"""
+    if not args.year:
+        print("--year <YYYY> required, archives up to and including it")
+        return
+
+    year = int(args.year)
+    if year >= date.today().year:
+        print("the current year can not be archived")
+        return
+
+    archived = db.archive_transactions(members_db, year)
+    if not archived:
+        print("nothing to archive")
+        return
+
+    archives = db.get_transaction_archives(members_db)
+    for archive_year, count in archived.items():
+        print("{}: {} transactions -> {}".format(
+            archive_year, count, archives[archive_year]))
+
+
 def assign_member_iban(members_db, args):
     """Use this member ID for the matching IBAN hash"""
     if not args.iban_hash:
@@ -145,7 +280,7 @@ def assign_member_iban(members_db, args):
         "handler": "use_member_id",
     }
     rule = db.add_bank_import_rule(members_db, rule)
-    print_rule(members_db, rule)
+    print_rule(db.Session(members_db), rule)
 
 
 def assign_split_iban(members_db, args):
@@ -159,10 +294,11 @@ def assign_split_iban(members_db, args):
 
     assignments = [s.split("=") for s in args.split]
 
+    session = db.Session(members_db)
     rule_member_id = None
     total = Decimal(0)
     for member_id, amount in assignments:
-        member = db.get_member(members_db, member_id)
+        member = session.get_member(member_id)
         if not member:
             print("member not found with ID: {}".format(member_id))
             return
@@ -182,4 +318,4 @@ def assign_split_iban(members_db, args):
         "params": list(assignments),
     }
     rule = db.add_bank_import_rule(members_db, rule)
-    print_rule(members_db, rule)
+    print_rule(session, rule)
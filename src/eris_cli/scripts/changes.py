@@ -0,0 +1,58 @@
+"""
+ERIS Change Log
+"""
+
+import time
+
+from eris import db
+
+POLL_INTERVAL = 1.0
+
+
+def print_change(change):
+    """Show a change log entry"""
+    print("{id}\t{changed_at}\t{table_name:<18}\t{operation:<6}\t"
+          "{row_key}".format(**change))
+
+
+def tail_changes(members_db, args):
+    """Show the changes after --after <id>, keep polling with --follow"""
+    after = args.after or 0
+    limit = int(args.limit or 1000)
+    try:
+        after = db.encode_id(after)
+    except ValueError:
+        print("--after <change id> is expected")
+        return
+
+    while True:
+        try:
+            changes = db.get_changes(members_db, after=after, limit=limit)
+        except db.ChangesCompactedError as e:
+            print(e)
+            print("a full sync is required, continue with --after {}".format(
+                db.get_changes_compacted_until(members_db)))
+            return
+
+        for change in changes:
+            print_change(change)
+        if changes:
+            after = changes[-1]["id"]
+
+        if not args.follow:
+            print("next: --after {}".format(after))
+            return
+        if len(changes) < limit:
+            time.sleep(POLL_INTERVAL)
+
+
+def compact_changes(members_db, args):
+    """Remove superseded changes, and all before --date if given"""
+    before = None
+    if args.date:
+        before = db.decode_date(args.date)
+
+    removed = db.compact_changes(members_db, before)
+    print("{} changes removed".format(removed))
+    print("changes up to {} may be missing".format(
+        db.get_changes_compacted_until(members_db)))
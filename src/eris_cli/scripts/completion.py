@@ -0,0 +1,50 @@
+"""
+ERIS Shell Completion
+"""
+from eris_cli.cli import COMMANDS
+
+BASH_COMPLETION = """\
+_eris() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}"
+    local opts
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        COMPREPLY=($(compgen -W "{commands} --help" -- "$cur"))
+        return
+    fi
+    case "${{COMP_WORDS[1]}}" in
+{cases}
+    esac
+    if [[ "$cur" == -* ]]; then
+        COMPREPLY=($(compgen -W "$opts --help" -- "$cur"))
+    else
+        COMPREPLY=($(compgen -f -- "$cur"))
+    fi
+}}
+complete -o filenames -F _eris eris
+"""
+
+ZSH_PREAMBLE = """\
+autoload -Uz bashcompinit
+bashcompinit
+"""
+
+
+def completion_script(shell="bash"):
+    """Generate the completion script from the command registry"""
+    cases = []
+    for command in COMMANDS.values():
+        flags = " ".join(flag for flag, _ in command.get_options())
+        cases.append('        {}) opts="{}" ;;'.format(command.name, flags))
+
+    script = BASH_COMPLETION.format(
+        commands=" ".join(COMMANDS),
+        cases="\n".join(cases))
+    if shell == "zsh":
+        script = ZSH_PREAMBLE + script
+
+    return script
+
+
+def print_completion(_members_db, args):
+    """Print a shell completion script"""
+    print(completion_script(args.shell), end="")
@@ -0,0 +1,37 @@
+"""
+ERIS Dunning Letters
+"""
+
+from eris import dunning
+
+
+def list_arrears(members_db, _args):
+    """List members in arrears with their dunning level"""
+    print("{:>4}\t{:<24}\t{:<30}\t{:>12}\t{}\t{}\t{}\t{}".format(
+        "ID", "Name", "Email", "Account", "Fee", "Interval", "Level",
+        "Notified"))
+    print("{:-<140}".format("-"))
+    for member in dunning.get_members_in_arrears(members_db):
+        print("{id:>4}\t{name:<24}\t{email:<30}\t{account:>12.2f}\t{fee}\t"
+              "{interval}\t{level}\t{dunning_level}".format(**member))
+
+
+def write_dunning_letters(members_db, args):
+    """Write reminders for members in arrears to a maildir or .mbox"""
+    if not args.filename:
+        print("--filename <maildir or file.mbox> is required")
+        return
+
+    template = None
+    if args.template:
+        with open(args.template) as file:
+            template = file.read()
+
+    counts = dunning.write_letters(members_db, args.filename, template)
+    if not counts:
+        print("no new reminders")
+        return
+
+    for level, count in sorted(counts.items()):
+        print("level {}: {} letters".format(level, count))
+    print("written to {}".format(args.filename))
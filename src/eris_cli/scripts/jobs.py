@@ -0,0 +1,41 @@
+"""
+ERIS Writer Jobs
+"""
+
+import sys
+
+from eris import db, jobs
+
+
+def submit(members_db, kind, params):
+    """Queue a job and follow its output"""
+    job_id = jobs.submit_job(members_db, kind, params)
+    print("queued job {}, waiting for the writer (eris run-writer)".format(
+        job_id))
+    job = jobs.wait_for_job(members_db, job_id, out=sys.stdout)
+    if job["status"] == "queued":
+        print("job {} is still queued, see eris list-jobs".format(job_id))
+    elif job["status"] == "failed":
+        print("job {} failed:".format(job_id))
+        print(job["error"])
+
+
+def run_writer(members_db, _args):
+    """Run queued import, calculation and adjustment jobs"""
+    filename = db.get_filename(members_db)
+    members_db.close()
+    try:
+        jobs.run_writer(filename)
+    except KeyboardInterrupt:
+        pass
+
+
+def list_jobs(members_db, _args):
+    """List the latest writer jobs"""
+    print("{:>4}\t{:<10}\t{:<8}\t{:<20}\t{:<20}\t{}".format(
+        "ID", "Kind", "Status", "Created", "Finished", "Params"))
+    print("{:-<120}".format("-"))
+    for job in jobs.get_jobs(members_db):
+        print("{:>4}\t{:<10}\t{:<8}\t{:<20}\t{:<20}\t{}".format(
+            job["id"], job["kind"], job["status"], job["created_at"],
+            job["finished_at"] or "", job["params"]))
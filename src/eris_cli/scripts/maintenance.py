@@ -0,0 +1,61 @@
+"""
+ERIS Database Maintenance
+"""
+
+from eris import maintenance
+
+
+def print_pages(title, pages):
+    """Show the page statistics"""
+    size = pages["page_size"] * pages["page_count"]
+    print("{:<8}\t{} pages of {} bytes ({:.1f} MiB), {} free, "
+          "auto_vacuum {}".format(
+              title, pages["page_count"], pages["page_size"],
+              size / (1 << 20), pages["freelist_count"],
+              pages["auto_vacuum"]))
+
+
+def maintain(members_db, args):
+    """Check and optimize the database, vacuum incrementally"""
+    pages = maintenance.DEFAULT_VACUUM_PAGES
+    if args.vacuum_pages:
+        pages = int(args.vacuum_pages)
+
+    report = maintenance.maintain(members_db, pages, rebuild=args.force)
+
+    print("{:<24}\t{:>10}\t{}".format("Step", "Seconds", "Result"))
+    print("{:-<90}".format("-"))
+    for step in report["steps"]:
+        result = step["result"]
+        if isinstance(result, list):
+            result = "\n\t\t\t\t\t".join(result)
+        print("{:<24}\t{:>10.3f}\t{}".format(
+            step["step"], step["seconds"], result))
+    print("")
+
+    print_pages("before", report["pages_before"])
+    print_pages("after", report["pages_after"])
+    if report["pages_after"]["auto_vacuum"] != "incremental":
+        print("incremental vacuum is off, enable it once with --force")
+    print("")
+
+    if "indexes" in report:
+        print("{:<32}\t{:<20}\t{:>8}\t{}".format(
+            "Table / Index", "Table", "Pages", "Statistics"))
+        print("{:-<90}".format("-"))
+        for entry in report["indexes"]:
+            print("{:<32}\t{:<20}\t{:>8}\t{}".format(
+                entry["name"], entry["table"],
+                entry["pages"] if entry["pages"] is not None else "-",
+                entry["stat"] or "-"))
+        print("")
+
+    print("{:<28}\t{:>10}\t{:>10}\t{}".format(
+        "Query", "Before ms", "After ms", "Plan"))
+    print("{:-<90}".format("-"))
+    after = report.get("probes_after", {})
+    for name, probe in report["probes_before"].items():
+        probe_after = after.get(name, probe)
+        print("{:<28}\t{:>10.2f}\t{:>10.2f}\t{}".format(
+            name, probe["seconds"] * 1000, probe_after["seconds"] * 1000,
+            probe_after["plan"]))
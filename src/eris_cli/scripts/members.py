@@ -4,9 +4,14 @@ Eris CLI
 
 import json
 from datetime import date
+from decimal import Decimal, InvalidOperation
 
 from eris import db
-from eris.readers import read_members_csv
+from eris.readers import (
+    read_members_csv,
+    read_member_updates_csv,
+    join_members,
+)
 
 def list_members(members_db, args):
     """
@@ -16,7 +21,7 @@ def list_members(members_db, args):
     if args.name:
         members = db.get_members_by_name(members_db, args.name)
     else:
-        members = db.get_members(members_db)
+        members = db.iter_members(members_db)
     print("{:>4}\t{:<24}\t{:<30}\t{:<24}\t{:>12}\t{}\t{}\t{}\t{}".format(
         "ID", "Name", "Email", "Notes", "Account", "Last Payment", "Interval", "Fee", "Inacive"))
     print("{:-<180}".format("-"))
@@ -71,20 +76,6 @@ INTERVALS = {
 }
 
 
-def get_payment_interval(intervals, name):
-    """Get payment interval from legacy members db"""
-    # Get member
-    member = None
-    for m in intervals:
-        if m["name"] == name:
-            member = m
-
-    if not member:
-        return (1, False)
-
-    return (INTERVALS[member["zahlungsart"]], True)
-
-
 def import_payment_intervals(members_db, args):
     """
     Import payment intervals
@@ -96,17 +87,30 @@ def import_payment_intervals(members_db, args):
         return
 
     with open(args.filename) as file:
-        intervals = read_members_csv(file)
+        rows = read_members_csv(file)
 
-    members = db.get_members(members_db)
+    members = db.iter_members(members_db)
+    matched, unmatched = join_members(members, rows)
 
-    for m in members:
-        (interval, found) = get_payment_interval(intervals, m["name"])
-        if not found:
+    updates = []
+    for member, row in matched:
+        interval = INTERVALS.get(row["zahlungsart"])
+        if interval is None:
+            print("Unknown payment type {} for {} ({})".format(
+                row["zahlungsart"], member["name"], member["id"]))
             continue
-        
-        # Update member
-        db.set_interval(members_db, m["id"], interval)
+        if interval != member["interval"]:
+            updates.append((member["id"], "interval", interval))
+
+    # Update members
+    db.update_members(members_db, updates)
+
+    print("Updated {} of {} matched members".format(
+        len(updates), len(matched)))
+    if unmatched:
+        print("Not found in legacy export:")
+        for member in unmatched:
+            print(" - {} ({})".format(member["name"], member["id"]))
 
 
 def set_interval(members_db, args):
@@ -172,6 +176,120 @@ def end_membership(members_db, args):
     db.end_membership(members_db, args.id, end=args.date)
     
 
+def decode_update_value(field, value):
+    """Decode and check a value of a bulk member update"""
+    value = value.strip()
+    if field == "name":
+        if not value:
+            raise ValueError("name must not be empty")
+        return value
+    if field == "fee":
+        try:
+            fee = Decimal(value)
+        except InvalidOperation as e:
+            raise ValueError("not an amount: {}".format(value)) from e
+        if not fee.is_finite():
+            raise ValueError("not an amount: {}".format(value))
+        if fee < 0:
+            raise ValueError("fee must not be negative")
+        return fee
+    if field == "interval":
+        try:
+            interval = int(value)
+        except ValueError as e:
+            raise ValueError("not a number of months: {}".format(value)) from e
+        if interval < 1:
+            raise ValueError("interval must be at least one month")
+        return interval
+    if field == "membership_end":
+        if not value:
+            return None # Membership continues
+        return db.decode_date(value)
+
+    raise ValueError("unsupported field: {}".format(field))
+
+
+def validate_member_updates(members, updates):
+    """Check all updates against the members, returns decoded updates"""
+    decoded = []
+    errors = []
+    seen = set()
+    for line, (member_id, field, value) in enumerate(updates, start=2):
+        if member_id is None or field is None or value is None:
+            errors.append("line {}: id, field and value are required".format(
+                line))
+            continue
+
+        try:
+            member_id = int(member_id)
+        except ValueError:
+            errors.append("line {}: not a member id: {}".format(
+                line, member_id))
+            continue
+
+        if member_id not in members:
+            errors.append("line {}: member not found: {}".format(
+                line, member_id))
+            continue
+
+        if (member_id, field) in seen:
+            errors.append("line {}: duplicate {} for member {}".format(
+                line, field, member_id))
+            continue
+        seen.add((member_id, field))
+
+        try:
+            value = decode_update_value(field, value)
+        except ValueError as e:
+            errors.append("line {}: {}".format(line, e))
+            continue
+
+        decoded.append((member_id, field, value))
+
+    return decoded, errors
+
+
+def bulk_update_members(members_db, args):
+    """Update members from a CSV with id,field,value rows"""
+    if not args.filename:
+        print("please provide the CSV with changes using --filename")
+        return
+
+    with open(args.filename) as file:
+        try:
+            updates = read_member_updates_csv(file)
+        except ValueError as e:
+            print("{}: {}".format(args.filename, e))
+            return
+
+    members = {m["id"]: m for m in db.get_members(members_db)}
+    updates, errors = validate_member_updates(members, updates)
+    if errors:
+        print("Not applying any changes:")
+        for error in errors:
+            print(" - " + error)
+        return
+
+    print("{:>4}\t{:<24}\t{:<16}\t{:<24}\t{}".format(
+        "ID", "Name", "Field", "Before", "After"))
+    print("{:-<100}".format("-"))
+    for member_id, field, value in updates:
+        member = members[member_id]
+        print("{:>4}\t{:<24}\t{:<16}\t{:<24}\t{}".format(
+            member_id, member["name"], field,
+            str(member[field]), str(value)))
+    print("")
+    print("{} changes for {} members".format(
+        len(updates), len({u[0] for u in updates})))
+
+    if input("proceed? (y/n) ") != "y":
+        print("abort")
+        return
+
+    db.update_members(members_db, updates)
+    print("ok")
+
+
 def add_member(members_db, args):
     """Add a member to the database"""
     if not args.name:
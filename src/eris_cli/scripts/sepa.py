@@ -0,0 +1,109 @@
+"""
+ERIS SEPA Direct Debit
+"""
+
+from eris import db, sepa
+
+
+def set_sepa_creditor(members_db, args):
+    """Set the SEPA creditor name, account and creditor id"""
+    if not args.name:
+        print("--name <creditor name> is required")
+        return
+    if not args.iban:
+        print("--iban <creditor IBAN> is required")
+        return
+    if not args.creditor_id:
+        print("--creditor-id <SEPA creditor id> is required")
+        return
+
+    try:
+        creditor = sepa.set_creditor(
+            members_db, args.name, args.iban, args.bic, args.creditor_id)
+    except sepa.MandateError as e:
+        print(e)
+        return
+
+    print("Creditor: {name} {iban} {bic} ({creditor_id})".format(**creditor))
+
+
+def add_mandate(members_db, args):
+    """Add or replace the direct debit mandate of a member"""
+    if not args.id:
+        print("--id <member id> is required")
+        return
+    if not args.iban:
+        print("--iban <member IBAN> is required")
+        return
+    if not args.date:
+        print("--date <date of signature> is required")
+        return
+
+    member = db.get_member(members_db, args.id)
+    if not member:
+        print("member not found")
+        return
+
+    try:
+        mandate = sepa.set_mandate(members_db, {
+            "member_id": member["id"],
+            "mandate_id": args.mandate_id,
+            "iban": args.iban,
+            "bic": args.bic,
+            "signed_on": args.date,
+        })
+    except sepa.MandateError as e:
+        print(e)
+        return
+
+    print("Mandate {mandate_id} for {name}: {iban}".format(
+        name=member["name"], **mandate))
+
+
+def export_sepa_debits(members_db, args):
+    """Write a pain.008 direct debit file for all due members"""
+    if not args.filename:
+        print("--filename <output.xml> is required")
+        return
+
+    collection_date = None
+    if args.date:
+        collection_date = db.decode_date(args.date)
+
+    try:
+        count, cents = sepa.export_debits(
+            members_db, args.filename, collection_date, xsd=args.xsd)
+    except (sepa.MandateError, sepa.ValidationError) as e:
+        print(e)
+        return
+
+    if not count:
+        print("no members are due, nothing written")
+        return
+
+    print("{} debits, {} EUR written to {}".format(
+        count, sepa.format_cents(cents), args.filename))
+
+    if args.xsd:
+        print("valid according to {}".format(args.xsd))
+
+
+def cancel_collection(members_db, args):
+    """Cancel the pending direct debit of a member"""
+    if not args.id:
+        print("--id <member id> is required")
+        return
+
+    member = db.get_member(members_db, args.id)
+    if not member:
+        print("member not found")
+        return
+
+    count = sepa.cancel_collections(members_db, member["id"])
+    if not count:
+        print("no pending collection for {} ({})".format(
+            member["name"], member["id"]))
+        return
+
+    print("cancelled the pending collection of {} ({})".format(
+        member["name"], member["id"]))